@@ -0,0 +1,41 @@
+"""
+Micro-benchmark of the message codecs used by the communicators.
+
+Measures the encode and decode cost per message and the encoded size of
+typical consensus messages for every available codec.
+
+Usage:
+    python benchmarks/bench_codecs.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qcluster.communication import CODECS  # noqa: E402
+
+MESSAGES = {
+    'heartbeat': {'identifier': 'server_a', 'term': 42},
+    'vote_response': {'vote_granted': True},
+    'register': {'host': 'localhost', 'port': 7001, 'identifier': 'server_a'},
+}
+
+
+def bench(iterations):
+    print("{:<10} {:<14} {:>6} {:>12} {:>12}".format(
+        'codec', 'message', 'bytes', 'encode (ns)', 'decode (ns)'))
+    for name, codec in CODECS.items():
+        for message_name, message in MESSAGES.items():
+            payload = codec.encode(message)
+            encode = timeit.timeit(lambda: codec.encode(message),
+                                   number=iterations)
+            decode = timeit.timeit(lambda: codec.decode(payload),
+                                   number=iterations)
+            print("{:<10} {:<14} {:>6} {:>12.0f} {:>12.0f}".format(
+                name, message_name, len(payload),
+                encode / iterations * 1e9, decode / iterations * 1e9))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -1,5 +1,7 @@
 from .qcluster import QCluster
+from .consensus import NotLeaderError
+from .gossip import MemberStatus
 
-__all__ = ['QCluster']
+__all__ = ['QCluster', 'NotLeaderError', 'MemberStatus']
 __version__ = "0.0.5"
 __copyright__ = "Copyright 2020 Qson Labs, LLC"
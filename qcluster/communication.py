@@ -1,14 +1,279 @@
 import aiohttp
 import asyncio
 import async_timeout
+import json
 import logging
+import struct
 
 from aiohttp import web
 from qcluster import utils
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
 logger = logging.getLogger(__name__)
 aiohttp_logger = logging.getLogger("{}.aiohttp".format(__name__))
 
+# The HTTP header carrying the data that describes a request with a raw body,
+# such as a snapshot chunk
+_CHUNK_HEADER = 'X-Raft-Chunk'
+
+
+class JSONCodec:
+    """
+    Serializes messages as JSON. Every peer understands this codec, so it is
+    the default and the fallback when a peer rejects another codec.
+    """
+    name = "json"
+    codec_id = 1
+    content_type = "application/json"
+
+    @staticmethod
+    def encode(data):
+        """
+        Encodes a message.
+
+        Args:
+            data: The dict to encode.
+
+        Returns:
+            The encoded bytes.
+        """
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def decode(payload):
+        """
+        Decodes a message.
+
+        Args:
+            payload: The bytes to decode.
+
+        Returns:
+            The decoded dict.
+        """
+        if not payload:
+            return {}
+        return json.loads(payload)
+
+
+class BinaryCodec:
+    """
+    Serializes messages into a fixed struct layout. The fields used by the
+    consensus messages are packed in a known order behind a presence bitmask;
+    any other field is carried in a trailing JSON blob.
+
+    Layout:
+        - uint32 bitmask of the known fields that are present
+        - each present known field, in order:
+            - int: signed 64 bit integer
+            - bool: 1 byte
+            - str: uint16 length followed by utf-8 bytes
+        - optional JSON object with the remaining fields
+    """
+    name = "binary"
+    codec_id = 2
+    content_type = "application/x-qcluster-binary"
+
+    fields = (
+        ('identifier', str),
+        ('term', int),
+        ('vote_granted', bool),
+        ('host', str),
+        ('port', int),
+        ('prev_index', int),
+        ('prev_term', int),
+        ('leader_commit', int),
+        ('success', bool),
+        ('match_index', int),
+        ('last_log_index', int),
+        ('last_log_term', int),
+        ('pre_vote', bool),
+        ('leadership_transfer', bool),
+        ('election_timeout_ms', int),
+    )
+
+    _mask = struct.Struct('!I')
+    _int = struct.Struct('!q')
+    _length = struct.Struct('!H')
+
+    @classmethod
+    def encode(cls, data):
+        """
+        Encodes a message.
+
+        Args:
+            data: The dict to encode.
+
+        Returns:
+            The encoded bytes.
+        """
+        mask = 0
+        parts = [b'']
+        packed = set()
+        for bit, (key, kind) in enumerate(cls.fields):
+            value = data.get(key)
+            if type(value) is not kind:
+                continue
+            if kind is int:
+                if not -2 ** 63 <= value < 2 ** 63:
+                    continue
+                parts.append(cls._int.pack(value))
+            elif kind is bool:
+                parts.append(b'\x01' if value else b'\x00')
+            else:
+                raw = value.encode('utf-8')
+                if len(raw) > 0xFFFF:
+                    continue
+                parts.append(cls._length.pack(len(raw)))
+                parts.append(raw)
+            mask |= 1 << bit
+            packed.add(key)
+        parts[0] = cls._mask.pack(mask)
+        if len(packed) != len(data):
+            extra = {k: v for k, v in data.items() if k not in packed}
+            parts.append(JSONCodec.encode(extra))
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, payload):
+        """
+        Decodes a message.
+
+        Args:
+            payload: The bytes to decode.
+
+        Returns:
+            The decoded dict.
+
+        Raises:
+            ValueError: The payload is truncated or malformed.
+        """
+        if not payload:
+            return {}
+        try:
+            mask, = cls._mask.unpack_from(payload, 0)
+            offset = cls._mask.size
+            data = {}
+            for bit, (key, kind) in enumerate(cls.fields):
+                if not mask & (1 << bit):
+                    continue
+                if kind is int:
+                    data[key], = cls._int.unpack_from(payload, offset)
+                    offset += cls._int.size
+                elif kind is bool:
+                    data[key] = payload[offset] != 0
+                    offset += 1
+                else:
+                    length, = cls._length.unpack_from(payload, offset)
+                    offset += cls._length.size
+                    raw = bytes(payload[offset:offset + length])
+                    if len(raw) != length:
+                        raise ValueError("Truncated string field")
+                    data[key] = raw.decode('utf-8')
+                    offset += length
+        except (struct.error, IndexError) as e:
+            raise ValueError("Malformed binary message: {}".format(e))
+        if offset < len(payload):
+            data.update(JSONCodec.decode(bytes(payload[offset:])))
+        return data
+
+
+class MsgpackCodec:
+    """
+    Serializes messages with msgpack. Only available when the optional
+    msgpack package is installed.
+    """
+    name = "msgpack"
+    codec_id = 3
+    content_type = "application/x-msgpack"
+
+    @staticmethod
+    def encode(data):
+        """
+        Encodes a message.
+
+        Args:
+            data: The dict to encode.
+
+        Returns:
+            The encoded bytes.
+        """
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def decode(payload):
+        """
+        Decodes a message.
+
+        Args:
+            payload: The bytes to decode.
+
+        Returns:
+            The decoded dict.
+        """
+        if not payload:
+            return {}
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec, BinaryCodec)}
+if msgpack is not None:  # pragma: no cover
+    CODECS[MsgpackCodec.name] = MsgpackCodec
+
+
+def get_codec(name):
+    """
+    Looks up a codec by name.
+
+    Args:
+        name: The name of the codec, e.g. "json" or "binary".
+
+    Returns:
+        The codec class.
+
+    Raises:
+        ValueError: The codec is unknown or its dependency is not installed.
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError("Unsupported codec: {}".format(name))
+    return codec
+
+
+def get_codec_by_content_type(content_type):
+    """
+    Looks up a codec by the content type it produces.
+
+    Args:
+        content_type: A MIME type such as "application/json".
+
+    Returns:
+        The codec class, or None if no codec matches.
+    """
+    for codec in CODECS.values():
+        if codec.content_type == content_type:
+            return codec
+    return None
+
+
+def get_codec_by_id(codec_id):
+    """
+    Looks up a codec by the identifier written into TCP frames.
+
+    Args:
+        codec_id: The numeric codec identifier.
+
+    Returns:
+        The codec class, or None if no codec matches.
+    """
+    for codec in CODECS.values():
+        if codec.codec_id == codec_id:
+            return codec
+    return None
+
 
 class HTTPCommunicator:
     """
@@ -17,7 +282,15 @@ class HTTPCommunicator:
     responsible for maintaining a "Requester" and a "Responder".
     """
 
-    def __init__(self, identifier, listen_port, listen_host="localhost"):
+    def __init__(self,
+                 identifier,
+                 listen_port,
+                 listen_host="localhost",
+                 pool_limit=100,
+                 pool_limit_per_peer=4,
+                 keepalive_timeout=30,
+                 codec="json",
+                 udp_heartbeats=False):
         """
         Creates a new HTTPCommunication object. This will expose higher level
         communications to other parts of the project.
@@ -26,14 +299,36 @@ class HTTPCommunicator:
             identifier: The identifier of the peer implementing the SDK.
             listen_host: The hostname that will accept inbound messages.
             listen_port: The port that will accept inbound messages.
+            pool_limit: Optional; The maximum number of open connections
+              across all peers. (Default=100)
+            pool_limit_per_peer: Optional; The maximum number of open
+              connections to a single peer. (Default=4)
+            keepalive_timeout: Optional; The time in seconds an idle
+              connection is kept open before it is expired. (Default=30)
+            codec: Optional; The name of the preferred codec for outbound
+              messages. Peers that reject it fall back to "json".
+              (Default="json")
+            udp_heartbeats: Optional; Whether to also accept and offer
+              fire-and-forget heartbeats over UDP. (Default=False)
         """
         self.identifier = identifier
         self.listen_host = listen_host
         self.listen_port = listen_port
+        self.codec = get_codec(codec)
+
+        # The codec agreed upon with each (host, port)
+        self._peer_codecs = {}
 
-        self._requester = _HTTPRequester()
+        self._requester = _HTTPRequester(limit=pool_limit,
+                                         limit_per_host=pool_limit_per_peer,
+                                         keepalive_timeout=keepalive_timeout)
         self._responder = _HTTPResponder(self.listen_host, self.listen_port)
 
+        self.heartbeat_channel = None
+        if udp_heartbeats:
+            self.heartbeat_channel = UDPHeartbeatChannel(self.listen_host,
+                                                         self.listen_port)
+
     async def start(self):
         """
         Responsible for formally starting the sub-services used for HTTP
@@ -42,6 +337,19 @@ class HTTPCommunicator:
         This needs to be called before requests will be accepted.
         """
         await self._responder.start_server()
+        if self.heartbeat_channel is not None:
+            await self.heartbeat_channel.start()
+
+    async def close(self):
+        """
+        Shuts down the sub-services used for HTTP communication. Pooled
+        outbound connections are closed and the listener stops accepting
+        requests.
+        """
+        if self.heartbeat_channel is not None:
+            self.heartbeat_channel.close()
+        await self._requester.close()
+        await self._responder.stop_server()
 
     async def ping(self, host, port, timeout=1):
         """
@@ -61,7 +369,7 @@ class HTTPCommunicator:
         try:
             response = await self._requester.get(host, port, '/ping', timeout)
             return response.status == 200
-        except aiohttp.client_exceptions.ClientOSError:
+        except aiohttp.ClientConnectionError:
             return False
         except asyncio.exceptions.TimeoutError:
             return False
@@ -90,18 +398,10 @@ class HTTPCommunicator:
         logger.debug("Sending heartbeat to {}:{}".format(host, port))
         try:
             endpoint = "/raft/heartbeat"
-            response = await self._requester.post(host,
-                                                  port,
-                                                  endpoint,
-                                                  data,
-                                                  timeout)
-            return_data = None
-            try:
-                return_data = await response.json()
-            finally:
-                return response.status == 200, return_data
-        except aiohttp.client_exceptions.ClientOSError:
-            # logger.error("ClientOSError")
+            response = await self._post(host, port, endpoint, data, timeout)
+            return_data = await self._requester.read_data(response)
+            return response.status == 200, return_data
+        except aiohttp.ClientConnectionError:
             return False, None
         except asyncio.exceptions.TimeoutError:
             logger.error("TimeoutError")
@@ -122,24 +422,16 @@ class HTTPCommunicator:
         logger.debug("Sending request_vote to {}:{}".format(host, port))
         try:
             endpoint = "/raft/request_vote"
-            response = await self._requester.post(host,
-                                                  port,
-                                                  endpoint,
-                                                  data,
-                                                  timeout)
-            return_data = None
-            try:
-                return_data = await response.json()
-            finally:
-                return response.status == 200, return_data
-        except aiohttp.client_exceptions.ClientOSError:
-            # logger.error("ClientOSError")
+            response = await self._post(host, port, endpoint, data, timeout)
+            return_data = await self._requester.read_data(response)
+            return response.status == 200, return_data
+        except aiohttp.ClientConnectionError:
             return False, None
         except asyncio.exceptions.TimeoutError:
             logger.error("TimeoutError")
             return False, None
 
-    async def register_with(self, host, port, timeout=1):
+    async def register_with(self, host, port, timeout=1, learner=False):
         """
         Makes a registration message to a peer. The peer will be notified of
         where the current instance can be reached using the member's host
@@ -150,22 +442,139 @@ class HTTPCommunicator:
             port: The port of the host to register with.
             timeout: Optional; The time in seconds to wait for a response.
               (Default=1)
+            learner: Optional; Whether to register as a learner.
+              (Default=False)
 
         Returns:
-            True if the registration was successful.
+            True if the registration was successful. False if it was
+            refused, or there are connectivity issues or a timeout exceeded.
         """
         endpoint = "/raft/register"
         payload = {
             'host': self.listen_host,
             'port': self.listen_port,
-            'identifier': self.identifier
+            'identifier': self.identifier,
+            'learner': learner
         }
-        response = await self._requester.post(host,
-                                              port,
-                                              endpoint,
-                                              payload,
-                                              timeout)
-        return response.status == 200
+        try:
+            response = await self._post(host, port, endpoint, payload,
+                                        timeout)
+            return response.status == 200
+        except aiohttp.ClientConnectionError:
+            return False
+        except asyncio.exceptions.TimeoutError:
+            return False
+
+    async def timeout_now(self, host, port, data, timeout=1):
+        """
+        Tells a peer to start an election right away, to hand leadership
+        over to it.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data to pass in the message.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        logger.debug("Sending timeout_now to {}:{}".format(host, port))
+        try:
+            endpoint = "/raft/timeout_now"
+            response = await self._post(host, port, endpoint, data, timeout)
+            return_data = await self._requester.read_data(response)
+            return response.status == 200, return_data
+        except aiohttp.ClientConnectionError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            logger.error("TimeoutError")
+            return False, None
+
+    async def gossip(self, host, port, data, timeout=1):
+        """
+        Sends a gossip message, a probe carrying membership updates, to a
+        peer.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data to pass in the message.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        try:
+            response = await self._post(host, port, "/gossip", data, timeout)
+            return_data = await self._requester.read_data(response)
+            return response.status == 200, return_data
+        except aiohttp.ClientConnectionError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            return False, None
+
+    async def install_snapshot(self, host, port, data, chunk, timeout=1):
+        """
+        Sends one chunk of a snapshot to a peer. The chunk is sent as the raw
+        body of the request and the data describing it in a header, so a
+        snapshot is streamed as a sequence of small requests.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data describing the chunk.
+            chunk: The bytes of the chunk.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        logger.debug("Sending install_snapshot to {}:{}".format(host, port))
+        try:
+            endpoint = "/raft/install_snapshot"
+            response = await self._requester.post_chunk(host, port, endpoint,
+                                                        data, chunk, timeout)
+            return_data = await self._requester.read_data(response)
+            return response.status == 200, return_data
+        except aiohttp.ClientConnectionError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            logger.error("TimeoutError")
+            return False, None
+
+    async def _post(self, host, port, endpoint, data, timeout):
+        """
+        Posts a message using the codec negotiated with the peer. A peer that
+        answers 415 (Unsupported Media Type) is downgraded to JSON for this
+        and all following messages.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            endpoint: The endpoint to target.
+            data: The data to transmit.
+            timeout: The time in seconds to wait for a response.
+
+        Returns:
+            An awaited session response.
+        """
+        codec = self._peer_codecs.get((host, port), self.codec)
+        response = await self._requester.post(host, port, endpoint, data,
+                                              timeout, codec=codec)
+        if response.status == 415 and codec is not JSONCodec:
+            logger.info("{}:{} does not accept the {} codec, falling back "
+                        "to {}".format(host, port, codec.name,
+                                       JSONCodec.name))
+            self._peer_codecs[(host, port)] = JSONCodec
+            response = await self._requester.post(host, port, endpoint, data,
+                                                  timeout, codec=JSONCodec)
+        else:
+            self._peer_codecs[(host, port)] = codec
+        return response
 
     def set_on_heartbeat(self, on_heartbeat):
         """
@@ -184,15 +593,18 @@ class HTTPCommunicator:
             on_heartbeat: The function to be called.
         """
         self._responder.set_on_heartbeat(on_heartbeat)
+        if self.heartbeat_channel is not None:
+            self.heartbeat_channel.set_on_heartbeat(on_heartbeat)
 
     def set_on_register(self, on_register):
         """
         Setter for the callback to be executed on register events.
 
-        The callback should accept 3 parameters:
+        The callback should accept 4 parameters:
             - The host of the new peer
             - The port of the new peer
             - The identifier of the new peer
+            - Whether the new peer registers as a learner
 
         The callback should produce a return value in either of the formats:
             - Tuple (bool, any) where the bool indicates success. Additional
@@ -209,14 +621,99 @@ class HTTPCommunicator:
     def set_on_request_vote(self, on_request_vote):
         self._responder.set_on_request_vote(on_request_vote)
 
+    def set_on_install_snapshot(self, on_install_snapshot):
+        """
+        Setter for the callback to be executed when a chunk of a snapshot is
+        received.
+
+        The callback should accept 2 parameters:
+            - The data describing the chunk
+            - The bytes of the chunk
+
+        Args:
+            on_install_snapshot: The function to be called.
+        """
+        self._responder.set_on_install_snapshot(on_install_snapshot)
+
+    def set_on_timeout_now(self, on_timeout_now):
+        """
+        Setter for the callback to be executed when the leader asks this
+        peer to start an election.
+
+        The callback should accept 1 parameter with the leader's data.
+
+        Args:
+            on_timeout_now: The function to be called.
+        """
+        self._responder.set_on_timeout_now(on_timeout_now)
+
+    def set_on_gossip(self, on_gossip):
+        """
+        Setter for the callback to be executed on gossip messages.
+
+        The callback should accept 1 parameter with the gossip data.
+
+        Args:
+            on_gossip: The function to be called.
+        """
+        self._responder.set_on_gossip(on_gossip)
+
 
 class _HTTPRequester:
     """
     A Requester object makes HTTP calls to a Responder object by targeting a
     host and a port.
+
+    A single session is kept for the lifetime of the requester so that
+    connections to each peer are pooled and reused between requests.
     """
-    def __init__(self):
-        pass
+    def __init__(self, limit=100, limit_per_host=4, keepalive_timeout=30):
+        """
+        Creates a new HTTP requester.
+
+        Args:
+            limit: Optional; The maximum number of open connections across
+              all peers. (Default=100)
+            limit_per_host: Optional; The maximum number of open connections
+              to a single peer. (Default=4)
+            keepalive_timeout: Optional; The time in seconds an idle
+              connection is kept open before it is expired. (Default=30)
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+
+        self._session = None
+        self._session_loop = None
+
+    def get_session(self):
+        """
+        Gets the pooled session, creating it on first use. The session is
+        bound to the running event loop, so a new one is made if the previous
+        session was closed or belongs to another loop.
+
+        Returns:
+            An aiohttp client session.
+        """
+        loop = asyncio.get_running_loop()
+        if (self._session is None or self._session.closed
+                or self._session_loop is not loop):
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """
+        Closes the pooled session and any idle connections it holds.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def get(self, host, port, endpoint, timeout=1):
         """
@@ -235,13 +732,17 @@ class _HTTPRequester:
         Raises:
             asyncio.TimeoutError: The request exceeded the timeout duration.
         """
-        async with aiohttp.ClientSession() as session:
-            url = "http://{}:{}{}".format(host, port, endpoint)
-            logger.debug("Making GET request to {}".format(url))
-            async with async_timeout.timeout(timeout):
-                return await session.get(url)
+        session = self.get_session()
+        url = "http://{}:{}{}".format(host, port, endpoint)
+        logger.debug("Making GET request to {}".format(url))
+        async with async_timeout.timeout(timeout):
+            response = await session.get(url)
+            # Reading the body releases the connection back to the pool
+            await response.read()
+        return response
 
-    async def post(self, host, port, endpoint, data, timeout=1):
+    async def post(self, host, port, endpoint, data, timeout=1,
+                   codec=JSONCodec):
         """
         Makes an HTTP POST request to a specified location.
 
@@ -252,6 +753,8 @@ class _HTTPRequester:
             data: The data to transmit.
             timeout: Optional; The time in seconds to wait for a response.
               (Default=1)
+            codec: Optional; The codec used to encode the data.
+              (Default=JSONCodec)
 
         Returns:
             An awaited session response.
@@ -259,19 +762,73 @@ class _HTTPRequester:
         Raises:
             asyncio.TimeoutError: The request exceeded the timeout duration.
         """
-        response = None
-        async with aiohttp.ClientSession() as session:
-            url = "http://{}:{}{}".format(host, port, endpoint)
-            logger.debug("Making POST request to {} with data: {}".format(
-                url, data
-            ))
-            async with async_timeout.timeout(timeout):
-                # response = await session.post(url, data=data)
-                response = await session.post(url, json=data)
-            # Delay to let the session close without dumb errors
-            await asyncio.sleep(0.0001)
+        session = self.get_session()
+        url = "http://{}:{}{}".format(host, port, endpoint)
+        logger.debug("Making POST request to {} with data: {}".format(
+            url, data
+        ))
+        async with async_timeout.timeout(timeout):
+            body = codec.encode(data)
+            headers = {'Content-Type': codec.content_type}
+            response = await session.post(url, data=body, headers=headers)
+            # Reading the body releases the connection back to the pool
+            await response.read()
         return response
 
+    async def post_chunk(self, host, port, endpoint, data, chunk, timeout=1):
+        """
+        Makes an HTTP POST request carrying raw bytes, with the data
+        describing them JSON encoded in a header.
+
+        Args:
+            host: The host to direct the request to.
+            port: The port to direct the request to.
+            endpoint: The endpoint to target.
+            data: The data describing the bytes.
+            chunk: The bytes to transmit.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            An awaited session response.
+
+        Raises:
+            asyncio.TimeoutError: The request exceeded the timeout duration.
+        """
+        session = self.get_session()
+        url = "http://{}:{}{}".format(host, port, endpoint)
+        logger.debug("Making POST request to {} with {} bytes and data: {}"
+                     .format(url, len(chunk), data))
+        async with async_timeout.timeout(timeout):
+            headers = {'Content-Type': 'application/octet-stream',
+                       _CHUNK_HEADER: json.dumps(data)}
+            response = await session.post(url, data=chunk, headers=headers)
+            # Reading the body releases the connection back to the pool
+            await response.read()
+        return response
+
+    @staticmethod
+    async def read_data(response):
+        """
+        Decodes the body of a response with the codec matching its content
+        type.
+
+        Args:
+            response: A response returned by get or post.
+
+        Returns:
+            The decoded dict, or None if the body is not a decodable message.
+        """
+        codec = get_codec_by_content_type(response.content_type)
+        if codec is None:
+            return None
+        try:
+            return codec.decode(await response.read())
+        except ValueError:
+            logger.error("Unable to decode a {} response"
+                         .format(codec.name))
+            return None
+
 
 class _HTTPResponder:
     """
@@ -299,12 +856,18 @@ class _HTTPResponder:
         self.routes_post = {
             '/raft/heartbeat': self.handle_heartbeat,
             '/raft/register': self.handle_register,
-            '/raft/request_vote': self.handle_request_vote
+            '/raft/request_vote': self.handle_request_vote,
+            '/raft/install_snapshot': self.handle_install_snapshot,
+            '/raft/timeout_now': self.handle_timeout_now,
+            '/gossip': self.handle_gossip
         }
 
         self.on_heartbeat = None
         self.on_register = None
         self.on_request_vote = None
+        self.on_install_snapshot = None
+        self.on_timeout_now = None
+        self.on_gossip = None
 
         self.setup_server()
 
@@ -323,16 +886,54 @@ class _HTTPResponder:
         self.site = aiohttp.web.TCPSite(self.runner, self.host, self.port)
         await self.site.start()
 
+    async def stop_server(self):
+        """
+        Stops listening for HTTP requests.
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+        self.runner = None
+        self.site = None
+
     @staticmethod
-    def respond(callback_response):
+    def respond(callback_response, codec=JSONCodec):
         success = callback_response[0]
         data = callback_response[1]
         status_code = 200 if success else 400
         if type(data) is dict:
-            return web.json_response(data, status=status_code)
+            if codec is JSONCodec:
+                return web.json_response(data, status=status_code)
+            return web.Response(status=status_code,
+                                body=codec.encode(data),
+                                content_type=codec.content_type)
         else:
             return web.Response(status=status_code, text=str(data))
 
+    @staticmethod
+    async def read_data(request):
+        """
+        Decodes the body of a request with the codec matching its content
+        type.
+
+        Args:
+            request: The aiohttp request object.
+
+        Returns:
+            A tuple of the codec and the decoded dict.
+
+        Raises:
+            aiohttp.web.HTTPUnsupportedMediaType: No codec matches the
+              content type of the request.
+            aiohttp.web.HTTPBadRequest: The body could not be decoded.
+        """
+        codec = get_codec_by_content_type(request.content_type)
+        if codec is None:
+            raise web.HTTPUnsupportedMediaType()
+        try:
+            return codec, codec.decode(await request.read())
+        except ValueError:
+            raise web.HTTPBadRequest()
+
     # MARK: handler methods
 
     async def handle_ping(self, request):
@@ -359,10 +960,10 @@ class _HTTPResponder:
             An aiohttp response object.
          """
         if self.on_heartbeat:
-            data = await request.json()
+            codec, data = await self.read_data(request)
             res = await utils.call_callback(self.on_heartbeat,
                                             data)
-            return self.respond(res)
+            return self.respond(res, codec)
         return web.Response(status=200)
 
     async def handle_register(self, request):
@@ -377,15 +978,17 @@ class _HTTPResponder:
             An aiohttp response object.
         """
         if self.on_register:
-            data = await request.json()
+            codec, data = await self.read_data(request)
             peer_host = data.get('host', None)
             peer_port = data.get('port', None)
             peer_identifier = data.get('identifier', None)
+            peer_learner = bool(data.get('learner', False))
             res = await utils.call_callback(self.on_register,
                                             peer_host,
                                             int(peer_port),
-                                            peer_identifier)
-            return self.respond(res)
+                                            peer_identifier,
+                                            peer_learner)
+            return self.respond(res, codec)
         return web.Response(status=200)
 
     async def handle_request_vote(self, request):
@@ -400,33 +1003,91 @@ class _HTTPResponder:
             An aiohttp response object.
         """
         if self.on_request_vote:
-            data = await request.json()
+            codec, data = await self.read_data(request)
             res = await utils.call_callback(self.on_request_vote,
                                             data)
-            return self.respond(res)
+            return self.respond(res, codec)
         return web.Response(status=400)
 
-    # MARK: callback registration
-
-    def set_on_heartbeat(self, on_heartbeat):
+    async def handle_install_snapshot(self, request):
         """
-        Setter for the callback to be executed on heartbeat events.
-
-        The callback should accept 1 parameter with heartbeat data.
+        Handler for a chunk of a snapshot. The chunk is the body of the
+        request and the data describing it is in a header.
 
         Args:
-            on_heartbeat: The function to be called.
+            request: The aiohttp request object.
+
+        Returns:
+            An aiohttp response object.
         """
-        self.on_heartbeat = on_heartbeat
+        if self.on_install_snapshot:
+            try:
+                data = json.loads(request.headers.get(_CHUNK_HEADER, ''))
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if type(data) is not dict:
+                raise web.HTTPBadRequest()
+            chunk = await request.read()
+            res = await utils.call_callback(self.on_install_snapshot,
+                                            data,
+                                            chunk)
+            return self.respond(res)
+        return web.Response(status=400)
 
-    def set_on_register(self, on_register):
+    async def handle_timeout_now(self, request):
         """
-        Setter for the callback to be executed on register events.
+        Handler for the leader asking this peer to start an election.
 
-        The callback should accept 3 parameters:
+        Args:
+            request: The aiohttp request object.
+
+        Returns:
+            An aiohttp response object.
+        """
+        if self.on_timeout_now:
+            codec, data = await self.read_data(request)
+            res = await utils.call_callback(self.on_timeout_now, data)
+            return self.respond(res, codec)
+        return web.Response(status=400)
+
+    async def handle_gossip(self, request):
+        """
+        Handler for gossip messages.
+
+        Args:
+            request: The aiohttp request object.
+
+        Returns:
+            An aiohttp response object.
+        """
+        if self.on_gossip:
+            codec, data = await self.read_data(request)
+            res = await utils.call_callback(self.on_gossip, data)
+            return self.respond(res, codec)
+        return web.Response(status=400)
+
+    # MARK: callback registration
+
+    def set_on_heartbeat(self, on_heartbeat):
+        """
+        Setter for the callback to be executed on heartbeat events.
+
+        The callback should accept 1 parameter with heartbeat data.
+
+        Args:
+            on_heartbeat: The function to be called.
+        """
+        self.on_heartbeat = on_heartbeat
+
+    def set_on_register(self, on_register):
+        """
+        Setter for the callback to be executed on register events.
+
+        The callback should accept 4 parameters:
             - The host of the new peer
             - The port of the new peer
             - The identifier of the new peer
+            - Whether the new peer registers as a learner
 
         Args:
             on_register: The function to be called.
@@ -441,3 +1102,1181 @@ class _HTTPResponder:
             on_request_vote: The function to be called.
         """
         self.on_request_vote = on_request_vote
+
+    def set_on_install_snapshot(self, on_install_snapshot):
+        """
+        Setter for the callback to be executed on install_snapshot events.
+
+        Args:
+            on_install_snapshot: The function to be called.
+        """
+        self.on_install_snapshot = on_install_snapshot
+
+    def set_on_timeout_now(self, on_timeout_now):
+        """
+        Setter for the callback to be executed on timeout_now events.
+
+        Args:
+            on_timeout_now: The function to be called.
+        """
+        self.on_timeout_now = on_timeout_now
+
+    def set_on_gossip(self, on_gossip):
+        """
+        Setter for the callback to be executed on gossip messages.
+
+        Args:
+            on_gossip: The function to be called.
+        """
+        self.on_gossip = on_gossip
+
+
+# MARK: TCP transport
+
+# Every TCP frame is a uint32 length followed by this header and the
+# codec-encoded body. The length covers the header and the body.
+_FRAME_LENGTH = struct.Struct('!I')
+_FRAME_HEADER = struct.Struct('!IBBB')
+
+MSG_PING = 1
+MSG_HEARTBEAT = 2
+MSG_REQUEST_VOTE = 3
+MSG_REGISTER = 4
+MSG_INSTALL_SNAPSHOT = 5
+MSG_TIMEOUT_NOW = 6
+MSG_GOSSIP = 7
+
+STATUS_REQUEST = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+STATUS_UNSUPPORTED = 3
+
+# A message carrying raw bytes, such as a snapshot chunk, has a body made of
+# the length of the encoded data, the encoded data and then the bytes.
+_CHUNK_PREFIX = struct.Struct('!I')
+
+
+async def _read_frame(reader, max_frame_size):
+    """
+    Reads a single frame from a stream.
+
+    Args:
+        reader: The asyncio stream reader.
+        max_frame_size: The largest frame in bytes that will be accepted.
+
+    Returns:
+        A tuple of (request id, message type, status, codec id, body).
+
+    Raises:
+        asyncio.IncompleteReadError: The stream closed mid-frame.
+        ValueError: The frame is larger than allowed or too small.
+    """
+    length, = _FRAME_LENGTH.unpack(
+        await reader.readexactly(_FRAME_LENGTH.size))
+    if length < _FRAME_HEADER.size or length > max_frame_size:
+        raise ValueError("Invalid frame length: {}".format(length))
+    frame = await reader.readexactly(length)
+    request_id, msg_type, status, codec_id = _FRAME_HEADER.unpack_from(frame)
+    body = frame[_FRAME_HEADER.size:]
+    return request_id, msg_type, status, codec_id, body
+
+
+def _split_chunk(body):
+    """
+    Splits the body of a message carrying raw bytes.
+
+    Args:
+        body: The body of the frame.
+
+    Returns:
+        A tuple of (encoded data, bytes).
+
+    Raises:
+        ValueError: The body is too short.
+    """
+    if len(body) < _CHUNK_PREFIX.size:
+        raise ValueError("Invalid chunk body")
+    length, = _CHUNK_PREFIX.unpack_from(body)
+    start = _CHUNK_PREFIX.size
+    if start + length > len(body):
+        raise ValueError("Invalid chunk body")
+    return body[start:start + length], body[start + length:]
+
+
+def _build_frame(request_id, msg_type, status, codec_id, body):
+    """
+    Builds a length-prefixed frame.
+
+    Args:
+        request_id: The identifier matching a response to its request.
+        msg_type: One of the MSG_* constants.
+        status: One of the STATUS_* constants.
+        codec_id: The identifier of the codec used for the body.
+        body: The encoded body.
+
+    Returns:
+        The frame bytes.
+    """
+    header = _FRAME_HEADER.pack(request_id, msg_type, status, codec_id)
+    return b''.join((_FRAME_LENGTH.pack(len(header) + len(body)),
+                     header,
+                     body))
+
+
+class TCPCommunicator:
+    """
+    A Communicator with the same interface as the HTTPCommunicator that
+    exchanges length-prefixed frames over raw TCP streams. One persistent
+    connection is kept per peer and requests sent over it are matched to
+    their responses by a request id. Requests are handled concurrently and
+    answered out of order, so a slow vote does not hold back a heartbeat.
+    """
+
+    def __init__(self,
+                 identifier,
+                 listen_port,
+                 listen_host="localhost",
+                 codec="binary",
+                 max_frame_size=1 << 24,
+                 max_in_flight=64,
+                 udp_heartbeats=False):
+        """
+        Creates a new TCPCommunicator object.
+
+        Args:
+            identifier: The identifier of the peer implementing the SDK.
+            listen_host: The hostname that will accept inbound messages.
+            listen_port: The port that will accept inbound messages.
+            codec: Optional; The name of the preferred codec for outbound
+              messages. Peers that reject it fall back to "json".
+              (Default="binary")
+            max_frame_size: Optional; The largest frame in bytes that will
+              be accepted. (Default=16MiB)
+            max_in_flight: Optional; The maximum number of requests awaiting
+              a response per peer. Further requests wait for a free slot.
+              (Default=64)
+            udp_heartbeats: Optional; Whether to also accept and offer
+              fire-and-forget heartbeats over UDP. (Default=False)
+        """
+        self.identifier = identifier
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.codec = get_codec(codec)
+
+        # The codec agreed upon with each (host, port)
+        self._peer_codecs = {}
+
+        self._requester = _TCPRequester(max_frame_size, max_in_flight)
+        self._responder = _TCPResponder(self.listen_host,
+                                        self.listen_port,
+                                        max_frame_size,
+                                        max_in_flight)
+
+        self.heartbeat_channel = None
+        if udp_heartbeats:
+            self.heartbeat_channel = UDPHeartbeatChannel(self.listen_host,
+                                                         self.listen_port,
+                                                         codec)
+
+    async def start(self):
+        """
+        Starts listening for inbound connections.
+
+        This needs to be called before requests will be accepted.
+        """
+        await self._responder.start_server()
+        if self.heartbeat_channel is not None:
+            await self.heartbeat_channel.start()
+
+    async def close(self):
+        """
+        Closes every outbound connection and stops the listener.
+        """
+        if self.heartbeat_channel is not None:
+            self.heartbeat_channel.close()
+        await self._requester.close()
+        await self._responder.stop_server()
+
+    async def ping(self, host, port, timeout=1):
+        """
+        A small ping message will be sent to the desired peer in order to test
+        connectivity.
+
+        Args:
+            host: The host to ping.
+            port: The port to ping.
+            timeout: Optional; The maximum time in seconds to wait for a
+              response. (Default=1)
+
+        Returns:
+            True if the peer answered. False if there are connectivity issues
+            or a timeout exceeded.
+        """
+        try:
+            status, _ = await self._request(host, port, MSG_PING, {},
+                                            timeout)
+            return status
+        except OSError:
+            return False
+        except asyncio.exceptions.TimeoutError:
+            return False
+
+    async def send_heartbeat(self, host, port, data, timeout=1):
+        """
+        Sends a heartbeat message to a peer.
+
+        Args:
+            host: The host to send the heartbeat to.
+            port: The port on the host to send the heartbeat to.
+            data: The data to include in the transmitted message.
+            timeout: Optional; The maximum time in seconds to wait for a
+              response. (Default=1)
+
+        Returns:
+            True if the peer acknowledges the heartbeat. False indicates an
+            invalid response from the peer or connectivity issues.
+        """
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            logger.error("The data parameter needs to be a dict!")
+            raise ValueError
+
+        logger.debug("Sending heartbeat to {}:{}".format(host, port))
+        try:
+            return await self._request(host, port, MSG_HEARTBEAT, data,
+                                       timeout)
+        except OSError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            logger.error("TimeoutError")
+            return False, None
+
+    async def request_vote(self, host, port, data, timeout=1):
+        """
+        Sends a request vote command to the target host and port.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data to pass in the message.
+            timeout: Optional; The time in seconds to wait for a response.
+                (Default=1)
+
+        """
+        logger.debug("Sending request_vote to {}:{}".format(host, port))
+        try:
+            return await self._request(host, port, MSG_REQUEST_VOTE, data,
+                                       timeout)
+        except OSError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            logger.error("TimeoutError")
+            return False, None
+
+    async def register_with(self, host, port, timeout=1, learner=False):
+        """
+        Makes a registration message to a peer. The peer will be notified of
+        where the current instance can be reached using the member's host
+        and port. The member's identifier will also be transmitted.
+
+        Args:
+            host: The host to register with.
+            port: The port of the host to register with.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+            learner: Optional; Whether to register as a learner.
+              (Default=False)
+
+        Returns:
+            True if the registration was successful.
+        """
+        payload = {
+            'host': self.listen_host,
+            'port': self.listen_port,
+            'identifier': self.identifier,
+            'learner': learner
+        }
+        try:
+            status, _ = await self._request(host, port, MSG_REGISTER,
+                                            payload, timeout)
+            return status
+        except OSError:
+            return False
+        except asyncio.exceptions.TimeoutError:
+            return False
+
+    async def timeout_now(self, host, port, data, timeout=1):
+        """
+        Tells a peer to start an election right away, to hand leadership
+        over to it.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data to pass in the message.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        logger.debug("Sending timeout_now to {}:{}".format(host, port))
+        try:
+            return await self._request(host, port, MSG_TIMEOUT_NOW, data,
+                                       timeout)
+        except OSError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            logger.error("TimeoutError")
+            return False, None
+
+    async def gossip(self, host, port, data, timeout=1):
+        """
+        Sends a gossip message, a probe carrying membership updates, to a
+        peer.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data to pass in the message.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        try:
+            return await self._request(host, port, MSG_GOSSIP, data, timeout)
+        except OSError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            return False, None
+
+    async def install_snapshot(self, host, port, data, chunk, timeout=1):
+        """
+        Sends one chunk of a snapshot to a peer. The chunk follows the
+        encoded data in the frame, as raw bytes.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            data: The data describing the chunk.
+            chunk: The bytes of the chunk.
+            timeout: Optional; The time in seconds to wait for a response.
+              (Default=1)
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        logger.debug("Sending install_snapshot to {}:{}".format(host, port))
+        try:
+            return await self._request(host, port, MSG_INSTALL_SNAPSHOT,
+                                       data, timeout, chunk=chunk)
+        except OSError:
+            return False, None
+        except asyncio.exceptions.TimeoutError:
+            logger.error("TimeoutError")
+            return False, None
+
+    async def _request(self, host, port, msg_type, data, timeout,
+                       chunk=None):
+        """
+        Sends a message using the codec negotiated with the peer. A peer that
+        does not support the codec is downgraded to JSON for this and all
+        following messages.
+
+        Args:
+            host: The target host.
+            port: The target port.
+            msg_type: One of the MSG_* constants.
+            data: The data to transmit.
+            timeout: The time in seconds to wait for a response.
+            chunk: Optional; Raw bytes sent after the data.
+
+        Returns:
+            A tuple of the success of the request and the returned data.
+        """
+        codec = self._peer_codecs.get((host, port), self.codec)
+        status, return_data = await self._requester.request(
+            host, port, msg_type, data, timeout, codec, chunk)
+        if status == STATUS_UNSUPPORTED and codec is not JSONCodec:
+            logger.info("{}:{} does not accept the {} codec, falling back "
+                        "to {}".format(host, port, codec.name,
+                                       JSONCodec.name))
+            self._peer_codecs[(host, port)] = JSONCodec
+            status, return_data = await self._requester.request(
+                host, port, msg_type, data, timeout, JSONCodec, chunk)
+        else:
+            self._peer_codecs[(host, port)] = codec
+        return status == STATUS_OK, return_data
+
+    def set_on_heartbeat(self, on_heartbeat):
+        """
+        Setter for the callback to be executed on heartbeat events. See
+        HTTPCommunicator.set_on_heartbeat for the callback contract.
+
+        Args:
+            on_heartbeat: The function to be called.
+        """
+        self._responder.set_on_heartbeat(on_heartbeat)
+        if self.heartbeat_channel is not None:
+            self.heartbeat_channel.set_on_heartbeat(on_heartbeat)
+
+    def set_on_register(self, on_register):
+        """
+        Setter for the callback to be executed on register events. See
+        HTTPCommunicator.set_on_register for the callback contract.
+
+        Args:
+            on_register: The function to be called.
+        """
+        self._responder.set_on_register(on_register)
+
+    def set_on_request_vote(self, on_request_vote):
+        self._responder.set_on_request_vote(on_request_vote)
+
+    def set_on_install_snapshot(self, on_install_snapshot):
+        """
+        Setter for the callback to be executed when a chunk of a snapshot is
+        received. See HTTPCommunicator.set_on_install_snapshot for the
+        callback contract.
+
+        Args:
+            on_install_snapshot: The function to be called.
+        """
+        self._responder.set_on_install_snapshot(on_install_snapshot)
+
+    def set_on_timeout_now(self, on_timeout_now):
+        """
+        Setter for the callback to be executed when the leader asks this
+        peer to start an election.
+
+        Args:
+            on_timeout_now: The function to be called.
+        """
+        self._responder.set_on_timeout_now(on_timeout_now)
+
+    def set_on_gossip(self, on_gossip):
+        """
+        Setter for the callback to be executed on gossip messages. See
+        HTTPCommunicator.set_on_gossip for the callback contract.
+
+        Args:
+            on_gossip: The function to be called.
+        """
+        self._responder.set_on_gossip(on_gossip)
+
+
+class _TCPConnection:
+    """
+    A persistent connection to a single peer. Requests are tagged with an
+    id so several callers can share the connection and each receives its
+    own response, in whatever order the peer answers. The number of requests
+    in flight is bounded; further callers wait for a free slot.
+    """
+
+    def __init__(self, reader, writer, max_frame_size, max_in_flight=64):
+        """
+        Creates a connection around an open stream.
+
+        Args:
+            reader: The asyncio stream reader.
+            writer: The asyncio stream writer.
+            max_frame_size: The largest frame in bytes that will be accepted.
+            max_in_flight: Optional; The maximum number of requests awaiting
+              a response at once. (Default=64)
+        """
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_size = max_frame_size
+
+        self._next_id = 0
+        self._pending = {}
+        self._window = asyncio.Semaphore(max_in_flight)
+        self._drain_lock = asyncio.Lock()
+        self._read_task = asyncio.get_running_loop().create_task(
+            self._read_responses())
+
+    @property
+    def closed(self):
+        return self._read_task.done()
+
+    async def request(self, msg_type, codec, body):
+        """
+        Sends a request frame and waits for the matching response.
+
+        Args:
+            msg_type: One of the MSG_* constants.
+            codec: The codec the body was encoded with.
+            body: The encoded body.
+
+        Returns:
+            A tuple of (status, codec id, response body).
+
+        Raises:
+            ConnectionResetError: The connection was lost.
+        """
+        async with self._window:
+            if self.closed:
+                raise ConnectionResetError("Connection closed")
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+            request_id = self._next_id
+            future = asyncio.get_running_loop().create_future()
+            self._pending[request_id] = future
+            try:
+                self.writer.write(_build_frame(request_id, msg_type,
+                                               STATUS_REQUEST,
+                                               codec.codec_id, body))
+                async with self._drain_lock:
+                    await self.writer.drain()
+                return await future
+            finally:
+                self._pending.pop(request_id, None)
+
+    @property
+    def in_flight(self):
+        """The number of requests awaiting a response."""
+        return len(self._pending)
+
+    async def _read_responses(self):
+        """
+        Reads response frames for the lifetime of the connection and resolves
+        the request waiting on each one.
+        """
+        error = ConnectionResetError("Connection closed")
+        try:
+            while True:
+                request_id, _, status, codec_id, body = await _read_frame(
+                    self.reader, self.max_frame_size)
+                future = self._pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result((status, codec_id, body))
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            logger.debug("Connection lost: {}".format(e))
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.writer.close()
+
+    async def close(self):
+        """
+        Closes the connection, failing any request still waiting on it.
+        """
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+
+
+class _TCPRequester:
+    """
+    A Requester keeps one persistent connection per peer and sends request
+    frames over it.
+    """
+
+    def __init__(self, max_frame_size, max_in_flight=64):
+        """
+        Creates a new TCP requester.
+
+        Args:
+            max_frame_size: The largest frame in bytes that will be accepted.
+            max_in_flight: Optional; The maximum number of requests awaiting
+              a response per peer. (Default=64)
+        """
+        self.max_frame_size = max_frame_size
+        self.max_in_flight = max_in_flight
+
+        self._connections = {}
+        self._connecting = {}
+
+    async def get_connection(self, host, port):
+        """
+        Gets the open connection to a peer, connecting if there is none.
+        Concurrent callers share a single connection attempt.
+
+        Args:
+            host: The host of the peer.
+            port: The port of the peer.
+
+        Returns:
+            A _TCPConnection.
+        """
+        key = (host, port)
+        connection = self._connections.get(key)
+        if connection is not None and not connection.closed:
+            return connection
+
+        connecting = self._connecting.get(key)
+        if connecting is None:
+            connecting = asyncio.ensure_future(self._connect(host, port))
+            self._connecting[key] = connecting
+            connecting.add_done_callback(
+                lambda future: self._connect_done(key, future))
+        return await asyncio.shield(connecting)
+
+    def _connect_done(self, key, future):
+        self._connecting.pop(key, None)
+        # Retrieve the error so an abandoned attempt is not reported as
+        # an unhandled exception
+        if not future.cancelled():
+            future.exception()
+
+    async def _connect(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        connection = _TCPConnection(reader, writer, self.max_frame_size,
+                                    self.max_in_flight)
+        self._connections[(host, port)] = connection
+        return connection
+
+    async def request(self, host, port, msg_type, data, timeout, codec,
+                      chunk=None):
+        """
+        Sends a request to a peer and waits for the response.
+
+        Args:
+            host: The host to direct the request to.
+            port: The port to direct the request to.
+            msg_type: One of the MSG_* constants.
+            data: The data to transmit.
+            timeout: The time in seconds to wait for a response.
+            codec: The codec used to encode the data.
+            chunk: Optional; Raw bytes sent after the data.
+
+        Returns:
+            A tuple of the response status and the decoded data, or None if
+            the response carried no decodable data.
+
+        Raises:
+            asyncio.TimeoutError: The request exceeded the timeout duration.
+            OSError: The peer could not be reached.
+        """
+        logger.debug("Making TCP request {} to {}:{} with data: {}".format(
+            msg_type, host, port, data
+        ))
+        body = codec.encode(data)
+        if chunk is not None:
+            body = b''.join((_CHUNK_PREFIX.pack(len(body)), body, chunk))
+        async with async_timeout.timeout(timeout):
+            connection = await self.get_connection(host, port)
+            status, codec_id, response_body = await connection.request(
+                msg_type, codec, body)
+        if not response_body:
+            return status, None
+        response_codec = get_codec_by_id(codec_id)
+        try:
+            return status, response_codec.decode(response_body)
+        except (AttributeError, ValueError):
+            logger.error("Unable to decode a response with codec {}"
+                         .format(codec_id))
+            return status, None
+
+    async def close(self):
+        """
+        Closes every open connection.
+        """
+        for connecting in list(self._connecting.values()):
+            connecting.cancel()
+        for connection in list(self._connections.values()):
+            await connection.close()
+        self._connections.clear()
+
+
+class _TCPResponder:
+    """
+    A Responder accepts TCP connections on a specified port and answers the
+    request frames received on them. Each request is handled in its own task
+    and answered as soon as it completes.
+    """
+
+    def __init__(self, host, port, max_frame_size, max_in_flight=64):
+        """
+        Creates a new TCP responder.
+
+        Args:
+            host: The host to listen on.
+            port: The port to listen on.
+            max_frame_size: The largest frame in bytes that will be accepted.
+            max_in_flight: Optional; The maximum number of requests handled
+              at once per connection. Reading pauses while the limit is
+              reached. (Default=64)
+        """
+        self.host = host
+        self.port = port
+        self.max_frame_size = max_frame_size
+        self.max_in_flight = max_in_flight
+
+        self.server = None
+        self._writers = set()
+
+        self.handlers = {
+            MSG_PING: self.handle_ping,
+            MSG_HEARTBEAT: self.handle_heartbeat,
+            MSG_REGISTER: self.handle_register,
+            MSG_REQUEST_VOTE: self.handle_request_vote,
+            MSG_INSTALL_SNAPSHOT: self.handle_install_snapshot,
+            MSG_TIMEOUT_NOW: self.handle_timeout_now,
+            MSG_GOSSIP: self.handle_gossip
+        }
+
+        self.on_heartbeat = None
+        self.on_register = None
+        self.on_request_vote = None
+        self.on_install_snapshot = None
+        self.on_timeout_now = None
+        self.on_gossip = None
+
+    async def start_server(self):
+        """
+        Starts listening on the host and port for TCP connections.
+        """
+        self.server = await asyncio.start_server(self.handle_connection,
+                                                 self.host,
+                                                 self.port)
+
+    async def stop_server(self):
+        """
+        Stops listening and closes every inbound connection.
+        """
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self.server.wait_closed()
+        self.server = None
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the request frames of a single inbound connection.
+
+        Args:
+            reader: The asyncio stream reader.
+            writer: The asyncio stream writer.
+        """
+        self._writers.add(writer)
+        window = asyncio.Semaphore(self.max_in_flight)
+        drain_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                request_id, msg_type, _, codec_id, body = await _read_frame(
+                    reader, self.max_frame_size)
+                await window.acquire()
+                task = asyncio.ensure_future(self._answer(
+                    writer, drain_lock, request_id, msg_type, codec_id,
+                    body))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: window.release())
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            logger.debug("Inbound connection closed: {}".format(e))
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _answer(self, writer, drain_lock, request_id, msg_type,
+                      codec_id, body):
+        frame = await self.dispatch(request_id, msg_type, codec_id, body)
+        if writer.is_closing():
+            return
+        writer.write(frame)
+        try:
+            async with drain_lock:
+                await writer.drain()
+        except OSError as e:
+            logger.debug("Unable to answer request {}: {}"
+                         .format(request_id, e))
+
+    async def dispatch(self, request_id, msg_type, codec_id, body):
+        """
+        Decodes a request, runs its handler and builds the response frame.
+
+        Args:
+            request_id: The id to echo back in the response.
+            msg_type: One of the MSG_* constants.
+            codec_id: The identifier of the codec used for the body.
+            body: The encoded body.
+
+        Returns:
+            The response frame.
+        """
+        codec = get_codec_by_id(codec_id)
+        if codec is None:
+            return _build_frame(request_id, msg_type, STATUS_UNSUPPORTED,
+                                JSONCodec.codec_id, b'')
+        handler = self.handlers.get(msg_type)
+        args = ()
+        try:
+            if msg_type == MSG_INSTALL_SNAPSHOT:
+                body, chunk = _split_chunk(body)
+                args = (chunk,)
+            data = codec.decode(body)
+        except ValueError:
+            handler = None
+        if handler is None:
+            return _build_frame(request_id, msg_type, STATUS_ERROR,
+                                codec.codec_id, b'')
+        try:
+            success, return_data = await handler(data, *args)
+        except Exception:
+            logger.exception("Error handling message type {}"
+                             .format(msg_type))
+            success, return_data = False, None
+        status = STATUS_OK if success else STATUS_ERROR
+        response_body = b''
+        if type(return_data) is dict:
+            response_body = codec.encode(return_data)
+        return _build_frame(request_id, msg_type, status, codec.codec_id,
+                            response_body)
+
+    # MARK: handler methods
+
+    async def handle_ping(self, data):
+        return True, None
+
+    async def handle_heartbeat(self, data):
+        if self.on_heartbeat:
+            return await utils.call_callback(self.on_heartbeat, data)
+        return True, None
+
+    async def handle_register(self, data):
+        if self.on_register:
+            return await utils.call_callback(self.on_register,
+                                             data.get('host', None),
+                                             int(data.get('port', 0)),
+                                             data.get('identifier', None),
+                                             bool(data.get('learner', False)))
+        return True, None
+
+    async def handle_request_vote(self, data):
+        if self.on_request_vote:
+            return await utils.call_callback(self.on_request_vote, data)
+        return False, None
+
+    async def handle_install_snapshot(self, data, chunk):
+        if self.on_install_snapshot:
+            return await utils.call_callback(self.on_install_snapshot,
+                                             data, chunk)
+        return False, None
+
+    async def handle_timeout_now(self, data):
+        if self.on_timeout_now:
+            return await utils.call_callback(self.on_timeout_now, data)
+        return False, None
+
+    async def handle_gossip(self, data):
+        if self.on_gossip:
+            return await utils.call_callback(self.on_gossip, data)
+        return False, None
+
+    # MARK: callback registration
+
+    def set_on_heartbeat(self, on_heartbeat):
+        """
+        Setter for the callback to be executed on heartbeat events.
+
+        Args:
+            on_heartbeat: The function to be called.
+        """
+        self.on_heartbeat = on_heartbeat
+
+    def set_on_register(self, on_register):
+        """
+        Setter for the callback to be executed on register events.
+
+        Args:
+            on_register: The function to be called.
+        """
+        self.on_register = on_register
+
+    def set_on_request_vote(self, on_request_vote):
+        """
+        Setter for the callback to be executed on request_vote events.
+
+        Args:
+            on_request_vote: The function to be called.
+        """
+        self.on_request_vote = on_request_vote
+
+    def set_on_install_snapshot(self, on_install_snapshot):
+        """
+        Setter for the callback to be executed on install_snapshot events.
+
+        Args:
+            on_install_snapshot: The function to be called.
+        """
+        self.on_install_snapshot = on_install_snapshot
+
+    def set_on_timeout_now(self, on_timeout_now):
+        """
+        Setter for the callback to be executed on timeout_now events.
+
+        Args:
+            on_timeout_now: The function to be called.
+        """
+        self.on_timeout_now = on_timeout_now
+
+    def set_on_gossip(self, on_gossip):
+        """
+        Setter for the callback to be executed on gossip messages.
+
+        Args:
+            on_gossip: The function to be called.
+        """
+        self.on_gossip = on_gossip
+
+
+# MARK: UDP heartbeats
+
+# Every heartbeat datagram starts with this header followed by the
+# codec-encoded body.
+_DATAGRAM_HEADER = struct.Struct('!BBI')
+
+DATAGRAM_HEARTBEAT = 1
+DATAGRAM_ACK = 2
+DATAGRAM_ACK_REQUESTED = 0x80
+
+
+class UDPHeartbeatChannel:
+    """
+    A fire-and-forget heartbeat channel over UDP datagrams. Losing a
+    heartbeat is harmless as another one follows shortly, so no round trip
+    is made per beat. Only a sample of the heartbeats ask the receiver for
+    an acknowledgement, which carries the receiver's callback response.
+
+    The channel binds the same port number as the communicator owning it,
+    since UDP and TCP ports do not collide.
+    """
+
+    def __init__(self, listen_host, listen_port, codec="binary",
+                 ack_interval=4):
+        """
+        Creates a new UDP heartbeat channel.
+
+        Args:
+            listen_host: The hostname that will accept heartbeats.
+            listen_port: The port that will accept heartbeats.
+            codec: Optional; The name of the codec for heartbeat bodies.
+              (Default="binary")
+            ack_interval: Optional; Every n-th heartbeat to a peer asks for
+              an acknowledgement. (Default=4)
+        """
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.codec = get_codec(codec)
+        self.ack_interval = max(1, ack_interval)
+
+        self.transport = None
+        self.on_heartbeat = None
+        self.on_ack = None
+
+        self._sequences = {}
+        self._addresses = {}
+        self._peers_by_address = {}
+        self._last_ack = {}
+        # The callbacks in progress, kept until they are done
+        self._tasks = set()
+
+    async def start(self):
+        """
+        Starts listening for heartbeat datagrams.
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UDPHeartbeatProtocol(self),
+            local_addr=(self.listen_host, self.listen_port))
+
+    def close(self):
+        """
+        Stops listening for heartbeat datagrams.
+        """
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+
+    async def send_heartbeat(self, host, port, data):
+        """
+        Sends a heartbeat datagram without waiting for a response. The
+        address of a peer is only resolved on the first heartbeat.
+
+        Args:
+            host: The host to send the heartbeat to.
+            port: The port on the host to send the heartbeat to.
+            data: The data to include in the transmitted message.
+        """
+        if self.transport is None:
+            return
+        address = self._addresses.get((host, port))
+        if address is None:
+            address = await self._resolve(host, port)
+            if address is None or self.transport is None:
+                return
+        sequence = self._sequences.get((host, port), 0) + 1
+        self._sequences[(host, port)] = sequence
+        kind = DATAGRAM_HEARTBEAT
+        if sequence % self.ack_interval == 0:
+            kind |= DATAGRAM_ACK_REQUESTED
+        header = _DATAGRAM_HEADER.pack(kind, self.codec.codec_id, sequence)
+        self.transport.sendto(header + self.codec.encode(data), address)
+
+    def last_ack(self, host, port):
+        """
+        Gets the time the last acknowledgement was received from a peer.
+
+        Args:
+            host: The host of the peer.
+            port: The port of the peer.
+
+        Returns:
+            The event loop time of the last acknowledgement, or None if no
+            acknowledgement was received yet.
+        """
+        return self._last_ack.get((host, port))
+
+    async def _resolve(self, host, port):
+        sock = self.transport.get_extra_info('socket')
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, port, family=sock.family,
+                                           type=sock.type)
+        except OSError as e:
+            logger.error("Unable to resolve {}:{}: {}".format(host, port, e))
+            return None
+        address = infos[0][4]
+        self._addresses[(host, port)] = address
+        self._peers_by_address[address[:2]] = (host, port)
+        return address
+
+    def datagram_received(self, payload, address):
+        """
+        Decodes a datagram and hands it to the matching handler.
+
+        Args:
+            payload: The datagram bytes.
+            address: The address the datagram was sent from.
+        """
+        try:
+            kind, codec_id, sequence = _DATAGRAM_HEADER.unpack_from(payload)
+            codec = get_codec_by_id(codec_id)
+            data = codec.decode(payload[_DATAGRAM_HEADER.size:])
+        except (struct.error, AttributeError, ValueError):
+            logger.debug("Dropping malformed datagram from {}"
+                         .format(address))
+            return
+        if type(data) is not dict:
+            logger.debug("Dropping datagram without a dict body from {}"
+                         .format(address))
+            return
+        if kind & ~DATAGRAM_ACK_REQUESTED == DATAGRAM_HEARTBEAT:
+            ack = bool(kind & DATAGRAM_ACK_REQUESTED)
+            self._run(
+                self._handle_heartbeat(data, address, sequence, codec, ack))
+        elif kind == DATAGRAM_ACK:
+            self._handle_ack(data, address)
+
+    def _run(self, call):
+        """
+        Runs a callback in the background. A failure is logged, as there
+        is no one waiting for its result.
+        """
+        task = asyncio.ensure_future(call)
+        self._tasks.add(task)
+        task.add_done_callback(self._finish)
+
+    def _finish(self, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exception = task.exception()
+        if exception is not None:
+            logger.error("Unable to handle a heartbeat datagram: {!r}"
+                         .format(exception))
+
+    async def _handle_heartbeat(self, data, address, sequence, codec, ack):
+        if not self.on_heartbeat:
+            return
+        _, return_data = await utils.call_callback(self.on_heartbeat, data)
+        if ack and self.transport is not None:
+            if type(return_data) is not dict:
+                return_data = {}
+            header = _DATAGRAM_HEADER.pack(DATAGRAM_ACK, codec.codec_id,
+                                           sequence)
+            self.transport.sendto(header + codec.encode(return_data),
+                                  address)
+
+    def _handle_ack(self, data, address):
+        peer = self._peers_by_address.get(address[:2])
+        if peer is None:
+            return
+        self._last_ack[peer] = asyncio.get_running_loop().time()
+        if self.on_ack:
+            self._run(utils.call_callback(self.on_ack, peer[0], peer[1],
+                                          data))
+
+    def set_on_heartbeat(self, on_heartbeat):
+        """
+        Setter for the callback to be executed on heartbeat events.
+
+        Args:
+            on_heartbeat: The function to be called.
+        """
+        self.on_heartbeat = on_heartbeat
+
+    def set_on_ack(self, on_ack):
+        """
+        Setter for the callback to be executed when a heartbeat is
+        acknowledged.
+
+        The callback should accept 3 parameters:
+            - The host of the peer
+            - The port of the peer
+            - The data returned by the peer's heartbeat callback
+
+        Args:
+            on_ack: The function to be called.
+        """
+        self.on_ack = on_ack
+
+
+class _UDPHeartbeatProtocol(asyncio.DatagramProtocol):
+    """
+    Forwards received datagrams to a UDPHeartbeatChannel.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def datagram_received(self, data, addr):
+        self.channel.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        logger.debug("UDP heartbeat error: {}".format(exc))
+
+
+TRANSPORTS = {
+    'http': HTTPCommunicator,
+    'tcp': TCPCommunicator
+}
+
+
+def get_transport(name):
+    """
+    Looks up a communicator class by transport name.
+
+    Args:
+        name: The name of the transport, "http" or "tcp".
+
+    Returns:
+        The communicator class.
+
+    Raises:
+        ValueError: The transport is unknown.
+    """
+    transport = TRANSPORTS.get(name)
+    if transport is None:
+        raise ValueError("Unsupported transport: {}".format(name))
+    return transport
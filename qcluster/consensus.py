@@ -1,9 +1,14 @@
 from enum import Enum
 import asyncio
+import json
 import random
 import logging
 import time
 
+from qcluster.log import RaftLog
+from qcluster.registry import Peer
+from qcluster.snapshot import Snapshot
+
 logger = logging.getLogger(__name__)
 
 
@@ -12,6 +17,69 @@ class PeerState(Enum):
     CANDIDATE = 2
     FOLLOWER = 3
     TERMINATING = 4
+    LEARNER = 5
+
+
+class NotLeaderError(Exception):
+    """
+    Raised when an operation that only the leader can perform is made on
+    another peer, or when leadership is lost before a proposal commits.
+    """
+
+
+class ElectionTimer(object):
+    def __init__(self, get_timeout):
+        """
+        Creates a deadline on the monotonic clock of the event loop that
+        can be pushed back cheaply. Resetting it only moves the deadline;
+        the single timer scheduled on the loop notices the move when it
+        fires and schedules itself again for the new deadline.
+
+        Args:
+            get_timeout: A function returning the timeout in seconds the
+              deadline is set to on a reset.
+        """
+        self.get_timeout = get_timeout
+        self.deadline = None
+        self._waiter = None
+        self._handle = None
+
+    def reset(self):
+        """Moves the deadline to a new timeout from now."""
+        loop = asyncio.get_running_loop()
+        self.deadline = loop.time() + self.get_timeout()
+
+    def expire(self):
+        """Makes the deadline pass right away, waking up the waiter."""
+        self.deadline = 0
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def wait(self):
+        """
+        Waits for the deadline to pass. The deadline is set first if it is
+        not, and unset once it passed, so the next wait gets a new timeout.
+        """
+        loop = asyncio.get_running_loop()
+        if self.deadline is None:
+            self.reset()
+        self._waiter = loop.create_future()
+        self._handle = loop.call_at(self.deadline, self._check)
+        try:
+            await self._waiter
+            self.deadline = None
+        finally:
+            self._handle.cancel()
+            self._waiter = None
+            self._handle = None
+
+    def _check(self):
+        if self.deadline > self._handle.when():
+            # Reset since the timer was scheduled
+            loop = asyncio.get_running_loop()
+            self._handle = loop.call_at(self.deadline, self._check)
+        elif not self._waiter.done():
+            self._waiter.set_result(None)
 
 
 class RaftConsensus:
@@ -19,101 +87,1525 @@ class RaftConsensus:
                  communicator,
                  registry,
                  min_timeout=0.150,
-                 max_timeout=0.300):
+                 max_timeout=0.300,
+                 max_election_timeout=5.0,
+                 adaptive_timeouts=True,
+                 check_quorum=True,
+                 max_append_entries=100,
+                 batch_window=0.002,
+                 max_batch_entries=100,
+                 max_batch_bytes=1 << 20,
+                 max_pipeline_depth=4,
+                 max_probe_interval=1.0,
+                 storage=None,
+                 snapshot_store=None,
+                 snapshot_threshold=10000,
+                 snapshot_interval=None,
+                 snapshot_chunk_size=1 << 18,
+                 lazy_recovery=False,
+                 pre_vote=True,
+                 learner=False):
         """
         Creates a RAFT algorithm module to handle leader election
         and consensus.
+
+        Args:
+            communicator: The communicator used to reach the peers.
+            registry: The registry of peers.
+            min_timeout: Optional; The lower bound of the election timeout
+              in seconds. With adaptive timeouts this is the floor the
+              lower bound never goes below. (Default=0.150)
+            max_timeout: Optional; The upper bound of the election timeout
+              in seconds. With adaptive timeouts it keeps its ratio to the
+              lower bound. (Default=0.300)
+            max_election_timeout: Optional; The ceiling the lower bound of
+              the election timeout never goes above. (Default=5.0)
+            adaptive_timeouts: Optional; Whether the election timeout and the
+              heartbeat interval follow the round trip time measured to the
+              peers. The leader shares its timeout with its followers.
+              (Default=True)
+            check_quorum: Optional; Whether the leader steps down when a
+              majority of the peers did not respond to it within an election
+              timeout. (Default=True)
+            max_append_entries: Optional; The maximum number of log entries
+              sent to a peer in a single AppendEntries. (Default=100)
+            batch_window: Optional; The time in seconds proposals are
+              collected before they are appended and replicated as one
+              batch. (Default=0.002)
+            max_batch_entries: Optional; A batch is flushed early once it
+              holds this many proposals. (Default=100)
+            max_batch_bytes: Optional; A batch is flushed early once its
+              proposals add up to this many bytes. (Default=1MiB)
+            max_pipeline_depth: Optional; The maximum number of
+              AppendEntries in flight to a single peer. (Default=4)
+            max_probe_interval: Optional; The longest interval in seconds
+              between two attempts to reach a peer that stopped
+              responding. The interval doubles with every attempt that
+              fails, starting from the heartbeat interval. (Default=1.0)
+            storage: Optional; A WriteAheadLog the term, the vote and the
+              log are persisted to. The persisted state is restored when
+              the peer starts. Without one all state is lost on exit.
+            snapshot_store: Optional; A SnapshotStore snapshots are written
+              to. Without one only the latest snapshot is kept, in memory.
+            snapshot_threshold: Optional; A snapshot is taken once this many
+              entries were applied since the last one. (Default=10000)
+            snapshot_interval: Optional; A snapshot is taken once this many
+              seconds passed since the last one, if entries were applied
+              since. (Default=None)
+            snapshot_chunk_size: Optional; The size in bytes of the chunks a
+              snapshot is streamed to a peer in. (Default=256KiB)
+            lazy_recovery: Optional; Whether the state machine is restored
+              in the background when the peer starts, so it answers
+              heartbeats and votes sooner. (Default=False)
+            pre_vote: Optional; Whether an election is only started, and
+              the term only incremented, once a majority of the peers said
+              they would vote for this peer. Every peer of the cluster must
+              support it. (Default=True)
+            learner: Optional; Whether this peer starts as a learner, which
+              follows the log without voting, starting elections or counting
+              towards a majority. The membership of the cluster decides once
+              this peer is part of it. (Default=False)
         """
         self.term = 0
         self.registry = registry
         self.communicator = communicator
-        self.communicator.set_on_heartbeat(self.on_heartbeat)
-        self.communicator.set_on_request_vote(self.on_request_vote)
+        self.communicator.set_on_heartbeat(self.handle_heartbeat)
+        self.communicator.set_on_request_vote(self.handle_request_vote)
+        self.communicator.set_on_install_snapshot(self.on_install_snapshot)
+        self.communicator.set_on_timeout_now(self.on_timeout_now)
+        self.heartbeat_channel = getattr(communicator, 'heartbeat_channel',
+                                         None)
+        if self.heartbeat_channel is not None:
+            self.heartbeat_channel.set_on_ack(self.on_heartbeat_ack)
 
-        self.state = PeerState.FOLLOWER
+        self.learner = learner
+        self.state = PeerState.LEARNER if learner else PeerState.FOLLOWER
         self.known_leader = None
         self.min_timeout = min_timeout
         self.max_timeout = max_timeout
+
+        # MARK: Timeouts
+        self.adaptive_timeouts = adaptive_timeouts
+        self.timeout_floor = min_timeout
+        self.timeout_spread = max_timeout / min_timeout
+        self.max_election_timeout = max(max_election_timeout, min_timeout)
+        # Smoothed round trip time and its variation, by peer identifier
+        self._srtt = {}
+        self._rttvar = {}
+        self.set_election_timeout(min_timeout)
         self.has_voted_in_term = False
+        self.voted_for = None
+        self.pre_vote = pre_vote
+        # The peer leadership is being handed over to, while we are leader
+        self.transfer_target = None
+        # Set when the leader asked us to start an election right away
+        self._transfer_election = False
+
+        # MARK: Log replication
+        self.storage = storage
+        self.log = RaftLog(storage)
+        self.commit_index = 0
+        self.last_applied = 0
+        self.max_append_entries = max_append_entries
+        self.on_apply = None
+        # Leader state, keyed by peer identifier
+        self.next_index = {}
+        self.match_index = {}
+
+        # MARK: Proposal batching
+        self.batch_window = batch_window
+        self.max_batch_entries = max_batch_entries
+        self.max_batch_bytes = max_batch_bytes
+        self.max_pipeline_depth = max_pipeline_depth
+        self._proposals = []
+        self._proposal_bytes = 0
+        self._flush_handle = None
+        self._waiters = {}
+        self._in_flight = {}
+        # The tasks replicating to each peer while we are leader, keyed by
+        # peer identifier
+        self.max_probe_interval = max_probe_interval
+        self._replicators = {}
+
+        # MARK: Check quorum
+        self.check_quorum = check_quorum
+        # When each peer last responded to us as leader
+        self._last_contact = {}
+        self._leader_since = None
+
+        # MARK: Reads
+        # When each peer last acknowledged us, by the time the heartbeat
+        # was sent
+        self._last_ack = {}
+        # Only acknowledgements of heartbeats sent after this time grant a
+        # lease, as the target of a leadership transfer is voted for
+        # regardless of our lease
+        self._lease_revoked_until = 0
+        # When a valid heartbeat from a leader was last received
+        self.last_heartbeat = None
+
+        # MARK: Snapshots
+        self.snapshot = None
+        self.snapshot_store = snapshot_store
+        self.snapshot_threshold = snapshot_threshold
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_chunk_size = snapshot_chunk_size
+        self.on_snapshot = None
+        self.on_restore = None
+        self._snapshot_task = None
+        self._last_snapshot = time.monotonic()
+        # The tasks streaming the snapshot, keyed by peer identifier
+        self._snapshot_senders = {}
+        # The snapshot being received, as (index, term, bytearray)
+        self._incoming_snapshot = None
+        self.lazy_recovery = lazy_recovery
+        self._restore_task = None
+        # Cleared while the state machine is restored in the background
+        self.state_restored = asyncio.Event()
+        self.state_restored.set()
+
+        # MARK: Membership
+        # The members set by the membership entries of the log, as
+        # (index, members) in index order. The first one is the membership
+        # as of the snapshot, or the configured one.
+        self._memberships = [(0, self.configured_membership())]
+        self._membership_lock = asyncio.Lock()
+        # Whether we are one of the members of the latest membership, and
+        # one of its voters
+        self.is_member = True
+        self.is_voter = not learner
+        self.communicator.set_on_register(self.handle_register)
 
         self.got_heartbeat = asyncio.Event()
+        # Reset by every heartbeat, a follower starts an election once it
+        # passed
+        self.election_timer = ElectionTimer(self.get_timeout)
+
+    def recover(self):
+        """
+        Restores the latest snapshot and the term, the vote and the log
+        persisted after it. Only the entries following the snapshot are
+        decoded. Called by start, so the callbacks can be set until then.
+
+        With lazy recovery the snapshot is loaded and restored in the
+        background: the term, the vote and the last index, which are all
+        heartbeats and votes need, are available right away, while entries
+        are only applied and linearizable reads only served once the state
+        machine is rebuilt.
+        """
+        t_start = time.monotonic()
+        snapshot_index, snapshot_term = 0, 0
+        if self.snapshot_store is not None:
+            snapshots = self.snapshot_store.list()
+            if snapshots:
+                snapshot_index, snapshot_term, _ = snapshots[-1]
+
+        if self.storage is not None:
+            t_phase = time.monotonic()
+            self.storage.open(skip_through=snapshot_index)
+            self.term = self.storage.term
+            self.voted_for = self.storage.voted_for
+            self.has_voted_in_term = self.voted_for is not None
+            if snapshot_index < self.storage.snapshot_index:
+                logger.error("The snapshot of index {} is missing"
+                             .format(self.storage.snapshot_index))
+                snapshot_index = self.storage.snapshot_index
+                snapshot_term = self.storage.snapshot_term
+            logger.info("Replayed {} entries of the write-ahead log after "
+                        "index {} in {:.3f}s"
+                        .format(len(self.storage.entries), snapshot_index,
+                                time.monotonic() - t_phase))
+            self.log.load(self.storage.entries, snapshot_index,
+                          snapshot_term)
+            memberships = [(snapshot_index, self.storage.membership
+                            or self.membership_at(snapshot_index))]
+            for index, _, data in self.storage.entries:
+                members = self.membership_of(data)
+                if members is not None and index > snapshot_index:
+                    memberships.append((index, members))
+            self._memberships = memberships
+            self.apply_membership(self.membership())
+        elif snapshot_index > 0:
+            self.log.load([], snapshot_index, snapshot_term)
+
+        if self.snapshot_store is not None and snapshot_index > 0 \
+                and self.snapshot_store.list():
+            if self.lazy_recovery:
+                self.state_restored.clear()
+                self._restore_task = asyncio.ensure_future(
+                    self._restore_in_background(snapshot_index,
+                                                snapshot_term))
+                self._restore_task.add_done_callback(self._ignore_result)
+            else:
+                t_phase = time.monotonic()
+                snapshot = self.snapshot_store.load(snapshot_index,
+                                                    snapshot_term)
+                logger.info("Loaded {} in {:.3f}s"
+                            .format(snapshot, time.monotonic() - t_phase))
+                self.restore_snapshot(snapshot)
+        logger.info("Recovered term {} and last index {} in {:.3f}s"
+                    .format(self.term, self.log.last_index(),
+                            time.monotonic() - t_start))
+
+    async def _restore_in_background(self, index, term):
+        t_phase = time.monotonic()
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, self.snapshot_store.load,
+                                              index, term)
+        logger.info("Loaded {} in the background in {:.3f}s"
+                    .format(snapshot, time.monotonic() - t_phase))
+        if self.state_restored.is_set():
+            # A newer snapshot was installed from the leader meanwhile
+            return
+        self.restore_snapshot(snapshot)
+        self.apply_committed()
+
+    def persist_state(self):
+        """
+        Writes the term and the vote to the storage if they changed. The
+        write is durable once sync_storage returns.
+        """
+        if self.storage is None:
+            return
+        if not self.has_voted_in_term:
+            self.voted_for = None
+        if (self.storage.term, self.storage.voted_for) \
+                != (self.term, self.voted_for):
+            self.storage.save_state(self.term, self.voted_for)
+
+    async def sync_storage(self):
+        """
+        Waits until every change made to the term, the vote and the log is
+        durable.
+        """
+        if self.storage is not None:
+            await self.storage.sync()
+
+    async def save_snapshot(self, snapshot):
+        """
+        Durably writes a snapshot to the snapshot store, if there is one.
+
+        Args:
+            snapshot: The Snapshot to write.
+        """
+        if self.snapshot_store is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.snapshot_store.save,
+                                       snapshot)
+
+    def durable_index(self):
+        """The index of the last entry of the log known to be durable."""
+        if self.storage is None:
+            return self.log.last_index()
+        return min(self.storage.durable_index, self.log.last_index())
 
     def get_timeout(self):
         """Generates a timeout interval between our min and max."""
         return random.uniform(self.min_timeout, self.max_timeout)
 
+    def set_election_timeout(self, timeout):
+        """
+        Sets the lower bound of the election timeout, within the floor and
+        the ceiling, and derives the other timeouts from it: three
+        heartbeats are sent per election timeout and a heartbeat is given
+        up on after two intervals.
+
+        Args:
+            timeout: The lower bound of the election timeout in seconds.
+        """
+        timeout = min(max(timeout, self.timeout_floor),
+                      self.max_election_timeout)
+        self.min_timeout = timeout
+        self.max_timeout = timeout * self.timeout_spread
+        self.heartbeat_interval = timeout / 3
+        self.response_timeout = self.heartbeat_interval * 2
+
+    def record_rtt(self, identifier, rtt):
+        """
+        Updates the smoothed round trip time to a peer and its variation,
+        as TCP does (RFC 6298), then adapts the election timeout so it
+        covers the slowest peer ten times over.
+
+        Args:
+            identifier: The identifier of the peer.
+            rtt: The measured round trip time in seconds.
+        """
+        srtt = self._srtt.get(identifier)
+        if srtt is None:
+            self._srtt[identifier] = rtt
+            self._rttvar[identifier] = rtt / 2
+        else:
+            self._rttvar[identifier] = (0.75 * self._rttvar[identifier]
+                                        + 0.25 * abs(srtt - rtt))
+            self._srtt[identifier] = 0.875 * srtt + 0.125 * rtt
+        if self.adaptive_timeouts:
+            rto = max(self._srtt[peer] + 4 * self._rttvar[peer]
+                      for peer in self._srtt)
+            self.set_election_timeout(10 * rto)
+
     async def start(self):
+        self.recover()
         while self.state != PeerState.TERMINATING:
             await self.process_state()
 
     async def process_state(self):
         if self.state == PeerState.FOLLOWER:
-            try:
-                await asyncio.wait_for(self.got_heartbeat.wait(),
-                                       self.get_timeout())
-                self.got_heartbeat.clear()
-            except asyncio.exceptions.TimeoutError:
+            await self.election_timer.wait()
+            if not self.is_follower():
+                # The leader handed its leadership over to us
+                return
+            if not self.is_voter:
+                # We were removed from the cluster
+                return
+            self.known_leader = None
+            if await self.run_pre_vote():
                 self.state = PeerState.CANDIDATE
                 self.term += 1
-                self.known_leader = None
         elif self.state == PeerState.CANDIDATE:
             logger.debug("I am starting an election for term {}"
                          .format(self.term))
+            loop = asyncio.get_running_loop()
             timeout = self.get_timeout()
-            t_start = time.time()
+            deadline = loop.time() + timeout
             self.got_heartbeat.clear()
-            # Send a request vote to all peers
-            requests = []
-            for peer in self.registry.peers:
-                host = peer.host
-                port = peer.port
-                data = {
-                    'identifier': self.communicator.identifier,
-                    'term': self.term
-                }
-                call = self.communicator.request_vote(host, port, data)
-                requests.append(asyncio.wait_for(call, timeout=timeout))
+            # Our own vote must be durable before asking for others
             self.has_voted_in_term = True
-            results = await asyncio.gather(*requests, return_exceptions=True)
+            self.voted_for = self.communicator.identifier
+            self.persist_state()
+            await self.sync_storage()
+            transfer = self._transfer_election
+            self._transfer_election = False
+            majority = await self.request_votes(self.term, timeout,
+                                                transfer=transfer)
             if not self.got_heartbeat.is_set() and self.is_candidate():
-                # Loop through our results and tally votes
-                votes = 1
-                for ballot in results:
-                    if self.parse_ballot(ballot):
-                        votes += 1
-                outcome = (votes / (self.registry.get_peer_count() + 1))
-                majority = outcome > 0.5
-                logger.debug("I got {} of the votes on term {}"
-                             .format(outcome, self.term))
                 if majority:
-                    self.state = PeerState.LEADER
-                    self.known_leader = self.communicator.identifier
+                    self.become_leader()
                 else:
-                    duration = time.time() - t_start
-                    await asyncio.sleep(timeout - duration)
-                    self.term += 1
+                    await asyncio.sleep(max(0, deadline - loop.time()))
+                    if await self.run_pre_vote():
+                        self.term += 1
+                    elif self.is_candidate():
+                        self.state = PeerState.FOLLOWER
         elif self.state == PeerState.LEADER:
             logger.info("I am the leader for term {}".format(self.term))
-            t_start = time.time()
-            requests = []
-            for peer in self.registry.peers:
-                host = peer.host
-                port = peer.port
-                data = {
-                    'identifier': self.communicator.identifier,
-                    'term': self.term
-                }
-                call = self.communicator.send_heartbeat(host, port, data)
-                requests.append(asyncio.wait_for(call, timeout=0.100))
-            await asyncio.gather(*requests, return_exceptions=True)
-            duration = time.time() - t_start
-            await asyncio.sleep(0.050 - duration)
+            # Each peer is replicated to by its own task, so a slow peer
+            # does not delay the heartbeats to the others
+            self.start_replicators()
+            await asyncio.sleep(self.heartbeat_interval)
+            if self.check_quorum and self.is_leader() \
+                    and not self.has_quorum():
+                logger.info("A majority did not respond within the "
+                            "election timeout, stepping down")
+                self.step_down()
+        elif self.state == PeerState.LEARNER:
+            await self.election_timer.wait()
+            if self.state == PeerState.LEARNER:
+                # Learners never start an election, they only forget a
+                # leader they stopped hearing from
+                self.known_leader = None
+
+    async def request_votes(self, term, timeout, pre_vote=False,
+                            transfer=False):
+        """
+        Asks every voter for its vote in an election. The ballots are
+        counted as they arrive: the election is decided, and the remaining
+        requests cancelled, as soon as a majority voted for us or can no
+        longer do so.
+
+        Args:
+            term: The term of the election.
+            timeout: The time in seconds to wait for the ballots.
+            pre_vote: Optional; Whether the peers are only asked if they
+              would vote, without changing their term or their vote.
+              (Default=False)
+            transfer: Optional; Whether the election was asked for by the
+              leader, so peers still hearing from it vote anyway.
+              (Default=False)
+
+        Returns:
+            True if a majority of the cluster, us included, voted for us.
+        """
+        requests = []
+        for peer in self.registry.voters:
+            data = {
+                'identifier': self.communicator.identifier,
+                'term': term,
+                'last_log_index': self.log.last_index(),
+                'last_log_term': self.log.last_term()
+            }
+            if pre_vote:
+                data['pre_vote'] = True
+            if transfer:
+                data['leadership_transfer'] = True
+            call = self.communicator.request_vote(peer.host, peer.port, data)
+            request = asyncio.ensure_future(
+                asyncio.wait_for(call, timeout=timeout))
+            request.add_done_callback(self._ignore_result)
+            requests.append(request)
+
+        cluster_size = len(requests) + 1
+        majority = cluster_size // 2 + 1
+        votes = 1
+        refusals = 0
+        try:
+            for ballot in asyncio.as_completed(requests):
+                try:
+                    ballot = await ballot
+                except Exception as e:
+                    ballot = e
+                if self.parse_ballot(ballot):
+                    votes += 1
+                else:
+                    refusals += 1
+                if votes >= majority or cluster_size - refusals < majority:
+                    break
+        finally:
+            for request in requests:
+                request.cancel()
+        logger.debug("I got {} of the {}votes on term {}, {} refused"
+                     .format(votes, 'pre-' if pre_vote else '', term,
+                             refusals))
+        return votes >= majority
+
+    async def run_pre_vote(self):
+        """
+        Asks the peers whether they would vote for us in the next term,
+        before the term is incremented. A peer that cannot win, such as one
+        cut off from the cluster, thus keeps its term and does not force the
+        cluster into a new election when it comes back.
+
+        Returns:
+            True if an election can be started.
+        """
+        if not self.pre_vote:
+            return True
+        term = self.term
+        self.got_heartbeat.clear()
+        majority = await self.request_votes(term + 1, self.get_timeout(),
+                                            pre_vote=True)
+        # A leader may have made itself known in the meantime
+        return majority and self.term == term \
+            and not self.got_heartbeat.is_set()
+
+    async def transfer_leadership(self, target_identifier=None):
+        """
+        Hands leadership over to a follower, so a planned restart of the
+        leader does not leave the cluster leaderless for an election
+        timeout. The follower is brought up to date and then told to start
+        an election right away. Proposals are refused meanwhile.
+
+        Args:
+            target_identifier: Optional; The identifier of the follower to
+              hand over to. By default the most up to date one is chosen.
+
+        Returns:
+            True if the follower caught up in time and started an election.
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The target is not a known voter.
+        """
+        if not self.is_leader():
+            raise NotLeaderError("Only the leader can transfer leadership")
+        if target_identifier is None:
+            peer = max(self.registry.voters, default=None,
+                       key=lambda p: self.match_index.get(p.identifier, 0))
+        else:
+            peer = self.registry.get_peer_by_identifier(target_identifier)
+        if peer is None or peer.learner:
+            raise ValueError("Unknown voter: {}".format(target_identifier))
+
+        logger.info("Transferring leadership to {}".format(peer.identifier))
+        term = self.term
+        deadline = time.monotonic() + self.max_timeout
+        self.transfer_target = peer.identifier
+        self._lease_revoked_until = float('inf')
+        try:
+            self.flush_proposals()
+            while self.match_index.get(peer.identifier, 0) \
+                    < self.log.last_index():
+                if not self.is_leader() or self.term != term:
+                    raise NotLeaderError("Leadership was lost")
+                if time.monotonic() >= deadline:
+                    logger.info("{} did not catch up in time"
+                                .format(peer.identifier))
+                    return False
+                sender = self._snapshot_senders.get(peer.identifier)
+                if sender is not None:
+                    await asyncio.wait([sender],
+                                       timeout=deadline - time.monotonic())
+                elif not await self.replicate_to(peer, reliable=True):
+                    await asyncio.sleep(0.010)
+            data = {'identifier': self.communicator.identifier,
+                    'term': self.term}
+            status, response = await self.communicator.timeout_now(
+                peer.host, peer.port, data, timeout=self.max_timeout)
+            return status and type(response) is dict \
+                and response.get('success', False)
+        finally:
+            self.transfer_target = None
+            # The election started by the target may still be collecting
+            # votes that ignore our lease
+            self._lease_revoked_until = time.monotonic() + self.max_timeout
+
+    def become_leader(self):
+        """
+        Takes over as leader for the current term. Every peer is assumed to
+        be up to date until it says otherwise, and an empty entry is
+        appended so that entries of earlier terms can be committed.
+        """
+        self.stop_replicators()
+        self._last_ack = {}
+        self._lease_revoked_until = 0
+        self._last_contact = {}
+        self._leader_since = time.monotonic()
+        self.state = PeerState.LEADER
+        self.known_leader = self.communicator.identifier
+        self.log.append(self.term, None)
+        for peer in self.registry.peers:
+            self.next_index[peer.identifier] = self.log.last_index()
+            self.match_index[peer.identifier] = 0
+        self.advance_commit_index()
+        self.advance_when_durable()
+
+    def last_contact(self, peer):
+        """
+        Gets when a peer last responded to us as leader, or when we became
+        leader if it did not respond since.
+        """
+        return self._last_contact.get(peer.identifier,
+                                      self._leader_since or 0)
+
+    def has_quorum(self):
+        """
+        Determines if a majority of the cluster, us included, responded to
+        this leader within the election timeout.
+        """
+        since = time.monotonic() - self.max_timeout
+        contacts = 1
+        for peer in self.registry.voters:
+            if self.last_contact(peer) > since:
+                contacts += 1
+        return contacts > (self.registry.get_voter_count() + 1) / 2
+
+    def step_down(self):
+        """
+        Stops being leader without knowing of a newer one. Pending
+        proposals fail, as their outcome is unknown.
+        """
+        self.fail_waiters()
+        self.stop_replicators()
+        self.state = PeerState.FOLLOWER
+        self.known_leader = None
+
+    def start_replicators(self):
+        """
+        Starts a replicator for every peer that does not have one running.
+        """
+        for peer in self.registry.peers:
+            replicator = self._replicators.get(peer.identifier)
+            if replicator is not None and not replicator.done():
+                continue
+            replicator = asyncio.ensure_future(
+                self.run_replicator(peer, self.term))
+            replicator.add_done_callback(self._ignore_result)
+            self._replicators[peer.identifier] = replicator
+
+    def stop_replicators(self):
+        """
+        Cancels the replicators of every peer.
+        """
+        replicators = self._replicators
+        self._replicators = {}
+        for replicator in replicators.values():
+            replicator.cancel()
+
+    async def run_replicator(self, peer, term):
+        """
+        Replicates to a single peer every heartbeat interval for as long as
+        we are leader for the term. A peer that does not respond is tried
+        again after an interval that doubles with every failed attempt, up
+        to max_probe_interval.
+
+        Args:
+            peer: The Peer to replicate to.
+            term: The term we are leader for.
+        """
+        interval = self.heartbeat_interval
+        while self.is_leader() and self.term == term:
+            t_start = time.monotonic()
+            # Peers sent unacknowledged heartbeats are asked for a response
+            # before they count as lost
+            quiet = t_start - self.last_contact(peer) > self.min_timeout / 2
+            try:
+                await asyncio.wait_for(self.replicate_to(peer, reliable=quiet),
+                                       timeout=self.response_timeout)
+            except Exception as e:
+                logger.debug("Replicating to {} failed: {!r}"
+                             .format(peer.identifier, e))
+            if quiet and self._last_contact.get(peer.identifier, 0) < t_start:
+                interval = min(interval * 2, max(self.max_probe_interval,
+                                                 self.heartbeat_interval))
+            else:
+                interval = self.heartbeat_interval
+            elapsed = time.monotonic() - t_start
+            await asyncio.sleep(max(0, interval - elapsed))
+
+    def build_append_entries(self, peer):
+        """
+        Builds the AppendEntries message for a peer. The message carries the
+        entries the peer is missing, or none when it is up to date, in
+        which case it is a plain heartbeat.
+
+        Args:
+            peer: The Peer the message is for.
+
+        Returns:
+            The message data.
+        """
+        next_index = self.next_index.get(peer.identifier,
+                                         self.log.last_index() + 1)
+        prev_index = next_index - 1
+        entries = self.log.entries_from(next_index, self.max_append_entries)
+        return {
+            'identifier': self.communicator.identifier,
+            'term': self.term,
+            'prev_index': prev_index,
+            'prev_term': self.log.term_at(prev_index),
+            'entries': [entry.to_dict() for entry in entries],
+            'leader_commit': self.commit_index,
+            'election_timeout_ms': round(self.min_timeout * 1000)
+        }
+
+    async def replicate_to(self, peer, reliable=False):
+        """
+        Sends a single AppendEntries to a peer and handles its response.
+        Heartbeats to peers that are up to date go over the UDP heartbeat
+        channel when there is one; their sampled acknowledgements are
+        handled by on_heartbeat_ack.
+
+        Args:
+            peer: The Peer to replicate to.
+            reliable: Optional; Whether to wait for the response even when
+              the heartbeat could go over the UDP channel. (Default=False)
+
+        Returns:
+            True if the peer acknowledged this peer as its leader.
+        """
+        next_index = self.next_index.get(peer.identifier,
+                                         self.log.last_index() + 1)
+        if next_index <= self.log.snapshot_index:
+            # The entries the peer needs were compacted
+            self.start_sending_snapshot(peer)
+            return False
+        data = self.build_append_entries(peer)
+        if (self.heartbeat_channel is not None and not data['entries']
+                and not reliable):
+            await self.heartbeat_channel.send_heartbeat(peer.host,
+                                                        peer.port,
+                                                        data)
+            return False
+
+        identifier = peer.identifier
+        term = self.term
+        sent_at = time.monotonic()
+        if data['entries']:
+            # Pipeline: the next batch for this peer starts after this one
+            # without waiting for the acknowledgement
+            self.next_index[identifier] = (data['prev_index']
+                                           + len(data['entries']) + 1)
+        self._in_flight[identifier] = self._in_flight.get(identifier, 0) + 1
+        response = None
+        try:
+            call = self.communicator.send_heartbeat(peer.host, peer.port,
+                                                    data)
+            status, response = await call
+        finally:
+            self._in_flight[identifier] -= 1
+            if (type(response) is not dict and data['entries']
+                    and self.term == term):
+                # Lost or timed out, resend the batch
+                self.next_index[identifier] = min(
+                    self.next_index[identifier], data['prev_index'] + 1)
+        if type(response) is not dict or self.term != term:
+            return False
+        if self.registry.get_peer_by_identifier(identifier) is not peer:
+            # The peer was removed from the cluster meanwhile
+            return False
+        self.record_rtt(identifier, time.monotonic() - sent_at)
+        self.handle_append_response(peer, response)
+        if response.get('term') != term or not self.is_leader():
+            return False
+        # The lease is measured from when the heartbeat was sent
+        self._last_ack[identifier] = max(self._last_ack.get(identifier, 0),
+                                         sent_at)
+        return True
+
+    def start_sending_snapshot(self, peer):
+        """
+        Starts streaming the latest snapshot to a peer, unless it is
+        already being sent. The transfer runs in its own task so that it is
+        not bound by the heartbeat timeout.
+
+        Args:
+            peer: The Peer to send the snapshot to.
+        """
+        sender = self._snapshot_senders.get(peer.identifier)
+        if sender is not None and not sender.done():
+            return
+        sender = asyncio.ensure_future(self.send_snapshot(peer))
+        sender.add_done_callback(self._ignore_result)
+        self._snapshot_senders[peer.identifier] = sender
+
+    async def send_snapshot(self, peer):
+        """
+        Streams the latest snapshot to a peer in chunks, stopping at the
+        first chunk that is not accepted.
+
+        Args:
+            peer: The Peer to send the snapshot to.
+
+        Returns:
+            True if the peer installed the snapshot.
+        """
+        snapshot = self.snapshot
+        term = self.term
+        if snapshot is None or not self.is_leader():
+            return False
+        logger.info("Sending {} to {}".format(snapshot, peer.identifier))
+        for offset, chunk, done in snapshot.chunks(self.snapshot_chunk_size):
+            data = {
+                'identifier': self.communicator.identifier,
+                'term': term,
+                'last_index': snapshot.index,
+                'last_term': snapshot.term,
+                'membership': self.membership_at(snapshot.index),
+                'offset': offset,
+                'done': done
+            }
+            status, response = await self.communicator.install_snapshot(
+                peer.host, peer.port, data, chunk)
+            if type(response) is not dict or self.term != term:
+                return False
+            if response.get('term') == term:
+                self._last_contact[peer.identifier] = time.monotonic()
+            if response.get('term', term) > term or done:
+                self.handle_append_response(peer, response)
+            if not response.get('success', False) or not self.is_leader():
+                return False
+        return True
+
+    async def confirm_leadership(self):
+        """
+        Sends a round of heartbeats and waits for the responses to confirm
+        that a majority still follows this leader.
+
+        Returns:
+            True if a majority acknowledged this peer as leader.
+        """
+        if not self.is_leader():
+            return False
+        requests = []
+        for peer in self.registry.voters:
+            call = self.replicate_to(peer, reliable=True)
+            requests.append(asyncio.wait_for(call,
+                                             timeout=self.response_timeout))
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        acks = 1 + sum(1 for result in results if result is True)
+        return self.is_leader() and acks > (len(results) + 1) / 2
+
+    async def read_index(self):
+        """
+        Implements the ReadIndex protocol: the commit index is recorded, then
+        leadership is confirmed with one round of heartbeats. Reading the
+        state machine after this returns is linearizable.
+
+        Returns:
+            The index the state machine has applied at least up to.
+
+        Raises:
+            NotLeaderError: This peer is not the leader or could not confirm
+              its leadership.
+        """
+        if not self.is_leader():
+            raise NotLeaderError("Only the leader serves reads")
+        await self.state_restored.wait()
+        if self.log.term_at(self.commit_index) != self.term:
+            # Until an entry of its own term commits, a new leader does not
+            # know the latest commit index
+            await self.confirm_leadership()
+            if self.log.term_at(self.commit_index) != self.term:
+                raise NotLeaderError("Leadership is not established yet")
+        read_index = self.commit_index
+        if not await self.confirm_leadership():
+            raise NotLeaderError("Unable to confirm leadership")
+        return read_index
+
+    def has_lease(self):
+        """
+        Determines if this leader holds a lease: a majority acknowledged a
+        heartbeat sent less than the minimum election timeout ago, so no
+        other leader can have been elected since. The configured floor of
+        the timeout is used, as followers may not have adopted our latest
+        one yet, and a margin is kept for clock drift between the peers.
+
+        A leadership transfer revokes the lease from its start until the
+        election of the target is over, as the peers vote for the target
+        even while they honor our lease.
+
+        Returns:
+            True if reads can be served without contacting the peers.
+        """
+        if not self.is_leader():
+            return False
+        if self.log.term_at(self.commit_index) != self.term:
+            return False
+        lease_start = max(time.monotonic() - self.timeout_floor * 0.9,
+                          self._lease_revoked_until)
+        acks = 1
+        for peer in self.registry.voters:
+            if self._last_ack.get(peer.identifier, 0) > lease_start:
+                acks += 1
+        return acks > (self.registry.get_voter_count() + 1) / 2
+
+    async def lease_read(self):
+        """
+        Serves a read under the leader lease, falling back to the ReadIndex
+        protocol when the lease has expired.
+
+        Returns:
+            The index the state machine has applied at least up to.
+
+        Raises:
+            NotLeaderError: This peer is not the leader or could not confirm
+              its leadership.
+        """
+        if self.has_lease() and self.state_restored.is_set():
+            return self.commit_index
+        return await self.read_index()
+
+    def replicate_now(self):
+        """
+        Starts replicating to every peer that has room in its pipeline
+        instead of waiting for the next heartbeat.
+        """
+        for peer in self.registry.peers:
+            if self._in_flight.get(peer.identifier, 0) \
+                    < self.max_pipeline_depth:
+                call = asyncio.wait_for(self.replicate_to(peer),
+                                        timeout=self.response_timeout)
+                task = asyncio.ensure_future(call)
+                task.add_done_callback(self._ignore_result)
+
+    @staticmethod
+    def _ignore_result(task):
+        if not task.cancelled():
+            task.exception()
+
+    async def propose(self, data):
+        """
+        Proposes data to be appended to the replicated log. Proposals
+        arriving within the batch window are appended and replicated as a
+        single batch.
+
+        Args:
+            data: The JSON serializable data of the entry.
+
+        Returns:
+            The value returned by the on_apply callback once the entry is
+            committed and applied.
+
+        Raises:
+            NotLeaderError: This peer is not the leader, or it lost
+              leadership before the entry was committed.
+            ValueError: The data has a 'membership' key, which is reserved
+              for the entries changing the members of the cluster.
+        """
+        if type(data) is dict and 'membership' in data:
+            raise ValueError("The 'membership' key is reserved for "
+                             "membership changes")
+        if not self.is_leader():
+            raise NotLeaderError("Only the leader accepts proposals")
+        if self.transfer_target is not None:
+            raise NotLeaderError("Leadership is being transferred to {}"
+                                 .format(self.transfer_target))
+        future = asyncio.get_running_loop().create_future()
+        self._proposals.append((data, future))
+        self._proposal_bytes += len(json.dumps(data))
+        if (len(self._proposals) >= self.max_batch_entries
+                or self._proposal_bytes >= self.max_batch_bytes):
+            self.flush_proposals()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.batch_window,
+                                                 self.flush_proposals)
+        return await future
+
+    def flush_proposals(self):
+        """
+        Appends the collected proposals to the log and starts replicating
+        them.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        proposals = self._proposals
+        self._proposals = []
+        self._proposal_bytes = 0
+        if not proposals:
+            return
+        if not self.is_leader():
+            for _, future in proposals:
+                if not future.done():
+                    future.set_exception(NotLeaderError(
+                        "Leadership lost before the proposal was appended"))
+            return
+        for data, future in proposals:
+            index = self.log.append(self.term, data)
+            self._waiters[index] = future
+        logger.debug("Appended a batch of {} entries".format(len(proposals)))
+        self.advance_commit_index()
+        self.advance_when_durable()
+        self.replicate_now()
+
+    def advance_when_durable(self):
+        """
+        Counts the leader's own copy of the entries appended so far towards
+        the commit index once they are durable.
+        """
+        if self.storage is None:
+            return
+        task = asyncio.ensure_future(self._advance_when_durable(self.term))
+        task.add_done_callback(self._ignore_result)
+
+    async def _advance_when_durable(self, term):
+        await self.sync_storage()
+        if self.is_leader() and self.term == term:
+            self.advance_commit_index()
+
+    def fail_waiters(self):
+        """
+        Fails every proposal that is not committed yet. Called when
+        leadership is lost, as the outcome of those proposals is unknown.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        futures = [future for _, future in self._proposals]
+        futures.extend(self._waiters.values())
+        self._proposals = []
+        self._proposal_bytes = 0
+        self._waiters = {}
+        for future in futures:
+            if not future.done():
+                future.set_exception(NotLeaderError(
+                    "Leadership lost before the entry was committed"))
+
+    def handle_append_response(self, peer, data):
+        """
+        Updates the replication progress of a peer from its response to an
+        AppendEntries.
+
+        We expected the data to have:
+            - the peer's term
+            - success, whether the peer's log matched
+            - match_index, the last index known to match on success, or the
+              peer's last index as a hint on failure
+
+        Args:
+            peer: The Peer that responded.
+            data: The response data.
+        """
+        peer_term = data.get('term', -1)
+        if peer_term > self.term:
+            logger.info("{} is on a newer term {}, stepping down"
+                        .format(peer.identifier, peer_term))
+            self.fail_waiters()
+            self.term = peer_term
+            self.state = PeerState.FOLLOWER
+            self.known_leader = None
+            self.has_voted_in_term = False
+            self.persist_state()
+            return
+        if not self.is_leader() or 'success' not in data:
+            return
+
+        identifier = peer.identifier
+        if peer_term == self.term:
+            self._last_contact[identifier] = time.monotonic()
+            self.registry.record_heartbeat(identifier)
+        match_index = data.get('match_index', 0)
+        if data['success']:
+            self.match_index[identifier] = max(
+                self.match_index.get(identifier, 0), match_index)
+            self.next_index[identifier] = max(
+                self.next_index.get(identifier, 1),
+                self.match_index[identifier] + 1)
+            self.advance_commit_index()
+        else:
+            next_index = self.next_index.get(identifier,
+                                             self.log.last_index() + 1)
+            self.next_index[identifier] = max(
+                1, min(next_index - 1, match_index + 1))
+
+    def advance_commit_index(self):
+        """
+        Moves the commit index up to the highest index stored on a majority
+        of the voters, provided that entry is from the current term.
+        """
+        matches = [self.durable_index()] if self.is_voter else []
+        for peer in self.registry.voters:
+            matches.append(self.match_index.get(peer.identifier, 0))
+        if not matches:
+            return
+        matches.sort(reverse=True)
+        majority_index = matches[len(matches) // 2]
+        if (majority_index > self.commit_index
+                and self.log.term_at(majority_index) == self.term):
+            self.commit_index = majority_index
+            logger.debug("Committed up to index {}".format(majority_index))
+            self.apply_committed()
+
+    def apply_committed(self):
+        """
+        Hands the entries that were committed but not yet applied to the
+        on_apply callback, in order, and resolves the proposals waiting on
+        them. Empty entries are skipped. Nothing is applied until the state
+        machine is restored from the latest snapshot.
+
+        The callback is called synchronously with the LogEntry and its
+        return value is passed to the proposer.
+        """
+        if not self.state_restored.is_set():
+            return
+        while self.last_applied < self.commit_index:
+            self.last_applied += 1
+            entry = self.log.get(self.last_applied)
+            future = self._waiters.pop(entry.index, None)
+            members = self.membership_of(entry.data)
+            try:
+                result = None
+                if (self.on_apply is not None and entry.data is not None
+                        and members is None):
+                    result = self.on_apply(entry)
+            except Exception as e:
+                logger.exception("Unable to apply entry {}"
+                                 .format(entry.index))
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                continue
+            if future is not None and not future.done():
+                future.set_result(result)
+            if (members is not None and self.is_leader()
+                    and not self.is_voter
+                    and entry.index >= self._memberships[-1][0]):
+                logger.info("I am no longer a voter, stepping down")
+                self.step_down()
+                if self.is_member:
+                    self.state = PeerState.LEARNER
+        self.maybe_snapshot()
+
+    def maybe_snapshot(self):
+        """
+        Starts taking a snapshot if enough entries were applied, or enough
+        time passed, since the last one.
+        """
+        if self.on_snapshot is None:
+            return
+        if self._snapshot_task is not None and not self._snapshot_task.done():
+            return
+        pending = self.last_applied - self.log.snapshot_index
+        if pending <= 0:
+            return
+        due = pending >= self.snapshot_threshold
+        if self.snapshot_interval is not None:
+            elapsed = time.monotonic() - self._last_snapshot
+            due = due or elapsed >= self.snapshot_interval
+        if due:
+            self._snapshot_task = asyncio.ensure_future(self.take_snapshot())
+            self._snapshot_task.add_done_callback(self._ignore_result)
+
+    async def take_snapshot(self):
+        """
+        Takes a snapshot of the state machine at the last applied entry,
+        writes it durably and then compacts the log up to that entry.
+
+        Returns:
+            The Snapshot, or None if there was nothing new to include.
+        """
+        index = self.last_applied
+        if index <= self.log.snapshot_index or self.on_snapshot is None:
+            return None
+        # The state is captured right away, so it matches index
+        snapshot = Snapshot(index, self.log.term_at(index),
+                            self.on_snapshot())
+        self._last_snapshot = time.monotonic()
+        await self.save_snapshot(snapshot)
+        if self.snapshot is None or snapshot.index > self.snapshot.index:
+            self.snapshot = snapshot
+            self.compact_log(snapshot.index, snapshot.term)
+        logger.info("Took {}".format(snapshot))
+        return snapshot
+
+    def compact_log(self, index, term, membership=None):
+        """
+        Compacts the log up to the last entry included in a snapshot,
+        keeping the membership as of that entry.
+
+        Args:
+            index: The index of the last entry included in the snapshot.
+            term: The term of the entry at index.
+            membership: Optional; The members of the cluster as of index,
+              when the snapshot comes from the leader.
+        """
+        if membership is None:
+            membership = self.membership_at(index)
+        self.log.compact(index, term, membership)
+        last_index = self.log.last_index()
+        self._memberships = [(index, membership)] + [
+            (entry_index, members)
+            for entry_index, members in self._memberships
+            if index < entry_index <= last_index]
+        self.apply_membership(self.membership())
+
+    def restore_snapshot(self, snapshot):
+        """
+        Replaces the state machine with the state of a snapshot.
+
+        Args:
+            snapshot: The Snapshot to restore.
+        """
+        t_start = time.monotonic()
+        if self.on_restore is not None:
+            self.on_restore(snapshot.data)
+        self.snapshot = snapshot
+        self.commit_index = max(self.commit_index, snapshot.index)
+        self.last_applied = snapshot.index
+        self.state_restored.set()
+        logger.info("Restored the state machine from {} in {:.3f}s"
+                    .format(snapshot, time.monotonic() - t_start))
+
+    # MARK: Membership
+
+    def configured_membership(self):
+        """
+        Gets the members of the cluster as configured: this peer and the
+        peers of the registry.
+        """
+        member = {
+            'host': self.communicator.listen_host,
+            'port': self.communicator.listen_port,
+            'identifier': self.communicator.identifier,
+            'metadata': {}
+        }
+        if self.learner:
+            member['learner'] = True
+        members = [member]
+        members.extend(peer.to_dict() for peer in self.registry.peers)
+        return members
+
+    @staticmethod
+    def membership_of(data):
+        """
+        Gets the members set by the data of a log entry. Only
+        change_membership appends entries with a 'membership' key, as
+        proposals carrying one are refused.
+
+        Returns:
+            The list of members, or None if the entry is not a membership
+            entry.
+        """
+        if type(data) is dict and list(data) == ['membership'] \
+                and type(data['membership']) is list:
+            return data['membership']
+        return None
+
+    def membership(self):
+        """
+        Gets the members of the cluster, as set by the latest membership
+        entry of the log whether it is committed or not.
+        """
+        return self._memberships[-1][1]
+
+    def membership_at(self, index):
+        """
+        Gets the members of the cluster as of an index of the log.
+        """
+        for entry_index, members in reversed(self._memberships):
+            if entry_index <= index:
+                return members
+        return self._memberships[0][1]
+
+    def update_membership(self, prev_index, entries):
+        """
+        Updates the membership after the entries of an AppendEntries were
+        appended after prev_index. Membership entries take effect as soon
+        as they are appended, and the previous membership is restored when
+        they are replaced by conflicting entries.
+
+        Args:
+            prev_index: The index of the entry preceding the new ones.
+            entries: The list of dicts with a term and data.
+        """
+        added = []
+        for offset, entry in enumerate(entries, 1):
+            members = self.membership_of(entry.get('data'))
+            if members is not None:
+                added.append((prev_index + offset, members))
+        if not added and self._memberships[-1][0] <= prev_index:
+            return
+        match_index = prev_index + len(entries)
+        last_index = self.log.last_index()
+        memberships = [(index, members)
+                       for index, members in self._memberships
+                       if index <= prev_index
+                       or match_index < index <= last_index]
+        memberships.extend(added)
+        memberships.sort(key=lambda membership: membership[0])
+        if memberships != self._memberships:
+            self._memberships = memberships
+            self.apply_membership(self.membership())
+
+    def apply_membership(self, members):
+        """
+        Makes the registry match a membership, and this peer a learner or a
+        voter as the membership says. The leader starts replicating to the
+        peers added and forgets the peers removed.
+
+        Args:
+            members: The list of members, each a dict with the host, port,
+              identifier and metadata of a peer.
+        """
+        identifier = self.communicator.identifier
+        wanted = {member['identifier']: member for member in members}
+        self.is_member = identifier in wanted
+        learner = self.is_member and wanted[identifier].get('learner', False)
+        self.is_voter = self.is_member and not learner
+        if learner and self.state in (PeerState.FOLLOWER,
+                                      PeerState.CANDIDATE):
+            self.state = PeerState.LEARNER
+        elif self.is_voter and self.is_learner():
+            logger.info("I became a voter")
+            self.state = PeerState.FOLLOWER
+        for peer in list(self.registry.peers):
+            if peer.identifier not in wanted:
+                self.registry.remove_peer(peer.identifier)
+                self.forget_peer(peer.identifier)
+                logger.info("{} left the cluster".format(peer.identifier))
+        for member_identifier, member in wanted.items():
+            if member_identifier == identifier:
+                continue
+            if self.registry.get_peer_by_identifier(member_identifier):
+                self.registry.set_learner(member_identifier,
+                                          member.get('learner', False))
+                continue
+            if self.registry.add_peer(member) is None:
+                continue
+            logger.info("{} joined the cluster".format(member_identifier))
+            if self.is_leader():
+                self.next_index[member_identifier] = self.log.last_index() + 1
+                self.match_index[member_identifier] = 0
+        if self.is_leader():
+            self.start_replicators()
+
+    def forget_peer(self, identifier):
+        """
+        Drops the leader state of a peer removed from the cluster.
+
+        Args:
+            identifier: The identifier of the peer.
+        """
+        for state in (self.next_index, self.match_index, self._last_contact,
+                      self._last_ack, self._srtt, self._rttvar):
+            state.pop(identifier, None)
+        for tasks in (self._replicators, self._snapshot_senders):
+            task = tasks.pop(identifier, None)
+            if task is not None:
+                task.cancel()
+
+    async def add_peer(self, host, port, identifier, metadata=None,
+                       learner=False):
+        """
+        Adds a peer to the cluster. Adding a peer that is already a member
+        at the same address only turns it into a learner or a voter, so a
+        learner that caught up with the log can be promoted.
+
+        Args:
+            host: The host the peer can be reached at.
+            port: The port the peer can be reached at.
+            identifier: The unique identifier of the peer.
+            metadata: Optional; A dictionary of custom peer data.
+            learner: Optional; Whether the peer is added as a learner, which
+              follows the log without voting. (Default=False)
+
+        Raises:
+            NotLeaderError: This peer is not the leader, or it lost
+              leadership before the change was committed.
+            ValueError: The peer is invalid, or another member has the
+              identifier.
+        """
+        member = Peer(host, int(port), identifier, metadata or {}, learner)
+        if not member.is_valid():
+            raise ValueError("Invalid peer: {}".format(member.to_dict()))
+
+        def add(members):
+            for position, other in enumerate(members):
+                if other['identifier'] != identifier:
+                    continue
+                if (other['host'], other['port']) != (host, int(port)):
+                    raise ValueError("{} is already a member at {}:{}"
+                                     .format(identifier, other['host'],
+                                             other['port']))
+                if other.get('learner', False) == learner:
+                    return None
+                changed = dict(other)
+                changed.pop('learner', None)
+                if learner:
+                    changed['learner'] = True
+                return (members[:position] + [changed]
+                        + members[position + 1:])
+            return members + [member.to_dict()]
+
+        await self.change_membership(add)
+
+    async def remove_peer(self, identifier):
+        """
+        Removes a peer from the cluster. The leader can remove itself, in
+        which case it steps down once the change is committed.
+
+        Args:
+            identifier: The identifier of the peer.
+
+        Raises:
+            NotLeaderError: This peer is not the leader, or it lost
+              leadership before the change was committed.
+            ValueError: The peer is not a member, or is the last voter.
+        """
+        def remove(members):
+            remaining = [member for member in members
+                         if member['identifier'] != identifier]
+            if len(remaining) == len(members):
+                raise ValueError("{} is not a member".format(identifier))
+            if all(member.get('learner', False) for member in remaining):
+                raise ValueError("The last voter cannot be removed")
+            return remaining
+
+        await self.change_membership(remove)
+
+    async def change_membership(self, change):
+        """
+        Changes the members of the cluster. The new membership is appended
+        to the log and takes effect right away; changes are made one at a
+        time, each waiting for the previous one to commit, so that the old
+        and the new majorities always overlap.
+
+        The change carries on even if the caller is cancelled, so that the
+        next change still waits for it.
+
+        Args:
+            change: A function called with the list of members that
+              returns the new list, or None to leave it unchanged.
+
+        Raises:
+            NotLeaderError: This peer is not the leader, or it lost
+              leadership before the change was committed.
+        """
+        task = asyncio.ensure_future(self._change_membership(change))
+        task.add_done_callback(self._ignore_result)
+        await asyncio.shield(task)
+
+    async def _change_membership(self, change):
+        async with self._membership_lock:
+            if not self.is_leader():
+                raise NotLeaderError("Only the leader changes the members")
+            if self.transfer_target is not None:
+                raise NotLeaderError("Leadership is being transferred to {}"
+                                     .format(self.transfer_target))
+            if self.log.term_at(self.commit_index) != self.term:
+                # A membership entry of a previous leader may not be
+                # committed yet, which an entry of our term settles
+                await self.confirm_leadership()
+                if self.log.term_at(self.commit_index) != self.term:
+                    raise NotLeaderError("Leadership is not established yet")
+            members = change(self.membership())
+            if members is None:
+                return
+            future = asyncio.get_running_loop().create_future()
+            index = self.log.append(self.term, {'membership': members})
+            self._waiters[index] = future
+            self._memberships.append((index, members))
+            self.apply_membership(members)
+            logger.info("Changing the members of the cluster to {}"
+                        .format([member['identifier']
+                                 for member in members]))
+            self.advance_commit_index()
+            self.advance_when_durable()
+            self.replicate_now()
+            await future
+
+    async def handle_register(self, host, port, identifier, learner=False):
+        """
+        Adds a peer that asks to join the cluster, as a learner if it asks
+        to be one. Only the leader adds it; any other peer tells it which
+        peer is the leader.
+
+        Returns:
+            A tuple of whether the peer is a member, and the response data.
+        """
+        if not self.is_leader():
+            return False, {'leader': self.known_leader}
+        try:
+            await self.add_peer(host, port, identifier, learner=learner)
+        except (NotLeaderError, ValueError) as e:
+            return False, {'error': str(e)}
+        return True, {'term': self.term}
 
     def on_heartbeat(self, data):
         """
+        Handles a heartbeat, which is an AppendEntries message that may carry
+        no entries.
+
+        We expected the data to have:
+            - identifier
+            - leader's term
+            - prev_index and prev_term of the entry preceding the new ones
+            - entries, a list of dicts with a term and data
+            - leader_commit, the leader's commit index
+        """
+        if not self.accept_leader(data):
+            return False, {'term': self.term, 'success': False,
+                           'match_index': self.log.last_index()}
+
+        prev_index = data.get('prev_index', 0)
+        entries = data.get('entries', [])
+        success = self.log.append_entries(prev_index,
+                                          data.get('prev_term', 0),
+                                          entries)
+        if not success:
+            return True, {'term': self.term, 'success': False,
+                          'match_index': self.log.last_index()}
+        self.update_membership(prev_index, entries)
+        match_index = prev_index + len(entries)
+        leader_commit = data.get('leader_commit', 0)
+        if leader_commit > self.commit_index:
+            # A batch ending below what we committed must not undo it
+            self.commit_index = max(self.commit_index,
+                                    min(leader_commit, match_index))
+            self.apply_committed()
+        return True, {'term': self.term, 'success': True,
+                      'match_index': match_index}
+
+    def accept_leader(self, data):
+        """
+        Checks that a message from a leader is valid and, if so, follows
+        that leader.
+
         We expected the data to have:
             - identifier
             - leader's term
+
+        Returns:
+            True if the message is from a valid leader.
         """
         leader_identifier = data.get('identifier', None)
         leader_term = data.get('term', -1)
@@ -125,43 +1617,242 @@ class RaftConsensus:
             valid_beat = True
         elif self.state == PeerState.FOLLOWER and leader_term >= self.term:
             valid_beat = True
+        elif self.state == PeerState.LEARNER and leader_term >= self.term:
+            valid_beat = True
+
+        if not valid_beat:
+            return False
 
-        if valid_beat:
+        if leader_term > self.term:
+            self.has_voted_in_term = False
+        if self.is_leader():
+            self.fail_waiters()
+        if not self.is_learner():
             self.state = PeerState.FOLLOWER
-            self.known_leader = leader_identifier
-            self.term = leader_term
-            logger.debug("I got a heartbeat for term {} from {}"
-                         .format(self.term, leader_identifier))
-            self.got_heartbeat.set()
+        self.known_leader = leader_identifier
+        self.term = leader_term
+        self.persist_state()
+        timeout_ms = data.get('election_timeout_ms')
+        if self.adaptive_timeouts and type(timeout_ms) is int:
+            # Every peer uses the timeout the leader measured
+            self.set_election_timeout(timeout_ms / 1000)
+        logger.debug("I got a heartbeat for term {} from {}"
+                     .format(self.term, leader_identifier))
+        self.last_heartbeat = time.monotonic()
+        self.registry.record_heartbeat(leader_identifier)
+        self.got_heartbeat.set()
+        self.election_timer.reset()
+        return True
+
+    async def handle_heartbeat(self, data):
+        """
+        Handles a heartbeat like on_heartbeat, only responding once the
+        changes it made are durable.
+        """
+        response = self.on_heartbeat(data)
+        await self.sync_storage()
+        return response
+
+    async def on_install_snapshot(self, data, chunk):
+        """
+        Handles a chunk of a snapshot streamed by the leader. Once the last
+        chunk arrives the snapshot is written, the state machine restored
+        from it and the log compacted.
+
+        We expected the data to have:
+            - identifier
+            - leader's term
+            - last_index and last_term of the last entry in the snapshot
+            - membership, the members of the cluster as of last_index
+            - offset of the chunk in the snapshot
+            - done, whether this is the last chunk
+        """
+        if not self.accept_leader(data):
+            return False, {'term': self.term, 'success': False}
+        await self.sync_storage()
+
+        index = data.get('last_index', 0)
+        term = data.get('last_term', 0)
+        offset = data.get('offset', 0)
+        if offset == 0:
+            self._incoming_snapshot = (index, term, bytearray())
+        incoming = self._incoming_snapshot
+        if (incoming is None or incoming[:2] != (index, term)
+                or len(incoming[2]) != offset):
+            self._incoming_snapshot = None
+            return True, {'term': self.term, 'success': False}
+        incoming[2].extend(chunk)
+        if not data.get('done', False):
+            return True, {'term': self.term, 'success': True}
+
+        self._incoming_snapshot = None
+        if index > self.last_applied:
+            snapshot = Snapshot(index, term, bytes(incoming[2]))
+            await self.save_snapshot(snapshot)
+            if index > self.last_applied:
+                self.compact_log(index, term, data.get('membership'))
+                self.restore_snapshot(snapshot)
+                await self.sync_storage()
+        return True, {'term': self.term, 'success': True,
+                      'match_index': index}
+
+    def on_heartbeat_ack(self, host, port, data):
+        """
+        Handles an acknowledgement of a heartbeat sent over the UDP heartbeat
+        channel, which carries the peer's response to the AppendEntries.
+        """
+        peer = self.registry.get_peer_by_address(host, port)
+        if peer is not None and self.is_leader():
+            self.handle_append_response(peer, data)
+
+    def on_timeout_now(self, data):
+        """
+        Starts an election right away, because the leader is handing its
+        leadership over to us.
+
+        We expected the data to have:
+            - identifier
+            - leader's term
+        """
+        if data.get('term', -1) != self.term or not self.is_follower():
+            return True, {'term': self.term, 'success': False}
+        logger.info("{} hands its leadership over to me"
+                    .format(data.get('identifier', None)))
+        self.state = PeerState.CANDIDATE
+        self.term += 1
+        self.known_leader = None
+        self._transfer_election = True
+        # Wakes up the follower loop waiting for the election timeout
+        self.election_timer.expire()
+        return True, {'term': self.term, 'success': True}
 
     def on_request_vote(self, data):
         """
         We expected the data to have:
             - identifier
             - leader's term
+            - last_log_index and last_log_term of the candidate's log
         """
+        if not self.is_voter:
+            logger.debug("I decline to vote for {}, I am not a voter"
+                         .format(data.get('identifier', None)))
+            return True, {"vote_granted": False}
+        if data.get('pre_vote', False):
+            return self.on_pre_vote(data)
         leader_identifier = data.get('identifier', None)
         candidate_term = data.get('term', -1)
+        if (self.heard_from_leader_recently()
+                and not data.get('leadership_transfer', False)):
+            # A leader may be serving reads under its lease, so it must not
+            # be replaced before the lease runs out
+            logger.debug("I decline to vote for {}, I have a leader"
+                         .format(leader_identifier))
+            return True, {"vote_granted": False}
         if candidate_term > self.term:
+            if self.is_leader():
+                self.fail_waiters()
             self.term = candidate_term
             self.state = PeerState.FOLLOWER
-            self.has_voted_in_term = True
-            logger.debug("I just voted for {} for term {}"
-                         .format(leader_identifier, candidate_term))
-            return True, {"vote_granted": True}
+            self.has_voted_in_term = False
+            self.persist_state()
 
-        if candidate_term < self.term or self.has_voted_in_term:
+        up_to_date = self.log.is_up_to_date(data.get('last_log_index', 0),
+                                            data.get('last_log_term', 0))
+        if (candidate_term < self.term or self.has_voted_in_term
+                or not up_to_date):
             logger.debug("I decline to voted for {} for term {}"
                          .format(leader_identifier, candidate_term))
             return True, {"vote_granted": False}
         else:
             self.has_voted_in_term = True
+            self.voted_for = leader_identifier
+            self.persist_state()
             logger.debug("I just voted for {} for term {}"
                          .format(leader_identifier, candidate_term))
             return True, {"vote_granted": True}
 
+    def on_pre_vote(self, data):
+        """
+        Tells a peer whether we would vote for it in the term it wants to
+        start, without changing our term or our vote.
+
+        We expected the data to have:
+            - identifier
+            - the term the candidate wants to start
+            - last_log_index and last_log_term of the candidate's log
+        """
+        candidate_term = data.get('term', -1)
+        up_to_date = self.log.is_up_to_date(data.get('last_log_index', 0),
+                                            data.get('last_log_term', 0))
+        granted = (candidate_term >= self.term and up_to_date
+                   and not self.is_leader()
+                   and not self.heard_from_leader_recently())
+        logger.debug("I {} a pre-vote to {} for term {}"
+                     .format('grant' if granted else 'refuse',
+                             data.get('identifier', None), candidate_term))
+        return True, {"vote_granted": granted}
+
+    async def handle_request_vote(self, data):
+        """
+        Handles a vote request like on_request_vote, only responding once
+        the term and the vote are durable.
+        """
+        response = self.on_request_vote(data)
+        await self.sync_storage()
+        return response
+
+    def set_on_snapshot(self, on_snapshot):
+        """
+        Setter for the callback that serializes the state machine for a
+        snapshot.
+
+        The callback is called synchronously without parameters and must
+        return the state as bytes.
+
+        Args:
+            on_snapshot: The function to be called.
+        """
+        self.on_snapshot = on_snapshot
+
+    def set_on_restore(self, on_restore):
+        """
+        Setter for the callback that replaces the state machine with the
+        state of a snapshot.
+
+        The callback is called synchronously with the bytes returned by the
+        on_snapshot callback of the peer that took the snapshot.
+
+        Args:
+            on_restore: The function to be called.
+        """
+        self.on_restore = on_restore
+
+    def set_on_apply(self, on_apply):
+        """
+        Setter for the callback to be executed when a committed entry is
+        applied.
+
+        The callback is called synchronously, in log order, with the
+        LogEntry. Its return value is passed to the proposer of the entry.
+
+        Args:
+            on_apply: The function to be called.
+        """
+        self.on_apply = on_apply
+
     # MARK: Helper functions
 
+    def heard_from_leader_recently(self):
+        """
+        Helper to determine if a follower received a heartbeat within the
+        minimum election timeout.
+        """
+        if not self.is_follower() or self.known_leader is None:
+            return False
+        if self.last_heartbeat is None:
+            return False
+        return time.monotonic() - self.last_heartbeat < self.min_timeout
+
     @staticmethod
     def parse_ballot(ballot):
         """
@@ -210,3 +1901,7 @@ class RaftConsensus:
     def is_follower(self):
         """Helper to determine if we are a follower"""
         return self.state == PeerState.FOLLOWER
+
+    def is_learner(self):
+        """Helper to determine if we are a learner"""
+        return self.state == PeerState.LEARNER
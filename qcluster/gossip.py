@@ -0,0 +1,443 @@
+from enum import Enum
+import asyncio
+import logging
+import math
+import random
+
+logger = logging.getLogger(__name__)
+
+
+class MemberStatus(Enum):
+    ALIVE = 1
+    SUSPECT = 2
+    DEAD = 3
+
+
+class Member(object):
+    __slots__ = ('identifier', 'host', 'port', 'status', 'incarnation',
+                 'changed_at')
+
+    def __init__(self, identifier, host, port, status=MemberStatus.ALIVE,
+                 incarnation=0, changed_at=0):
+        """
+        Creates the gossip view of a member.
+
+        Args:
+            identifier: The unique identifier of the member.
+            host: The host the member can be reached at.
+            port: The port the member can be reached at.
+            status: Optional; The MemberStatus of the member.
+              (Default=MemberStatus.ALIVE)
+            incarnation: Optional; The incarnation the status was announced
+              for. Only the member itself increments it, to refute a
+              suspicion. (Default=0)
+            changed_at: Optional; The loop time the status last changed.
+              (Default=0)
+        """
+        self.identifier = identifier
+        self.host = host
+        self.port = port
+        self.status = status
+        self.incarnation = incarnation
+        self.changed_at = changed_at
+
+    def to_update(self):
+        """
+        Gets the member in the form it is piggybacked on gossip messages.
+
+        Returns:
+            A dict with the identifier, host, port, status and incarnation.
+        """
+        return {
+            'identifier': self.identifier,
+            'host': self.host,
+            'port': self.port,
+            'status': self.status.value,
+            'incarnation': self.incarnation
+        }
+
+
+class Gossip(object):
+    def __init__(self,
+                 communicator,
+                 registry,
+                 protocol_period=1.0,
+                 probe_timeout=None,
+                 indirect_probes=3,
+                 suspicion_multiplier=4,
+                 retransmit_multiplier=3,
+                 max_piggyback=8):
+        """
+        Creates a SWIM failure detector. Every protocol period this peer
+        probes a single member, in a shuffled round robin, and asks a few
+        others to probe it too when it does not answer. A member nobody
+        reached is suspected, and declared dead if it does not refute the
+        suspicion in time. Changes of status are piggybacked on the probes
+        and their acknowledgements, so each peer sends a bounded number of
+        messages per period however large the cluster is, and every peer
+        converges to the same view.
+
+        Args:
+            communicator: The communicator used to reach the members.
+            registry: The registry of the configured peers. Its peers are
+              added to the view as they are registered.
+            protocol_period: Optional; The time in seconds between two
+              probes. (Default=1.0)
+            probe_timeout: Optional; The time in seconds to wait for a
+              direct probe. Defaults to a third of the protocol period.
+            indirect_probes: Optional; The number of members asked to probe
+              a member that did not answer. (Default=3)
+            suspicion_multiplier: Optional; How many protocol periods,
+              scaled by the log of the cluster size, a suspected member has
+              to refute the suspicion. (Default=4)
+            retransmit_multiplier: Optional; How many times, scaled by the
+              log of the cluster size, each change is piggybacked.
+              (Default=3)
+            max_piggyback: Optional; The maximum number of changes
+              piggybacked on a single message. (Default=8)
+        """
+        self.communicator = communicator
+        self.registry = registry
+        self.identifier = communicator.identifier
+        self.protocol_period = protocol_period
+        if probe_timeout is None:
+            probe_timeout = protocol_period / 3
+        self.probe_timeout = probe_timeout
+        self.indirect_probes = indirect_probes
+        self.suspicion_multiplier = suspicion_multiplier
+        self.retransmit_multiplier = retransmit_multiplier
+        self.max_piggyback = max_piggyback
+
+        self.incarnation = 0
+        self.members = {}
+        self.running = False
+
+        # The identifiers left to probe in this round
+        self._probe_order = []
+        # The changes to piggyback, by identifier, with their transmissions
+        self._updates = {}
+
+    async def start(self):
+        """
+        Runs the protocol, one probe per protocol period, until stopped.
+        """
+        loop = asyncio.get_running_loop()
+        self.running = True
+        while self.running:
+            started = loop.time()
+            self.sync_registry()
+            self.expire_suspects()
+            member = self.next_member()
+            if member is not None:
+                await self.probe(member)
+            await asyncio.sleep(max(0, started + self.protocol_period
+                                    - loop.time()))
+
+    def stop(self):
+        self.running = False
+
+    def status(self, identifier):
+        """
+        Gets the status of a member in the view of this peer.
+
+        Args:
+            identifier: The identifier of the member.
+
+        Returns:
+            The MemberStatus, always ALIVE for this peer itself, or None if
+            the member is unknown.
+        """
+        if identifier == self.identifier:
+            return MemberStatus.ALIVE
+        member = self.members.get(identifier)
+        if member is None:
+            return None
+        return member.status
+
+    def alive_members(self):
+        """The members, other than this peer, currently considered alive."""
+        return [member for member in self.members.values()
+                if member.status == MemberStatus.ALIVE]
+
+    def sync_registry(self):
+        """Adds the registered peers that are not in the view yet."""
+        for peer in self.registry.peers:
+            if peer.identifier not in self.members:
+                self.add_member(peer.identifier, peer.host, peer.port)
+
+    def add_member(self, identifier, host, port,
+                   status=MemberStatus.ALIVE, incarnation=0):
+        """
+        Adds a member to the view, at a random position of the current
+        probe round so that it is probed within one round.
+
+        Returns:
+            The new Member.
+        """
+        loop = asyncio.get_running_loop()
+        member = Member(identifier, host, port, status, incarnation,
+                        loop.time())
+        self.members[identifier] = member
+        self._probe_order.insert(
+            random.randint(0, len(self._probe_order)), identifier)
+        return member
+
+    def next_member(self):
+        """
+        Picks the next member to probe. Every member that is not dead is
+        probed once per round, in an order shuffled for each round.
+
+        Returns:
+            The Member, or None if there is nothing to probe.
+        """
+        for _ in range(2):
+            while self._probe_order:
+                member = self.members.get(self._probe_order.pop())
+                if member is not None and member.status != MemberStatus.DEAD:
+                    return member
+            self._probe_order = list(self.members)
+            random.shuffle(self._probe_order)
+        return None
+
+    def suspicion_timeout(self):
+        """
+        The time in seconds a suspected member has to refute the
+        suspicion, which grows with the time a change needs to reach
+        everyone.
+        """
+        scale = max(1.0, math.log10(len(self.members) + 1))
+        return self.suspicion_multiplier * scale * self.protocol_period
+
+    def retransmit_limit(self):
+        """The number of times a change is piggybacked."""
+        scale = math.ceil(math.log10(len(self.members) + 2))
+        return self.retransmit_multiplier * scale
+
+    def expire_suspects(self):
+        """Declares dead the members whose suspicion timed out."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() - self.suspicion_timeout()
+        for member in list(self.members.values()):
+            if (member.status == MemberStatus.SUSPECT
+                    and member.changed_at <= deadline):
+                logger.info("{} did not refute the suspicion, it is dead"
+                            .format(member.identifier))
+                self.set_status(member, MemberStatus.DEAD, member.incarnation)
+
+    # MARK: Probes
+
+    async def probe(self, member):
+        """
+        Probes a member directly, then through other members if it does
+        not answer, and suspects it if nobody reached it.
+
+        Args:
+            member: The Member to probe.
+
+        Returns:
+            True if the member was reached.
+        """
+        success, data = await self.communicator.gossip(
+            member.host, member.port, self.message('ping'),
+            timeout=self.probe_timeout)
+        if success:
+            self.receive(data)
+            return True
+
+        helpers = [other for other in self.alive_members()
+                   if other is not member]
+        helpers = random.sample(helpers,
+                                min(self.indirect_probes, len(helpers)))
+        if helpers:
+            timeout = max(self.protocol_period - self.probe_timeout,
+                          self.probe_timeout)
+            results = await asyncio.gather(
+                *[self.request_probe(helper, member, timeout)
+                  for helper in helpers])
+            if any(results):
+                return True
+
+        if (self.members.get(member.identifier) is member
+                and member.status == MemberStatus.ALIVE):
+            logger.info("{} did not answer, suspecting it"
+                        .format(member.identifier))
+            self.set_status(member, MemberStatus.SUSPECT, member.incarnation)
+        return False
+
+    async def request_probe(self, helper, member, timeout):
+        """
+        Asks another member to ping a member on our behalf.
+
+        Returns:
+            True if the helper reached the member.
+        """
+        data = self.message('ping_req')
+        data['target'] = {'host': member.host, 'port': member.port}
+        success, response = await self.communicator.gossip(
+            helper.host, helper.port, data, timeout=timeout)
+        if not success:
+            return False
+        self.receive(response)
+        return bool(response.get('ack', False))
+
+    # MARK: Dissemination
+
+    def message(self, message_type):
+        """
+        Builds a gossip message with the changes to piggyback.
+
+        Args:
+            message_type: 'ping', 'ping_req' or 'ack'.
+
+        Returns:
+            The message data.
+        """
+        return {
+            'type': message_type,
+            'identifier': self.identifier,
+            'host': self.communicator.listen_host,
+            'port': self.communicator.listen_port,
+            'incarnation': self.incarnation,
+            'updates': self.piggyback()
+        }
+
+    def piggyback(self):
+        """
+        Picks the changes sent the fewest times, and forgets those sent
+        often enough to have reached everyone.
+
+        Returns:
+            A list of member updates.
+        """
+        if not self._updates:
+            return []
+        limit = self.retransmit_limit()
+        chosen = sorted(self._updates.items(),
+                        key=lambda item: item[1][1])[:self.max_piggyback]
+        updates = []
+        for identifier, (update, transmissions) in chosen:
+            updates.append(update)
+            if transmissions + 1 >= limit:
+                del self._updates[identifier]
+            else:
+                self._updates[identifier] = (update, transmissions + 1)
+        return updates
+
+    def broadcast(self, update):
+        """Queues a change to piggyback, replacing older ones about it."""
+        self._updates[update['identifier']] = (update, 0)
+
+    def set_status(self, member, status, incarnation):
+        loop = asyncio.get_running_loop()
+        member.status = status
+        member.incarnation = incarnation
+        member.changed_at = loop.time()
+        self.broadcast(member.to_update())
+
+    def refute(self, incarnation):
+        """Announces that we are alive with an incarnation above the one
+        we were suspected or declared dead in."""
+        self.incarnation = max(self.incarnation, incarnation) + 1
+        logger.info("Refuting a suspicion with incarnation {}"
+                    .format(self.incarnation))
+        self.broadcast({
+            'identifier': self.identifier,
+            'host': self.communicator.listen_host,
+            'port': self.communicator.listen_port,
+            'status': MemberStatus.ALIVE.value,
+            'incarnation': self.incarnation
+        })
+
+    def merge(self, update):
+        """
+        Applies a change to the view, unless it is older than what we
+        know: an alive member is only overridden by a suspicion of at
+        least its incarnation, a suspicion only by a newer incarnation,
+        and a dead member only by a newer incarnation that is alive.
+
+        Args:
+            update: A dict with the identifier, host, port, status and
+              incarnation of a member.
+        """
+        try:
+            identifier = update['identifier']
+            status = MemberStatus(update['status'])
+            incarnation = int(update['incarnation'])
+        except (KeyError, TypeError, ValueError):
+            logger.error("Invalid gossip update: {}".format(update))
+            return
+
+        if identifier == self.identifier:
+            if (status != MemberStatus.ALIVE
+                    and incarnation >= self.incarnation):
+                self.refute(incarnation)
+            return
+
+        member = self.members.get(identifier)
+        if member is None:
+            member = self.add_member(identifier, update.get('host'),
+                                     int(update.get('port', 0)), status,
+                                     incarnation)
+            self.broadcast(member.to_update())
+            return
+
+        if status == MemberStatus.ALIVE:
+            apply = incarnation > member.incarnation
+        elif status == MemberStatus.SUSPECT:
+            apply = (member.status != MemberStatus.DEAD
+                     and (incarnation > member.incarnation
+                          or (incarnation == member.incarnation
+                              and member.status == MemberStatus.ALIVE)))
+        else:
+            apply = (member.status != MemberStatus.DEAD
+                     and incarnation >= member.incarnation)
+        if apply:
+            if status != member.status:
+                logger.info("{} is now {}".format(identifier,
+                                                  status.name.lower()))
+            member.host = update.get('host', member.host)
+            member.port = int(update.get('port', member.port))
+            self.set_status(member, status, incarnation)
+
+    def receive(self, data):
+        """
+        Merges the sender of a gossip message, which is alive, and the
+        changes piggybacked on it.
+        """
+        if not isinstance(data, dict):
+            return
+        for update in data.get('updates', []):
+            self.merge(update)
+        if 'identifier' in data:
+            self.merge({
+                'identifier': data['identifier'],
+                'host': data.get('host'),
+                'port': data.get('port', 0),
+                'status': MemberStatus.ALIVE.value,
+                'incarnation': data.get('incarnation', 0)
+            })
+
+    async def on_gossip(self, data):
+        """
+        Answers a probe, or probes a member on behalf of the sender.
+
+        We expected the data to have:
+            - type: 'ping' or 'ping_req'
+            - identifier, host, port and incarnation of the sender
+            - updates to merge
+            - target: the host and port to ping, for a 'ping_req'
+        """
+        self.receive(data)
+        response = self.message('ack')
+        sender = self.members.get(data.get('identifier'))
+        if sender is not None and sender.status != MemberStatus.ALIVE:
+            # Lets the sender know it has to refute what we think of it
+            response['updates'].append(sender.to_update())
+        if data.get('type') == 'ping_req':
+            target = data.get('target') or {}
+            response['ack'] = False
+            if target.get('host') is not None:
+                response['ack'] = await self.communicator.ping(
+                    target['host'], target.get('port', 0),
+                    timeout=self.probe_timeout)
+        return True, response
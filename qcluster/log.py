@@ -0,0 +1,254 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LogEntry(object):
+    __slots__ = ('index', 'term', 'data')
+
+    def __init__(self, index, term, data):
+        """
+        Creates a log entry.
+
+        Args:
+            index: The position of the entry in the log, starting at 1.
+            term: The term in which the leader created the entry.
+            data: The application data carried by the entry.
+        """
+        self.index = index
+        self.term = term
+        self.data = data
+
+    def to_dict(self):
+        """
+        Gets the entry in the form it is transmitted in AppendEntries.
+
+        Returns:
+            A dict with the term and data of the entry.
+        """
+        return {'term': self.term, 'data': self.data}
+
+    def __eq__(self, other):
+        return (isinstance(other, LogEntry)
+                and self.index == other.index
+                and self.term == other.term
+                and self.data == other.data)
+
+    def __repr__(self):
+        return "LogEntry(index={}, term={}, data={!r})".format(
+            self.index, self.term, self.data)
+
+
+class RaftLog(object):
+    def __init__(self, storage=None):
+        """
+        Creates an empty replicated log. Indexes start at 1; the index 0 is a
+        sentinel with a term of 0 so that the first AppendEntries always has
+        a matching previous entry.
+
+        Once compacted, the log starts after the last entry included in a
+        snapshot, and that entry takes the role of the sentinel.
+
+        Args:
+            storage: Optional; A WriteAheadLog every change is written to.
+              Without one the log only lives in memory.
+        """
+        self.entries = []
+        self.storage = storage
+        self.snapshot_index = 0
+        self.snapshot_term = 0
+
+    def load(self, entries, snapshot_index=0, snapshot_term=0):
+        """
+        Replaces the content of the log with recovered entries, without
+        writing them to the storage again.
+
+        Args:
+            entries: A list of (index, term, data) tuples, in index order.
+            snapshot_index: Optional; The index of the last entry included in
+              the snapshot the log follows. Entries up to it are skipped.
+              (Default=0)
+            snapshot_term: Optional; The term of the entry at
+              snapshot_index. (Default=0)
+        """
+        self.snapshot_index = snapshot_index
+        self.snapshot_term = snapshot_term
+        self.entries = [LogEntry(index, term, data)
+                        for index, term, data in entries
+                        if index > snapshot_index]
+
+    def last_index(self):
+        """The index of the last entry, or 0 if the log is empty."""
+        return self.snapshot_index + len(self.entries)
+
+    def last_term(self):
+        """The term of the last entry, or 0 if the log is empty."""
+        if not self.entries:
+            return self.snapshot_term
+        return self.entries[-1].term
+
+    def get(self, index):
+        """
+        Gets the entry at an index.
+
+        Args:
+            index: The index of the entry.
+
+        Returns:
+            The LogEntry, or None if there is no entry at that index or it
+            was compacted.
+        """
+        position = index - self.snapshot_index
+        if 1 <= position <= len(self.entries):
+            return self.entries[position - 1]
+        return None
+
+    def term_at(self, index):
+        """
+        Gets the term of the entry at an index.
+
+        Args:
+            index: The index of the entry.
+
+        Returns:
+            The term of the entry, 0 for the index 0, or None if there is no
+            entry at that index or it was compacted.
+        """
+        if index == self.snapshot_index:
+            return self.snapshot_term
+        entry = self.get(index)
+        if entry is None:
+            return None
+        return entry.term
+
+    def append(self, term, data):
+        """
+        Appends a new entry to the end of the log.
+
+        Args:
+            term: The term of the entry.
+            data: The application data of the entry.
+
+        Returns:
+            The index of the new entry.
+        """
+        entry = LogEntry(self.last_index() + 1, term, data)
+        self.entries.append(entry)
+        if self.storage is not None:
+            self.storage.append(entry.index, term, data)
+        return entry.index
+
+    def entries_from(self, index, max_entries=None):
+        """
+        Gets the entries starting at an index.
+
+        Args:
+            index: The index of the first entry to return. It must not be
+              compacted.
+            max_entries: Optional; The maximum number of entries to return.
+
+        Returns:
+            A list of LogEntry objects.
+        """
+        start = max(index - self.snapshot_index, 1) - 1
+        if max_entries is None:
+            return self.entries[start:]
+        return self.entries[start:start + max_entries]
+
+    def truncate_from(self, index):
+        """
+        Removes the entry at an index and every entry after it.
+
+        Args:
+            index: The index of the first entry to remove.
+        """
+        index = max(index, self.snapshot_index + 1)
+        if index > self.last_index():
+            return
+        del self.entries[index - self.snapshot_index - 1:]
+        if self.storage is not None:
+            self.storage.truncate(index)
+
+    def compact(self, index, term, membership=None):
+        """
+        Discards the entries up to an index once they are included in a
+        snapshot. If the log does not hold the entry at index with that
+        term, the whole log is replaced by the snapshot.
+
+        Args:
+            index: The index of the last entry included in the snapshot.
+            term: The term of the entry at index.
+            membership: Optional; The members of the cluster as of index,
+              persisted along with the compaction.
+        """
+        if index <= self.snapshot_index:
+            return
+        if self.term_at(index) == term:
+            del self.entries[:index - self.snapshot_index]
+        else:
+            if self.entries and self.storage is not None:
+                # The compaction only drops the entries up to index, the
+                # conflicting ones after it must go as well
+                self.storage.truncate(self.snapshot_index + 1)
+            self.entries = []
+        self.snapshot_index = index
+        self.snapshot_term = term
+        if self.storage is not None:
+            self.storage.compact(index, term, membership)
+        logger.debug("Compacted the log up to index {}".format(index))
+
+    def append_entries(self, prev_index, prev_term, entries):
+        """
+        Applies the entries of an AppendEntries message from the leader.
+
+        The entries are only accepted if the log contains an entry at
+        prev_index with prev_term. An existing entry that conflicts with a
+        new one (same index, different term) is removed along with every
+        entry that follows it. Entries already present are left untouched.
+
+        Args:
+            prev_index: The index of the entry preceding the new ones.
+            prev_term: The term of the entry at prev_index.
+            entries: A list of dicts with a term and data.
+
+        Returns:
+            True if the log matched and now contains the entries.
+        """
+        if prev_index < self.snapshot_index:
+            # The entries up to the snapshot are committed, so they match
+            skipped = self.snapshot_index - prev_index
+            if skipped > len(entries):
+                return True
+            entries = entries[skipped:]
+            prev_index, prev_term = self.snapshot_index, self.snapshot_term
+        if self.term_at(prev_index) != prev_term:
+            return False
+        index = prev_index
+        for entry in entries:
+            index += 1
+            term = entry.get('term', 0)
+            existing_term = self.term_at(index)
+            if existing_term == term:
+                continue
+            if existing_term is not None:
+                logger.debug("Removing conflicting entries from index {}"
+                             .format(index))
+                self.truncate_from(index)
+            self.append(term, entry.get('data', None))
+        return True
+
+    def is_up_to_date(self, last_index, last_term):
+        """
+        Determines if a log ending at last_index and last_term is at least as
+        up to date as this log, which is required to grant a vote.
+
+        Args:
+            last_index: The index of the last entry of the other log.
+            last_term: The term of the last entry of the other log.
+
+        Returns:
+            True if the other log is at least as up to date.
+        """
+        if last_term != self.last_term():
+            return last_term > self.last_term()
+        return last_index >= self.last_index()
@@ -1,8 +1,14 @@
 import asyncio
+import json
 import logging
-from qcluster.communication import HTTPCommunicator
+import os
+from qcluster.communication import get_transport
 from qcluster.consensus import RaftConsensus, PeerState
+from qcluster.gossip import Gossip
 from qcluster.registry import Registry
+from qcluster.snapshot import SnapshotStore
+from qcluster.state_machine import KeyValueStateMachine
+from qcluster.wal import WriteAheadLog
 
 logger = logging.getLogger(__name__)
 
@@ -12,27 +18,333 @@ class QCluster(object):
                  identifier='',
                  listen_host='localhost',
                  listen_port=0,
-                 peers=[]):
+                 peers=[],
+                 transport='http',
+                 codec=None,
+                 udp_heartbeats=False,
+                 batch_window=0.002,
+                 max_batch_entries=100,
+                 max_batch_bytes=1 << 20,
+                 state_dir=None,
+                 wal_flush_window=0.001,
+                 wal_segment_size=64 << 20,
+                 snapshot_threshold=10000,
+                 snapshot_interval=None,
+                 lazy_recovery=False,
+                 pre_vote=True,
+                 adaptive_timeouts=True,
+                 check_quorum=True,
+                 learner=False,
+                 gossip=False,
+                 gossip_period=1.0):
         self.identifier = identifier
+        self.learner = learner
         self.listen_host = listen_host
         self.listen_port = int(listen_port)
 
         # MARK: Setup the communication module
         event_loop = asyncio.get_event_loop()
-        self.communicator = HTTPCommunicator(self.identifier,
-                                             listen_host=self.listen_host,
-                                             listen_port=self.listen_port)
+        communicator_options = {'udp_heartbeats': udp_heartbeats}
+        if codec is not None:
+            communicator_options['codec'] = codec
+        communicator_class = get_transport(transport)
+        self.communicator = communicator_class(self.identifier,
+                                               listen_host=self.listen_host,
+                                               listen_port=self.listen_port,
+                                               **communicator_options)
         self.registry = Registry(peers)
-        self.raft = RaftConsensus(self.communicator, self.registry)
+
+        # MARK: Setup the durable storage
+        self.state_dir = state_dir
+        self.wal = None
+        self.snapshot_store = None
+        if state_dir is not None:
+            self.wal = WriteAheadLog(os.path.join(state_dir, 'wal'),
+                                     segment_size=wal_segment_size,
+                                     flush_window=wal_flush_window)
+            self.snapshot_store = SnapshotStore(
+                os.path.join(state_dir, 'snapshots'))
+
+        self.raft = RaftConsensus(self.communicator,
+                                  self.registry,
+                                  batch_window=batch_window,
+                                  max_batch_entries=max_batch_entries,
+                                  max_batch_bytes=max_batch_bytes,
+                                  storage=self.wal,
+                                  snapshot_store=self.snapshot_store,
+                                  snapshot_threshold=snapshot_threshold,
+                                  snapshot_interval=snapshot_interval,
+                                  lazy_recovery=lazy_recovery,
+                                  pre_vote=pre_vote,
+                                  adaptive_timeouts=adaptive_timeouts,
+                                  check_quorum=check_quorum,
+                                  learner=learner)
+        self.state_machine = KeyValueStateMachine()
+        self.on_snapshot = None
+        self.on_restore = None
+        self.raft.set_on_apply(self.state_machine.apply)
+        self.raft.set_on_snapshot(self._snapshot)
+        self.raft.set_on_restore(self._restore)
+
+        # MARK: Setup the failure detector
+        self.gossip = None
+        if gossip:
+            self.gossip = Gossip(self.communicator, self.registry,
+                                 protocol_period=gossip_period)
+            self.communicator.set_on_gossip(self.gossip.on_gossip)
 
         event_loop.create_task(self.communicator.start())
         event_loop.create_task(self.raft.start())
+        if self.gossip is not None:
+            event_loop.create_task(self.gossip.start())
 
     def is_leader(self):
         return self.raft.state == PeerState.LEADER
 
+    def is_learner(self):
+        return self.raft.state == PeerState.LEARNER
+
     def get_leader_info(self):
         if self.raft.known_leader is not None:
             return self.registry.get_peer_by_identifier(self.raft.known_leader)
         else:
             return None
+
+    def get_member_status(self, identifier):
+        """
+        Gets whether a peer is alive, suspected or dead, as seen by the
+        gossip failure detector. Unlike the leader, every peer knows.
+
+        Args:
+            identifier: The identifier of the peer.
+
+        Returns:
+            The MemberStatus of the peer, or None if it is unknown or the
+            cluster was created without "gossip".
+        """
+        if self.gossip is None:
+            return None
+        return self.gossip.status(identifier)
+
+    async def transfer_leadership(self, target_identifier=None):
+        """
+        Hands leadership over to another peer, for instance before
+        restarting the leader. The peer is brought up to date and starts an
+        election right away, so the cluster is only leaderless for about
+        one round trip. Writes are refused while the transfer is underway.
+
+        Args:
+            target_identifier: Optional; The identifier of the peer to hand
+              over to. By default the most up to date peer is chosen.
+
+        Returns:
+            True if the peer started an election to take over.
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The target is not a known peer.
+        """
+        return await self.raft.transfer_leadership(target_identifier)
+
+    # MARK: Membership
+
+    async def add_peer(self, host, port, identifier, metadata=None,
+                       learner=False):
+        """
+        Adds a peer to the running cluster. The change is replicated like
+        a write, so every peer learns about the new one without being
+        restarted. Only the leader accepts membership changes.
+
+        Adding a peer that is already a member turns it into a learner or a
+        voter, for instance to promote a learner once it caught up.
+
+        Args:
+            host: The host the peer can be reached at.
+            port: The port the peer can be reached at.
+            identifier: The unique identifier of the peer.
+            metadata: Optional; A dictionary of custom peer data.
+            learner: Optional; Whether the peer only follows the log, to
+              serve reads, without voting or counting towards a majority.
+              (Default=False)
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The peer is invalid, or another member has the
+              identifier.
+        """
+        await self.raft.add_peer(host, port, identifier, metadata, learner)
+
+    async def remove_peer(self, identifier):
+        """
+        Removes a peer from the running cluster. A leader removing itself
+        steps down once the change is committed.
+
+        Args:
+            identifier: The identifier of the peer.
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The peer is not a member, or is the last one.
+        """
+        await self.raft.remove_peer(identifier)
+
+    async def join(self, timeout=5):
+        """
+        Asks the configured peers to add this peer to their cluster, as a
+        learner if this peer was created as one. The leader adds it, while
+        the other peers refuse.
+
+        Args:
+            timeout: Optional; The time in seconds to wait for each peer to
+              respond. (Default=5)
+
+        Returns:
+            True if this peer was added to the cluster.
+        """
+        for peer in list(self.registry.peers):
+            if await self.communicator.register_with(peer.host, peer.port,
+                                                     timeout=timeout,
+                                                     learner=self.learner):
+                return True
+        return False
+
+    # MARK: Snapshots
+
+    def set_on_snapshot(self, on_snapshot):
+        """
+        Setter for the callback that captures the application state to
+        include in a snapshot, next to the replicated key-value store.
+
+        The callback is called synchronously without parameters and must
+        return a JSON serializable value.
+
+        Args:
+            on_snapshot: The function to be called.
+        """
+        self.on_snapshot = on_snapshot
+
+    def set_on_restore(self, on_restore):
+        """
+        Setter for the callback that replaces the application state with
+        the one of a snapshot, when this peer restarts or has fallen too far
+        behind the leader.
+
+        The callback is called synchronously with the value returned by the
+        on_snapshot callback, or None if there was no such callback.
+
+        Args:
+            on_restore: The function to be called.
+        """
+        self.on_restore = on_restore
+
+    def _snapshot(self):
+        application = None
+        if self.on_snapshot is not None:
+            application = self.on_snapshot()
+        return json.dumps({
+            'store': self.state_machine.snapshot(),
+            'application': application
+        }).encode('utf-8')
+
+    def _restore(self, data):
+        state = json.loads(data)
+        self.state_machine.restore(state.get('store', {}))
+        if self.on_restore is not None:
+            self.on_restore(state.get('application'))
+
+    # MARK: Replicated key-value store
+
+    async def put(self, key, value):
+        """
+        Sets a key in the replicated store. Only the leader accepts writes.
+
+        Args:
+            key: The string key to set.
+            value: The JSON serializable value.
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The key is not a string.
+        """
+        self._check_key(key)
+        await self.raft.propose({'op': 'put', 'key': key, 'value': value})
+
+    async def get(self, key, default=None, consistency='stale'):
+        """
+        Reads a key from this peer's copy of the replicated store.
+
+        The consistency of the read can be one of:
+            - 'stale': Served locally by any peer. On a follower the value
+              may lag behind the leader.
+            - 'read_index': Linearizable. The leader confirms it is still
+              leader with one round of heartbeats before reading.
+            - 'lease': Linearizable as long as clocks drift less than 10%.
+              The leader reads without any round trip while a majority
+              acknowledged it within the election timeout.
+
+        Args:
+            key: The string key to read.
+            default: Optional; The value returned if the key is not set.
+            consistency: Optional; The consistency of the read.
+              (Default='stale')
+
+        Returns:
+            The value of the key.
+
+        Raises:
+            NotLeaderError: A linearizable read was made on a peer that is
+              not the leader.
+            ValueError: The consistency is unknown.
+        """
+        if consistency == 'read_index':
+            await self.raft.read_index()
+        elif consistency == 'lease':
+            await self.raft.lease_read()
+        elif consistency != 'stale':
+            raise ValueError("Unknown consistency: {}".format(consistency))
+        return self.state_machine.get(key, default)
+
+    async def delete(self, key):
+        """
+        Removes a key from the replicated store. Only the leader accepts
+        writes.
+
+        Args:
+            key: The string key to remove.
+
+        Returns:
+            True if the key existed.
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The key is not a string.
+        """
+        self._check_key(key)
+        return await self.raft.propose({'op': 'delete', 'key': key})
+
+    async def compare_and_set(self, key, expected, value):
+        """
+        Sets a key in the replicated store only if its current value equals
+        the expected one. Only the leader accepts writes.
+
+        Args:
+            key: The string key to set.
+            expected: The value the key must hold, None if it must be unset.
+            value: The new JSON serializable value.
+
+        Returns:
+            True if the value was set.
+
+        Raises:
+            NotLeaderError: This peer is not the leader.
+            ValueError: The key is not a string.
+        """
+        self._check_key(key)
+        return await self.raft.propose({'op': 'cas', 'key': key,
+                                        'expected': expected,
+                                        'value': value})
+
+    @staticmethod
+    def _check_key(key):
+        if type(key) is not str:
+            raise ValueError("Keys must be strings: {!r}".format(key))
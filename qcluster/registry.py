@@ -1,10 +1,15 @@
+from array import array
 import logging
+import math
+import time
 
 logger = logging.getLogger(__name__)
 
 
 class Peer(object):
-    def __init__(self, host, port, identifier, metadata):
+    __slots__ = ('host', 'port', 'identifier', 'metadata', 'learner')
+
+    def __init__(self, host, port, identifier, metadata, learner=False):
         """
         Creates a peer object with a host, port identifier, and some
         metadata.
@@ -14,11 +19,32 @@ class Peer(object):
             port: The port to connect to for internal communication
             identifier: A unique identifier for this peer
             metadata: A dictionary of custom peer data
+            learner: Optional; Whether the peer only follows the log, without
+              voting or counting towards a majority (Default=False)
         """
         self.host = host
         self.port = port
         self.identifier = identifier
         self.metadata = metadata
+        self.learner = learner
+
+    def to_dict(self):
+        """
+        Gets the peer in the form it is described in the configuration.
+
+        Returns:
+            A dict with the host, port, identifier and metadata, and whether
+            the peer is a learner if it is one.
+        """
+        data = {
+            'host': self.host,
+            'port': self.port,
+            'identifier': self.identifier,
+            'metadata': self.metadata
+        }
+        if self.learner:
+            data['learner'] = True
+        return data
 
     def is_valid(self):
         if self.host is None:
@@ -33,31 +59,257 @@ class Peer(object):
             return True
 
 
+class PhiAccrualDetector(object):
+    __slots__ = ('intervals', 'index', 'count', 'total', 'squares',
+                 'last_arrival', 'min_std_deviation')
+
+    def __init__(self, window_size=100, min_std_deviation=0.1):
+        """
+        Creates a phi accrual failure detector (Hayashibara et al.). It
+        keeps the last intervals between heartbeats in a fixed size ring
+        buffer, with their running sum and sum of squares, and expresses
+        how unlikely the current silence is under a normal distribution
+        of those intervals: a phi of 1 means a 10% chance the heartbeat is
+        merely late, a phi of 2 a 1% chance, and so on. A link with more
+        jitter needs a longer silence to reach the same phi.
+
+        Args:
+            window_size: Optional; The number of intervals kept.
+              (Default=100)
+            min_std_deviation: Optional; The floor of the standard
+              deviation in seconds, so that a very regular link does not
+              turn a slightly late heartbeat into a failure. (Default=0.1)
+        """
+        self.intervals = array('d', [0.0]) * window_size
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.last_arrival = None
+        self.min_std_deviation = min_std_deviation
+
+    def heartbeat(self, now=None):
+        """
+        Records the arrival of a heartbeat.
+
+        Args:
+            now: Optional; The arrival time on the monotonic clock.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.last_arrival is not None:
+            interval = now - self.last_arrival
+            if self.count == len(self.intervals):
+                old = self.intervals[self.index]
+                self.total -= old
+                self.squares -= old * old
+            else:
+                self.count += 1
+            self.intervals[self.index] = interval
+            self.index = (self.index + 1) % len(self.intervals)
+            self.total += interval
+            self.squares += interval * interval
+        self.last_arrival = now
+
+    def phi(self, now=None):
+        """
+        Gets the suspicion level of the peer.
+
+        Args:
+            now: Optional; The time on the monotonic clock.
+
+        Returns:
+            The phi value, 0 until two heartbeats arrived.
+        """
+        if self.count == 0:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        mean = self.total / self.count
+        variance = max(self.squares / self.count - mean * mean, 0.0)
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+        y = (now - self.last_arrival - mean) / std_deviation
+        # phi = -log10(1 - F(elapsed)), with the logistic approximation of
+        # the normal cumulative distribution F, written so that neither
+        # exponential can overflow
+        z = y * (1.5976 + 0.070566 * y * y)
+        if z > 0:
+            return (z + math.log1p(math.exp(-z))) / math.log(10)
+        return math.log1p(math.exp(z)) / math.log(10)
+
+
 class Registry(object):
-    def __init__(self, peers_data):
+    def __init__(self, peers_data, window_size=100, min_std_deviation=0.1):
+        """
+        Creates a registry of the peers described by the configuration.
+        Invalid peers and peers with a duplicate identifier are skipped.
+        The peers are indexed by identifier and by address, and the voters,
+        the peers that are not learners, are kept apart.
+
+        The registry also tracks the health of the peers this peer hears
+        from with a phi accrual failure detector each.
+
+        Args:
+            peers_data: A list of dictionaries with the host, port,
+              identifier and optional metadata and learner flag of each
+              peer.
+            window_size: Optional; The number of intervals between
+              heartbeats kept per peer. (Default=100)
+            min_std_deviation: Optional; The floor of the standard
+              deviation of those intervals, in seconds. (Default=0.1)
+        """
         self.peers = []
+        self.voters = []
+        self._by_identifier = {}
+        self._by_address = {}
+        self.window_size = window_size
+        self.min_std_deviation = min_std_deviation
+        self._detectors = {}
         for peer_data in peers_data:
-            peer_host = peer_data.get('host', None)
-            peer_port = int(peer_data.get('port', 0))
-            peer_identifier = peer_data.get('identifier', "")
-            peer_metadata = peer_data.get('metadata', {})
-            peer = Peer(peer_host, peer_port, peer_identifier, peer_metadata)
-
-            # Validate properties
-            if not peer.is_valid():
-                logger.error("Invalid peer data: {}".format(peer_data))
-                continue
-            if self.get_peer_by_identifier(peer_identifier) is not None:
-                logger.error("Duplicate identifier: {}"
-                             .format(peer_identifier))
-                continue
-            self.peers.append(peer)
+            self.add_peer(peer_data)
+
+    def add_peer(self, peer_data):
+        """
+        Adds a peer to the registry.
+
+        Args:
+            peer_data: A dictionary with the host, port, identifier and
+              optional metadata and learner flag of the peer.
+
+        Returns:
+            The new Peer, or None if the data is invalid or the identifier
+            is already registered.
+        """
+        peer_host = peer_data.get('host', None)
+        peer_port = int(peer_data.get('port', 0))
+        peer_identifier = peer_data.get('identifier', "")
+        peer_metadata = peer_data.get('metadata', {})
+        peer_learner = bool(peer_data.get('learner', False))
+        peer = Peer(peer_host, peer_port, peer_identifier, peer_metadata,
+                    peer_learner)
+
+        # Validate properties
+        if not peer.is_valid():
+            logger.error("Invalid peer data: {}".format(peer_data))
+            return None
+        if self.get_peer_by_identifier(peer_identifier) is not None:
+            logger.error("Duplicate identifier: {}"
+                         .format(peer_identifier))
+            return None
+        self.peers.append(peer)
+        if not peer.learner:
+            self.voters.append(peer)
+        self._by_identifier[peer_identifier] = peer
+        self._by_address.setdefault((peer.host, peer.port), peer)
+        return peer
+
+    def remove_peer(self, identifier):
+        """
+        Removes a peer from the registry.
+
+        Args:
+            identifier: The identifier of the peer.
+
+        Returns:
+            The removed Peer, or None if no peer has that identifier.
+        """
+        peer = self._by_identifier.pop(identifier, None)
+        if peer is None:
+            return None
+        self._detectors.pop(identifier, None)
+        self.peers.remove(peer)
+        if not peer.learner:
+            self.voters.remove(peer)
+        address = (peer.host, peer.port)
+        if self._by_address.get(address) is peer:
+            del self._by_address[address]
+            for other in self.peers:
+                if (other.host, other.port) == address:
+                    self._by_address[address] = other
+                    break
+        return peer
+
+    def set_learner(self, identifier, learner):
+        """
+        Turns a peer into a learner, or a learner into a voter.
+
+        Args:
+            identifier: The identifier of the peer.
+            learner: Whether the peer becomes a learner.
+
+        Returns:
+            The Peer, or None if no peer has that identifier.
+        """
+        peer = self._by_identifier.get(identifier)
+        if peer is None or peer.learner == learner:
+            return peer
+        peer.learner = learner
+        self.voters = [peer for peer in self.peers if not peer.learner]
+        return peer
 
     def get_peer_count(self):
         return len(self.peers)
 
+    def get_voter_count(self):
+        return len(self.voters)
+
     def get_peer_by_identifier(self, identifier):
-        for peer in self.peers:
-            if peer.identifier == identifier:
-                return peer
-        return None
+        return self._by_identifier.get(identifier)
+
+    def get_peer_by_address(self, host, port):
+        return self._by_address.get((host, port))
+
+    # MARK: Health
+
+    def record_heartbeat(self, identifier, now=None):
+        """
+        Records that a peer was heard from. Unknown peers are ignored.
+
+        Args:
+            identifier: The identifier of the peer.
+            now: Optional; The arrival time on the monotonic clock.
+        """
+        if identifier not in self._by_identifier:
+            return
+        detector = self._detectors.get(identifier)
+        if detector is None:
+            detector = PhiAccrualDetector(self.window_size,
+                                          self.min_std_deviation)
+            self._detectors[identifier] = detector
+        detector.heartbeat(now)
+
+    def get_phi(self, identifier, now=None):
+        """
+        Gets how strongly a peer is suspected to have failed, from how
+        long it has been silent compared to the usual intervals between
+        its heartbeats. The leader hears from every peer, while the other
+        peers only hear from the leader.
+
+        Args:
+            identifier: The identifier of the peer.
+            now: Optional; The time on the monotonic clock.
+
+        Returns:
+            The phi value of the peer, 0 if it was not heard from twice.
+        """
+        detector = self._detectors.get(identifier)
+        if detector is None:
+            return 0.0
+        return detector.phi(now)
+
+    def is_available(self, identifier, threshold=8.0, now=None):
+        """
+        Gets whether a peer is considered up for a phi threshold. With a
+        threshold of 8, a peer is only considered down once the chance
+        that its heartbeat is merely late fell to 1 in 10^8.
+
+        Args:
+            identifier: The identifier of the peer.
+            threshold: Optional; The phi value above which the peer is
+              considered down. (Default=8.0)
+            now: Optional; The time on the monotonic clock.
+
+        Returns:
+            True if the phi value of the peer is below the threshold.
+        """
+        return self.get_phi(identifier, now) < threshold
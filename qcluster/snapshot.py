@@ -0,0 +1,138 @@
+import logging
+import os
+
+from qcluster import utils
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+class Snapshot(object):
+    __slots__ = ('index', 'term', 'data')
+
+    def __init__(self, index, term, data):
+        """
+        Creates a snapshot of the state machine.
+
+        Args:
+            index: The index of the last entry applied to the state.
+            term: The term of the entry at index.
+            data: The serialized state, as bytes.
+        """
+        self.index = index
+        self.term = term
+        self.data = data
+
+    def chunks(self, chunk_size):
+        """
+        Splits the data into chunks to be streamed to a peer.
+
+        Args:
+            chunk_size: The size in bytes of a chunk.
+
+        Yields:
+            Tuples of (offset, chunk, whether it is the last chunk).
+        """
+        data = memoryview(self.data)
+        offset = 0
+        while True:
+            chunk = data[offset:offset + chunk_size]
+            done = offset + len(chunk) >= len(data)
+            yield offset, chunk, done
+            if done:
+                return
+            offset += len(chunk)
+
+    def __repr__(self):
+        return "Snapshot(index={}, term={}, size={})".format(
+            self.index, self.term, len(self.data))
+
+
+class SnapshotStore(object):
+    def __init__(self, directory, retain=2):
+        """
+        Creates a store keeping snapshots as files in a directory. A
+        snapshot is written to a temporary file and renamed once it is
+        durable, so a crash never leaves a partial snapshot behind.
+
+        Args:
+            directory: The directory holding the snapshots.
+            retain: Optional; The number of snapshots kept. (Default=2)
+        """
+        self.directory = directory
+        self.retain = retain
+
+    @staticmethod
+    def file_name(index, term):
+        return "{:020d}-{:020d}{}".format(index, term, SNAPSHOT_SUFFIX)
+
+    def list(self):
+        """
+        Lists the stored snapshots.
+
+        Returns:
+            A list of (index, term, file name) tuples, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SNAPSHOT_SUFFIX):
+                continue
+            index, _, term = name[:-len(SNAPSHOT_SUFFIX)].partition('-')
+            try:
+                snapshots.append((int(index), int(term), name))
+            except ValueError:
+                logger.warning("Ignoring unknown file {}".format(name))
+        return sorted(snapshots)
+
+    def latest(self):
+        """
+        Loads the most recent snapshot.
+
+        Returns:
+            The Snapshot, or None if there is none.
+        """
+        snapshots = self.list()
+        if not snapshots:
+            return None
+        index, term, _ = snapshots[-1]
+        return self.load(index, term)
+
+    def load(self, index, term):
+        """
+        Loads a stored snapshot.
+
+        Args:
+            index: The index of the snapshot.
+            term: The term of the snapshot.
+
+        Returns:
+            The Snapshot.
+        """
+        path = os.path.join(self.directory, self.file_name(index, term))
+        with open(path, 'rb') as f:
+            return Snapshot(index, term, f.read())
+
+    def save(self, snapshot):
+        """
+        Durably writes a snapshot and removes the oldest ones beyond the
+        number retained.
+
+        Args:
+            snapshot: The Snapshot to write.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = self.file_name(snapshot.index, snapshot.term)
+        path = os.path.join(self.directory, name)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(snapshot.data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+        utils.fsync_directory(self.directory)
+        logger.debug("Saved {}".format(snapshot))
+        for _, _, old_name in self.list()[:-self.retain]:
+            os.remove(os.path.join(self.directory, old_name))
@@ -0,0 +1,92 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class KeyValueStateMachine(object):
+    def __init__(self):
+        """
+        Creates an in-memory key-value store that is changed only by
+        applying committed log entries, so every peer holds the same data
+        once it has applied the same entries.
+
+        The entries are dicts in one of the following forms:
+            - {'op': 'put', 'key': key, 'value': value}
+            - {'op': 'delete', 'key': key}
+            - {'op': 'cas', 'key': key, 'expected': old, 'value': new}
+        """
+        self.data = {}
+        self.operations = {
+            'put': self.apply_put,
+            'delete': self.apply_delete,
+            'cas': self.apply_compare_and_set
+        }
+
+    def apply(self, entry):
+        """
+        Applies a committed log entry to the store.
+
+        Args:
+            entry: The LogEntry to apply.
+
+        Returns:
+            The result of the operation.
+
+        Raises:
+            ValueError: The entry is not a known operation.
+        """
+        command = entry.data
+        if type(command) is not dict:
+            raise ValueError("Invalid command: {}".format(command))
+        operation = self.operations.get(command.get('op'))
+        if operation is None:
+            raise ValueError("Unknown operation: {}".format(command))
+        return operation(command)
+
+    def apply_put(self, command):
+        self.data[command['key']] = command.get('value')
+        return True
+
+    def apply_delete(self, command):
+        return self.data.pop(command['key'], _MISSING) is not _MISSING
+
+    def apply_compare_and_set(self, command):
+        key = command['key']
+        if self.data.get(key) != command.get('expected'):
+            return False
+        self.data[key] = command.get('value')
+        return True
+
+    def get(self, key, default=None):
+        """
+        Reads a key from the local copy of the store.
+
+        Args:
+            key: The key to read.
+            default: Optional; The value returned if the key is not set.
+
+        Returns:
+            The value of the key.
+        """
+        return self.data.get(key, default)
+
+    def snapshot(self):
+        """
+        Gets a copy of the store to include in a snapshot.
+
+        Returns:
+            A dict of every key and its value.
+        """
+        return dict(self.data)
+
+    def restore(self, data):
+        """
+        Replaces the content of the store with the one of a snapshot.
+
+        Args:
+            data: A dict returned by snapshot.
+        """
+        self.data = dict(data)
+
+
+_MISSING = object()
@@ -1,4 +1,5 @@
 import inspect
+import os
 
 
 async def call_callback(callback, *args):
@@ -44,3 +45,20 @@ def interpret_callback_result(result):
         return False, None
     else:
         return True, result
+
+
+def fsync_directory(directory):
+    """
+    Makes the creation, renaming and removal of files in a directory
+    durable. Does nothing on platforms that cannot sync a directory.
+
+    Args:
+        directory: The path of the directory.
+    """
+    if not hasattr(os, 'O_DIRECTORY'):  # pragma: no cover
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,553 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from qcluster import utils
+
+logger = logging.getLogger(__name__)
+
+# Every record is this header followed by its payload. The checksum covers
+# the record type and the payload, so a torn write at the tail of a segment
+# is detected on recovery.
+_RECORD_HEADER = struct.Struct('!IIB')
+_ENTRY_HEADER = struct.Struct('!QQ')
+_INDEX = struct.Struct('!Q')
+
+RECORD_STATE = 1
+RECORD_ENTRY = 2
+RECORD_TRUNCATE = 3
+RECORD_COMPACT = 4
+
+SEGMENT_SUFFIX = '.wal'
+
+
+def encode_record(record_type, payload):
+    """
+    Builds a record.
+
+    Args:
+        record_type: One of the RECORD_* constants.
+        payload: The payload bytes.
+
+    Returns:
+        The record bytes.
+    """
+    checksum = zlib.crc32(payload, zlib.crc32(bytes((record_type,))))
+    return _RECORD_HEADER.pack(len(payload), checksum, record_type) + payload
+
+
+def decode_records(buffer, offset=0):
+    """
+    Reads the records of a segment up to the first empty, truncated or
+    corrupt record.
+
+    Args:
+        buffer: The segment bytes.
+        offset: Optional; Where to start reading. (Default=0)
+
+    Yields:
+        Tuples of (record offset, record type, payload).
+    """
+    while offset + _RECORD_HEADER.size <= len(buffer):
+        length, checksum, record_type = _RECORD_HEADER.unpack_from(buffer,
+                                                                   offset)
+        if length == 0:
+            return
+        start = offset + _RECORD_HEADER.size
+        payload = buffer[start:start + length]
+        if len(payload) != length:
+            return
+        if zlib.crc32(payload, zlib.crc32(bytes((record_type,)))) \
+                != checksum:
+            return
+        yield offset, record_type, payload
+        offset = start + length
+
+
+def encode_entry(index, term, data):
+    """
+    Builds the payload of an entry record.
+
+    Args:
+        index: The index of the entry.
+        term: The term of the entry.
+        data: The JSON serializable data of the entry.
+
+    Returns:
+        The payload bytes.
+    """
+    return _ENTRY_HEADER.pack(index, term) + json.dumps(data).encode('utf-8')
+
+
+def decode_entry(payload):
+    """
+    Reads the payload of an entry record.
+
+    Args:
+        payload: The payload bytes.
+
+    Returns:
+        A tuple of (index, term, data).
+    """
+    index, term = _ENTRY_HEADER.unpack_from(payload)
+    return index, term, json.loads(bytes(payload[_ENTRY_HEADER.size:]))
+
+
+class WriteAheadLog(object):
+    def __init__(self,
+                 directory,
+                 segment_size=64 << 20,
+                 flush_window=0.001,
+                 preallocate=True):
+        """
+        Creates a segmented, append-only write-ahead log that persists the
+        current term, the vote and the log entries of a peer.
+
+        Writes are buffered and a single background flush writes and fsyncs
+        everything buffered within the flush window, so concurrent writers
+        share one fsync. Segments are preallocated and a new segment is
+        started once the current one is full; a sealed segment is deleted
+        once a snapshot covers its highest entry. The log is only read back
+        on recovery, which maps each segment into memory to scan it. Entries
+        are served from the in-memory log. A failed write fails the log for
+        good, as what reached the disk is unknown.
+
+        Args:
+            directory: The directory holding the segments.
+            segment_size: Optional; The size in bytes of a segment.
+              (Default=64MiB)
+            flush_window: Optional; The time in seconds writes are collected
+              before they are flushed together. (Default=0.001)
+            preallocate: Optional; Whether to reserve the space of a segment
+              when it is created. (Default=True)
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_window = flush_window
+        self.preallocate = preallocate
+
+        self.term = 0
+        self.voted_for = None
+        # The members of the cluster as of the snapshot, or None if the
+        # configured ones apply
+        self.membership = None
+        self.snapshot_index = 0
+        self.snapshot_term = 0
+        self.entries = []
+        self.segments = []
+        # The index of the last entry written, and of the last one known to
+        # be durable
+        self.last_index = 0
+        self.durable_index = 0
+
+        # The highest entry index written to each segment
+        self._segment_last_index = {}
+        # The compaction waiting for its record to be durable, as a tuple of
+        # (index, segment of the record, future)
+        self._compaction = None
+        self._skip_through = 0
+
+        self._file = None
+        self._sequence = -1
+        self._offset = 0
+        # Where the next record goes, once the buffered ones are written
+        self._tail_sequence = 0
+        self._tail_offset = 0
+        self._buffer = []
+        self._waiters = []
+        # The futures of the records being written by the flusher
+        self._writing = []
+        # The removal of compacted segments in progress
+        self._removal = None
+        self._flush_task = None
+        # The error of a failed write, after which every write fails
+        self.error = None
+
+    # MARK: Recovery
+
+    def open(self, skip_through=0):
+        """
+        Opens the log, recovering the persisted state from every segment.
+        The recovered state is available in term, voted_for, snapshot_index,
+        snapshot_term and entries, the latter as a list of (index, term,
+        data) tuples following the snapshot.
+
+        Args:
+            skip_through: Optional; The index of a snapshot that is restored
+              separately. Entries up to it are skipped without decoding
+              their data. (Default=0)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._skip_through = skip_through
+        self.segments = sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX))
+        end = 0
+        for position, name in enumerate(self.segments):
+            end, sealed = self._scan_file(name)
+            if position == len(self.segments) - 1:
+                break
+            if not sealed:
+                logger.warning("Corrupt segment {}, ignoring the segments "
+                               "after it".format(name))
+                self.segments = self.segments[:position + 1]
+                break
+        self.last_index = self.durable_index = self.snapshot_index
+        if self.entries:
+            self.last_index = self.durable_index = self.entries[-1][0]
+        if self.segments:
+            self._open_segment(self.segments[-1], end)
+        else:
+            self._roll()
+        self._tail_sequence = self._sequence
+        self._tail_offset = self._offset
+        logger.info("Recovered term {} and {} entries from {} segments"
+                    .format(self.term, len(self.entries),
+                            len(self.segments)))
+
+    def _scan_file(self, name):
+        """
+        Memory-maps a segment for the time of its scan.
+
+        Returns:
+            A tuple of the offset following the last valid record, and
+            whether nothing but zeros follows it.
+        """
+        with open(self.segment_path(name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0, True
+            with mmap.mmap(f.fileno(), 0,
+                           access=mmap.ACCESS_READ) as segment:
+                with memoryview(segment) as buffer:
+                    end = self._scan_segment(buffer,
+                                             self.segment_sequence(name))
+                    return end, self._is_sealed(buffer, end)
+
+    def _scan_segment(self, buffer, sequence):
+        """
+        Replays the records of a segment.
+
+        Returns:
+            The offset following the last valid record.
+        """
+        end = 0
+        for offset, record_type, payload in decode_records(buffer):
+            self.replay(record_type, payload)
+            if record_type == RECORD_ENTRY:
+                self._track_entry(sequence,
+                                  _ENTRY_HEADER.unpack_from(payload)[0])
+            end = offset + _RECORD_HEADER.size + len(payload)
+        return end
+
+    @staticmethod
+    def _is_sealed(buffer, end):
+        """Whether a segment ends cleanly, with nothing but zeros left."""
+        return not any(buffer[end:end + _RECORD_HEADER.size])
+
+    def replay(self, record_type, payload):
+        """
+        Applies a recovered record to the in-memory state.
+
+        Args:
+            record_type: One of the RECORD_* constants.
+            payload: The payload bytes.
+        """
+        if record_type == RECORD_STATE:
+            state = json.loads(bytes(payload))
+            self.term = state.get('term', 0)
+            self.voted_for = state.get('voted_for', None)
+            self.membership = state.get('membership', self.membership)
+        elif record_type == RECORD_ENTRY:
+            index, term = _ENTRY_HEADER.unpack_from(payload)
+            self._truncate_entries(index)
+            if index > self._skip_through:
+                self.entries.append(decode_entry(payload))
+        elif record_type == RECORD_TRUNCATE:
+            index, = _INDEX.unpack_from(payload)
+            self._truncate_entries(index)
+        elif record_type == RECORD_COMPACT:
+            index, term = _ENTRY_HEADER.unpack_from(payload)
+            self.snapshot_index = index
+            self.snapshot_term = term
+            self.entries = [entry for entry in self.entries
+                            if entry[0] > index]
+
+    def _truncate_entries(self, index):
+        while self.entries and self.entries[-1][0] >= index:
+            self.entries.pop()
+
+    def _track_entry(self, sequence, index):
+        self._segment_last_index[sequence] = max(
+            self._segment_last_index.get(sequence, 0), index)
+
+    # MARK: Segments
+
+    def segment_path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def segment_name(sequence):
+        return "{:020d}{}".format(sequence, SEGMENT_SUFFIX)
+
+    @staticmethod
+    def segment_sequence(name):
+        return int(name[:-len(SEGMENT_SUFFIX)])
+
+    def _open_segment(self, name, offset):
+        self._sequence = self.segment_sequence(name)
+        self._file = open(self.segment_path(name), 'r+b')
+        # Drop whatever follows the last valid record, so a torn write can
+        # not be mistaken for a record later on
+        self._file.truncate(offset)
+        self._reserve(offset)
+        self._file.seek(offset)
+        self._offset = offset
+
+    def _roll(self):
+        """Seals the current segment and starts a new one."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._sequence += 1
+        name = self.segment_name(self._sequence)
+        self._file = open(self.segment_path(name), 'w+b')
+        self._reserve(0)
+        utils.fsync_directory(self.directory)
+        self.segments.append(name)
+        self._offset = 0
+        logger.debug("Started segment {}".format(name))
+
+    def _reserve(self, offset):
+        if not self.preallocate or offset >= self.segment_size:
+            return
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self._file.fileno(), offset,
+                               self.segment_size - offset)
+        else:  # pragma: no cover
+            self._file.truncate(self.segment_size)
+
+    # MARK: Writing
+
+    def save_state(self, term, voted_for):
+        """
+        Persists the current term and the vote, along with the membership
+        of the cluster as of the snapshot.
+
+        Args:
+            term: The current term.
+            voted_for: The identifier voted for in this term, or None.
+
+        Returns:
+            A future resolved once the state is durable.
+        """
+        self.term = term
+        self.voted_for = voted_for
+        state = {'term': term, 'voted_for': voted_for}
+        if self.membership is not None:
+            state['membership'] = self.membership
+        payload = json.dumps(state).encode('utf-8')
+        return self._enqueue(encode_record(RECORD_STATE, payload))
+
+    def append(self, index, term, data):
+        """
+        Persists a log entry. An entry at an index that already exists
+        replaces it and every entry after it.
+
+        Once a write failed, every write fails with the same error until
+        the log is opened again.
+
+        Args:
+            index: The index of the entry.
+            term: The term of the entry.
+            data: The JSON serializable data of the entry.
+
+        Returns:
+            A future resolved once the entry is durable.
+        """
+        self.last_index = index
+        payload = encode_entry(index, term, data)
+        record = encode_record(RECORD_ENTRY, payload)
+        future = self._enqueue(record)
+        if self.error is None:
+            self._track_entry(self._buffer[-1][0], index)
+        return future
+
+    def truncate(self, index):
+        """
+        Persists the removal of the entry at an index and every entry after
+        it.
+
+        Args:
+            index: The index of the first entry to remove.
+
+        Returns:
+            A future resolved once the removal is durable.
+        """
+        self.last_index = min(self.last_index, index - 1)
+        self.durable_index = min(self.durable_index, index - 1)
+        return self._enqueue(encode_record(RECORD_TRUNCATE,
+                                           _INDEX.pack(index)))
+
+    def compact(self, index, term, membership=None):
+        """
+        Persists that the entries up to an index are included in a
+        snapshot. Once this is durable, the segments holding nothing but
+        those entries are removed.
+
+        Args:
+            index: The index of the last entry included in the snapshot.
+            term: The term of the entry at index.
+            membership: Optional; The members of the cluster as of index,
+              which the removed segments may hold the only copy of.
+
+        Returns:
+            A future resolved once the compaction is durable.
+        """
+        if index <= self.snapshot_index:
+            return self._enqueue(None)
+        self.snapshot_index = index
+        self.snapshot_term = term
+        if membership is not None:
+            self.membership = membership
+        if index > self.last_index:
+            self.last_index = index
+        future = self._enqueue(encode_record(RECORD_COMPACT,
+                                             _ENTRY_HEADER.pack(index, term)))
+        if self.error is not None:
+            return future
+        sequence = self._buffer[-1][0]
+        # The older segments may hold the only copy of the term and the
+        # vote, so they are written again after the compaction
+        self.save_state(self.term, self.voted_for)
+        self._compaction = (index, sequence, future)
+        return future
+
+    async def sync(self):
+        """
+        Waits until every write made so far is durable, and the segments
+        compacted so far are removed.
+
+        Raises:
+            OSError: A write failed, so the writes can not be durable.
+        """
+        pending = self._writing + self._waiters
+        if self._removal is not None:
+            pending.append(self._removal)
+        if pending:
+            await asyncio.gather(*pending)
+        if self.error is not None:
+            raise self.error
+
+    def _enqueue(self, record):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if record is None:
+            future.set_result(None)
+            return future
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        # Segments are assigned here, so the segment of every record is
+        # known before it is written
+        if (self._tail_offset > 0
+                and self._tail_offset + len(record) > self.segment_size):
+            self._tail_sequence += 1
+            self._tail_offset = 0
+        self._buffer.append((self._tail_sequence, record))
+        self._tail_offset += len(record)
+        self._waiters.append(future)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush())
+        return future
+
+    async def _flush(self):
+        """
+        Group commit: writes everything buffered within the flush window and
+        fsyncs it once.
+        """
+        loop = asyncio.get_running_loop()
+        while self._buffer:
+            if self.flush_window:
+                await asyncio.sleep(self.flush_window)
+            records, waiters = self._buffer, self._waiters
+            self._buffer, self._waiters = [], []
+            self._writing = waiters
+            last_index = self.last_index
+            try:
+                await loop.run_in_executor(None, self._write, records)
+            except Exception as e:
+                logger.exception("Unable to write to the write-ahead log, "
+                                 "refusing any further write")
+                # What reached the segment is unknown after a failed write
+                # or fsync, and the records buffered meanwhile were given
+                # positions following the failed ones, so the log can not
+                # be written to safely anymore
+                self.error = e
+                for future in waiters + self._waiters:
+                    if not future.done():
+                        future.set_exception(e)
+                self._buffer, self._waiters = [], []
+                return
+            finally:
+                self._writing = []
+            self.durable_index = min(last_index, self.last_index)
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+            compaction = self._compaction
+            if (compaction is not None and compaction[2].done()
+                    and compaction[2].exception() is None):
+                index, sequence, _ = compaction
+                self._compaction = None
+                self._removal = loop.run_in_executor(
+                    None, self._remove_segments, index, sequence)
+                try:
+                    await self._removal
+                finally:
+                    self._removal = None
+
+    def _remove_segments(self, index, sequence):
+        """
+        Removes the oldest segments, up to the one holding the compaction
+        record, as long as they only hold entries up to index.
+        """
+        removed = 0
+        for name in list(self.segments):
+            segment_sequence = self.segment_sequence(name)
+            if segment_sequence >= min(sequence, self._sequence):
+                break
+            if self._segment_last_index.get(segment_sequence, 0) > index:
+                break
+            os.remove(self.segment_path(name))
+            self.segments.remove(name)
+            self._segment_last_index.pop(segment_sequence, None)
+            removed += 1
+        if removed:
+            utils.fsync_directory(self.directory)
+            logger.debug("Removed {} compacted segments".format(removed))
+
+    def _write(self, records):
+        """Writes records, rolling segments as needed, then fsyncs."""
+        for sequence, record in records:
+            if sequence != self._sequence:
+                self._roll()
+            self._file.write(record)
+            self._offset += len(record)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Closes the current segment. Writes that were not flushed yet are
+        discarded.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self._file is not None:
+            self._file.close()
+        self._file = None
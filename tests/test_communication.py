@@ -2,7 +2,9 @@ import pytest
 import asyncio
 import aiohttp.web
 from unittest.mock import Mock, patch
-from qcluster.communication import HTTPCommunicator, _HTTPResponder
+from qcluster.communication import HTTPCommunicator, _HTTPResponder, \
+    TCPCommunicator, UDPHeartbeatChannel, BinaryCodec, JSONCodec, \
+    get_codec, get_transport
 
 
 class TestHTTPCommunicator:
@@ -200,7 +202,7 @@ class TestHTTPCommunicator:
         await self.communicator.register_with('localhost', unused_tcp_port)
 
         # Assert
-        on_register.assert_called_with('localhost', unused_tcp_port, 'a')
+        on_register.assert_called_with('localhost', unused_tcp_port, 'a', False)
 
     @pytest.mark.asyncio
     async def test_on_register_can_return_error(self, unused_tcp_port):
@@ -218,6 +220,37 @@ class TestHTTPCommunicator:
         # Assert
         assert status is False
 
+    @pytest.mark.asyncio
+    async def test_requests_reuse_pooled_session(self, unused_tcp_port):
+        """Test that consecutive requests share one session and connection"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+
+        # Act
+        await self.communicator.send_heartbeat('localhost', unused_tcp_port, {})
+        session = self.communicator._requester.get_session()
+        await self.communicator.send_heartbeat('localhost', unused_tcp_port, {})
+
+        # Assert
+        assert self.communicator._requester.get_session() is session
+        assert len(session.connector._conns) == 1
+
+    @pytest.mark.asyncio
+    async def test_close_shuts_down_communicator(self, unused_tcp_port):
+        """Test that closing releases the session and stops the listener"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        session = self.communicator._requester.get_session()
+
+        # Act
+        await self.communicator.close()
+
+        # Assert
+        assert session.closed
+        assert await HTTPCommunicator('b', 0).ping('localhost', unused_tcp_port) is False
+
     @patch.object(aiohttp.web, 'Response')
     def test_respond_text_success(self, web_response):
         """Test that passing a success result with data returns a 200 result
@@ -334,4 +367,536 @@ class TestHTTPCommunicator:
 
         # Assert
         assert status is False
-        assert data is None
\ No newline at end of file
+        assert data is None
+
+    @pytest.mark.asyncio
+    async def test_install_snapshot_sends_raw_chunk(self, unused_tcp_port):
+        """Test that a snapshot chunk reaches the callback as raw bytes"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_install_snapshot = Mock()
+        on_install_snapshot.return_value = (True, {'success': True})
+        self.communicator.set_on_install_snapshot(on_install_snapshot)
+        data = {'term': 1, 'offset': 0, 'done': True}
+
+        # Act
+        result = await self.communicator.install_snapshot('localhost', unused_tcp_port, data, memoryview(b'\x00state'))
+
+        # Assert
+        assert result == (True, {'success': True})
+        on_install_snapshot.assert_called_with(data, b'\x00state')
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_timeout_now_calls_callback(self, unused_tcp_port):
+        """Test that a timeout_now message reaches its callback"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_timeout_now = Mock()
+        on_timeout_now.return_value = (True, {'success': True})
+        self.communicator.set_on_timeout_now(on_timeout_now)
+        data = {'identifier': 'b', 'term': 2}
+
+        # Act
+        result = await self.communicator.timeout_now('localhost', unused_tcp_port, data)
+
+        # Assert
+        assert result == (True, {'success': True})
+        on_timeout_now.assert_called_with(data)
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_gossip_calls_callback(self, unused_tcp_port):
+        """Test that a gossip message reaches its callback"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_gossip = Mock()
+        on_gossip.return_value = (True, {'type': 'ack', 'updates': []})
+        self.communicator.set_on_gossip(on_gossip)
+        data = {'type': 'ping', 'identifier': 'b', 'incarnation': 0,
+                'updates': [{'identifier': 'c', 'host': 'localhost', 'port': 7003,
+                             'status': 2, 'incarnation': 1}]}
+
+        # Act
+        result = await self.communicator.gossip('localhost', unused_tcp_port, data)
+
+        # Assert
+        assert result == (True, {'type': 'ack', 'updates': []})
+        on_gossip.assert_called_with(data)
+        await self.communicator.close()
+
+
+class TestCodecs:
+
+    def test_json_codec_round_trip(self):
+        """Test that the json codec decodes what it encodes"""
+        data = {'identifier': 'a', 'term': 3}
+        assert JSONCodec.decode(JSONCodec.encode(data)) == data
+
+    def test_binary_codec_round_trip(self):
+        """Test that known and unknown fields survive the binary codec"""
+        data = {'identifier': 'server_a', 'term': 2 ** 40, 'vote_granted': False, 'custom': [1, 2]}
+        assert BinaryCodec.decode(BinaryCodec.encode(data)) == data
+
+    def test_binary_codec_is_smaller_than_json(self):
+        """Test that a heartbeat is packed tighter than its json form"""
+        data = {'identifier': 'server_a', 'term': 12}
+        assert len(BinaryCodec.encode(data)) < len(JSONCodec.encode(data))
+
+    def test_binary_codec_keeps_mistyped_fields(self):
+        """Test that a known field with an unexpected type is not coerced"""
+        data = {'term': '5', 'port': True}
+        assert BinaryCodec.decode(BinaryCodec.encode(data)) == data
+
+    def test_binary_codec_rejects_truncated_payload(self):
+        """Test that a truncated payload raises a ValueError"""
+        payload = BinaryCodec.encode({'identifier': 'server_a', 'term': 1})
+        with pytest.raises(ValueError):
+            BinaryCodec.decode(payload[:-3])
+
+    def test_get_codec_rejects_unknown_codec(self):
+        """Test that an unknown codec name raises a ValueError"""
+        with pytest.raises(ValueError):
+            get_codec('yaml')
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_with_binary_codec(self, unused_tcp_port):
+        """Test that a heartbeat and its response travel as binary"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port, codec='binary')
+        await self.communicator.start()
+        on_heartbeat = Mock()
+        on_heartbeat.return_value = True, {'term': 1}
+        self.communicator.set_on_heartbeat(on_heartbeat)
+
+        # Act
+        status, data = await self.communicator.send_heartbeat('localhost', unused_tcp_port, {'identifier': 'a', 'term': 1})
+
+        # Assert
+        on_heartbeat.assert_called_with({'identifier': 'a', 'term': 1})
+        assert status is True
+        assert data == {'term': 1}
+
+    @pytest.mark.asyncio
+    async def test_peer_without_codec_falls_back_to_json(self, unused_tcp_port_factory):
+        """Test that a peer answering 415 is downgraded to json"""
+        # Setup
+        port_a, port_b = unused_tcp_port_factory(), unused_tcp_port_factory()
+        received = []
+
+        async def json_only(request):
+            received.append(request.content_type)
+            if request.content_type != 'application/json':
+                return aiohttp.web.Response(status=415)
+            return aiohttp.web.json_response({'vote_granted': True})
+
+        app = aiohttp.web.Application()
+        app.router.add_post('/raft/request_vote', json_only)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        await aiohttp.web.TCPSite(runner, 'localhost', port_b).start()
+        self.communicator = HTTPCommunicator('a', port_a, codec='binary')
+
+        # Act
+        first = await self.communicator.request_vote('localhost', port_b, {'term': 1})
+        second = await self.communicator.request_vote('localhost', port_b, {'term': 1})
+
+        # Assert
+        assert first == (True, {'vote_granted': True})
+        assert second == (True, {'vote_granted': True})
+        assert received == [BinaryCodec.content_type, 'application/json', 'application/json']
+        await runner.cleanup()
+
+
+class TestTCPCommunicator:
+
+    @pytest.mark.asyncio
+    async def test_ping_returns_true(self, unused_tcp_port):
+        """Test that a ping comes back"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+
+        # Act
+        result = await self.communicator.ping('localhost', unused_tcp_port)
+
+        # Assert
+        assert result is True
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_ping_returns_false(self, unused_tcp_port):
+        """Test that a ping to nowhere doesn't come back"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+
+        # Act
+        result = await self.communicator.ping('localhost', unused_tcp_port)
+
+        # Assert
+        assert result is False
+
+    @pytest.mark.asyncio
+    async def test_on_heartbeat_executes(self, unused_tcp_port):
+        """Test that the heartbeat callback receives the data and replies"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_heartbeat = Mock()
+        on_heartbeat.return_value = True, {'term': 2}
+        self.communicator.set_on_heartbeat(on_heartbeat)
+        data = {'identifier': 'a', 'term': 1}
+
+        # Act
+        status, return_data = await self.communicator.send_heartbeat('localhost', unused_tcp_port, data)
+
+        # Assert
+        on_heartbeat.assert_called_with(data)
+        assert status is True
+        assert return_data == {'term': 2}
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_rejects_invalid_data(self, unused_tcp_port):
+        """Test that the data parameter rejects non None or dict data."""
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        with pytest.raises(ValueError):
+            await self.communicator.send_heartbeat('localhost', unused_tcp_port, 5)
+
+    @pytest.mark.asyncio
+    async def test_request_vote_fails_with_no_callback(self, unused_tcp_port):
+        """Test that request vote fails when no callback is defined"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+
+        # Act
+        result = await self.communicator.request_vote('localhost', unused_tcp_port, {'term': 1})
+
+        # Assert
+        assert result == (False, None)
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_request_vote_timeout(self, unused_tcp_port):
+        """Test that request vote will timeout after a given timeout"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+
+        async def long_callback(data):
+            await asyncio.sleep(1)
+
+        self.communicator.set_on_request_vote(long_callback)
+        await self.communicator.start()
+
+        # Act
+        result = await self.communicator.request_vote('localhost', unused_tcp_port, {}, timeout=0.2)
+
+        # Assert
+        assert result == (False, None)
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_on_register_executes(self, unused_tcp_port):
+        """Test that our register callback is called with the right data"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_register = Mock()
+        on_register.return_value = True
+        self.communicator.set_on_register(on_register)
+
+        # Act
+        status = await self.communicator.register_with('localhost', unused_tcp_port)
+
+        # Assert
+        assert status is True
+        on_register.assert_called_with('localhost', unused_tcp_port, 'a', False)
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_register_with_closed_port_returns_false(self, unused_tcp_port_factory):
+        """Test that registering with an unreachable peer returns false"""
+        # Setup
+        port, closed_port = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator = TCPCommunicator('a', port)
+        await self.communicator.start()
+
+        # Act
+        status = await self.communicator.register_with('localhost', closed_port)
+
+        # Assert
+        assert status is False
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_one_connection(self, unused_tcp_port):
+        """Test that concurrent requests to a peer use a single connection"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        self.communicator.set_on_heartbeat(lambda data: (True, data))
+
+        # Act
+        results = await asyncio.gather(*[
+            self.communicator.send_heartbeat('localhost', unused_tcp_port, {'term': i})
+            for i in range(10)
+        ])
+
+        # Assert
+        assert results == [(True, {'term': i}) for i in range(10)]
+        assert len(self.communicator._requester._connections) == 1
+        assert len(self.communicator._responder._writers) == 1
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_slow_request_does_not_block_the_next(self, unused_tcp_port):
+        """Test that a heartbeat is answered while a vote is still pending"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+
+        async def slow_vote(data):
+            await asyncio.sleep(0.5)
+            return True, {'vote_granted': True}
+
+        self.communicator.set_on_request_vote(slow_vote)
+        self.communicator.set_on_heartbeat(lambda data: (True, {}))
+        await self.communicator.start()
+
+        # Act
+        vote = asyncio.ensure_future(self.communicator.request_vote('localhost', unused_tcp_port, {}))
+        await asyncio.sleep(0.05)
+        heartbeat = await self.communicator.send_heartbeat('localhost', unused_tcp_port, {}, timeout=0.2)
+
+        # Assert
+        assert heartbeat == (True, {})
+        assert vote.done() is False
+        assert await vote == (True, {'vote_granted': True})
+        assert len(self.communicator._requester._connections) == 1
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_in_flight_window_applies_backpressure(self, unused_tcp_port):
+        """Test that requests beyond the window wait for a free slot"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port, max_in_flight=1)
+        release = asyncio.Event()
+
+        async def blocked_vote(data):
+            await release.wait()
+            return True, {'vote_granted': True}
+
+        self.communicator.set_on_request_vote(blocked_vote)
+        await self.communicator.start()
+
+        # Act
+        first = asyncio.ensure_future(self.communicator.request_vote('localhost', unused_tcp_port, {}))
+        await asyncio.sleep(0.05)
+        second = await self.communicator.ping('localhost', unused_tcp_port, timeout=0.1)
+        release.set()
+
+        # Assert
+        assert second is False
+        assert await first == (True, {'vote_granted': True})
+        assert await self.communicator.ping('localhost', unused_tcp_port) is True
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_unsupported_codec_falls_back_to_json(self, unused_tcp_port):
+        """Test that a peer without the preferred codec is sent json"""
+        # Setup
+        class UnknownCodec(BinaryCodec):
+            name = 'unknown'
+            codec_id = 99
+
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        self.communicator.codec = UnknownCodec
+        self.communicator.set_on_heartbeat(lambda data: (True, data))
+        await self.communicator.start()
+
+        # Act
+        result = await self.communicator.send_heartbeat('localhost', unused_tcp_port, {'term': 1})
+
+        # Assert
+        assert result == (True, {'term': 1})
+        assert self.communicator._peer_codecs[('localhost', unused_tcp_port)] is JSONCodec
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_install_snapshot_sends_raw_chunk(self, unused_tcp_port):
+        """Test that a snapshot chunk follows the encoded data in the frame"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_install_snapshot = Mock()
+        on_install_snapshot.return_value = (True, {'term': 1})
+        self.communicator.set_on_install_snapshot(on_install_snapshot)
+        data = {'term': 1, 'offset': 0, 'done': True}
+
+        # Act
+        result = await self.communicator.install_snapshot('localhost', unused_tcp_port, data, b'\x00state')
+
+        # Assert
+        assert result == (True, {'term': 1})
+        on_install_snapshot.assert_called_with(data, b'\x00state')
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_timeout_now_calls_callback(self, unused_tcp_port):
+        """Test that a timeout_now message reaches its callback"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_timeout_now = Mock()
+        on_timeout_now.return_value = (True, {'success': True})
+        self.communicator.set_on_timeout_now(on_timeout_now)
+        data = {'identifier': 'b', 'term': 2}
+
+        # Act
+        result = await self.communicator.timeout_now('localhost', unused_tcp_port, data)
+
+        # Assert
+        assert result == (True, {'success': True})
+        on_timeout_now.assert_called_with(data)
+        await self.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_gossip_calls_callback(self, unused_tcp_port):
+        """Test that a gossip message reaches its callback"""
+        # Setup
+        self.communicator = TCPCommunicator('a', unused_tcp_port)
+        await self.communicator.start()
+        on_gossip = Mock()
+        on_gossip.return_value = (True, {'type': 'ack', 'updates': []})
+        self.communicator.set_on_gossip(on_gossip)
+        data = {'type': 'ping', 'identifier': 'b', 'incarnation': 0,
+                'updates': [{'identifier': 'c', 'host': 'localhost', 'port': 7003,
+                             'status': 2, 'incarnation': 1}]}
+
+        # Act
+        result = await self.communicator.gossip('localhost', unused_tcp_port, data)
+
+        # Assert
+        assert result == (True, {'type': 'ack', 'updates': []})
+        on_gossip.assert_called_with(data)
+        await self.communicator.close()
+
+    def test_get_transport(self):
+        """Test that transports are looked up by name"""
+        assert get_transport('http') is HTTPCommunicator
+        assert get_transport('tcp') is TCPCommunicator
+        with pytest.raises(ValueError):
+            get_transport('carrier-pigeon')
+
+
+class TestUDPHeartbeatChannel:
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_reaches_callback(self, unused_udp_port_factory):
+        """Test that a heartbeat datagram is handed to the callback"""
+        # Setup
+        port_a, port_b = unused_udp_port_factory(), unused_udp_port_factory()
+        self.channel_a = UDPHeartbeatChannel('localhost', port_a)
+        self.channel_b = UDPHeartbeatChannel('localhost', port_b)
+        await self.channel_a.start()
+        await self.channel_b.start()
+        received = asyncio.Event()
+        on_heartbeat = Mock(side_effect=lambda data: received.set())
+        self.channel_b.set_on_heartbeat(on_heartbeat)
+
+        # Act
+        await self.channel_a.send_heartbeat('localhost', port_b, {'identifier': 'a', 'term': 3})
+        await asyncio.wait_for(received.wait(), 1)
+
+        # Assert
+        on_heartbeat.assert_called_with({'identifier': 'a', 'term': 3})
+        self.channel_a.close()
+        self.channel_b.close()
+
+    @pytest.mark.asyncio
+    async def test_failing_callback_is_logged(self, unused_udp_port_factory, caplog):
+        """Test that an exception raised by the callback is logged and dropped"""
+        # Setup
+        port_a, port_b = unused_udp_port_factory(), unused_udp_port_factory()
+        self.channel_a = UDPHeartbeatChannel('localhost', port_a)
+        self.channel_b = UDPHeartbeatChannel('localhost', port_b)
+        await self.channel_a.start()
+        await self.channel_b.start()
+        received = asyncio.Event()
+
+        def on_heartbeat(data):
+            received.set()
+            raise RuntimeError("callback failed")
+        self.channel_b.set_on_heartbeat(on_heartbeat)
+
+        # Act
+        await self.channel_a.send_heartbeat('localhost', port_b, {'term': 3})
+        await asyncio.wait_for(received.wait(), 1)
+        await asyncio.sleep(0)
+
+        # Assert
+        assert "callback failed" in caplog.text
+        assert not self.channel_b._tasks
+        self.channel_a.close()
+        self.channel_b.close()
+
+    @pytest.mark.asyncio
+    async def test_sampled_heartbeats_are_acknowledged(self, unused_udp_port_factory):
+        """Test that every n-th heartbeat is acknowledged with the callback data"""
+        # Setup
+        port_a, port_b = unused_udp_port_factory(), unused_udp_port_factory()
+        self.channel_a = UDPHeartbeatChannel('localhost', port_a, ack_interval=2)
+        self.channel_b = UDPHeartbeatChannel('localhost', port_b)
+        await self.channel_a.start()
+        await self.channel_b.start()
+        self.channel_b.set_on_heartbeat(lambda data: (True, {'term': 7}))
+        acked = asyncio.Event()
+        on_ack = Mock(side_effect=lambda host, port, data: acked.set())
+        self.channel_a.set_on_ack(on_ack)
+
+        # Act
+        await self.channel_a.send_heartbeat('localhost', port_b, {'term': 1})
+        await asyncio.sleep(0.05)
+        assert on_ack.called is False
+        await self.channel_a.send_heartbeat('localhost', port_b, {'term': 1})
+        await asyncio.wait_for(acked.wait(), 1)
+
+        # Assert
+        on_ack.assert_called_once_with('localhost', port_b, {'term': 7})
+        assert self.channel_a.last_ack('localhost', port_b) is not None
+        self.channel_a.close()
+        self.channel_b.close()
+
+    @pytest.mark.asyncio
+    async def test_malformed_datagram_is_dropped(self, unused_udp_port):
+        """Test that garbage datagrams do not reach the callback"""
+        # Setup
+        self.channel = UDPHeartbeatChannel('localhost', unused_udp_port)
+        on_heartbeat = Mock()
+        self.channel.set_on_heartbeat(on_heartbeat)
+
+        # Act
+        self.channel.datagram_received(b'\x01', ('127.0.0.1', 1))
+
+        # Assert
+        assert on_heartbeat.called is False
+
+    @pytest.mark.asyncio
+    async def test_communicator_starts_heartbeat_channel(self, unused_tcp_port):
+        """Test that a communicator owns a channel when UDP heartbeats are on"""
+        # Setup
+        self.communicator = HTTPCommunicator('a', unused_tcp_port, udp_heartbeats=True)
+        on_heartbeat = Mock()
+
+        # Act
+        self.communicator.set_on_heartbeat(on_heartbeat)
+        await self.communicator.start()
+
+        # Assert
+        assert self.communicator.heartbeat_channel.on_heartbeat is on_heartbeat
+        assert self.communicator.heartbeat_channel.transport is not None
+        await self.communicator.close()
+        assert self.communicator.heartbeat_channel.transport is None
@@ -2,9 +2,11 @@ import asyncio
 import pytest
 import time
 
-from qcluster.consensus import RaftConsensus, PeerState
-from qcluster.communication import HTTPCommunicator
+from qcluster.consensus import RaftConsensus, PeerState, NotLeaderError, ElectionTimer
+from qcluster.communication import HTTPCommunicator, TCPCommunicator
 from qcluster.registry import Registry
+from qcluster.snapshot import Snapshot, SnapshotStore
+from qcluster.wal import WriteAheadLog
 
 from unittest.mock import Mock, patch
 
@@ -71,11 +73,20 @@ class TestConsensus:
         self.communicator = HTTPCommunicator('a', unused_tcp_port)
         self.registry = Registry([])
         self.raft = RaftConsensus(self.communicator, self.registry)
-        self.raft.got_heartbeat.set()
-        await self.raft.process_state()
+        follower = asyncio.ensure_future(self.raft.process_state())
 
+        t_start = time.monotonic()
+        while time.monotonic() - t_start < 0.5:
+            self.raft.on_heartbeat({'identifier': '1', 'term': 0})
+            await asyncio.sleep(0.05)
+        assert not follower.done()
         assert self.raft.state == PeerState.FOLLOWER
 
+        # Without heartbeats the election timeout passes
+        await follower
+        assert self.raft.state == PeerState.CANDIDATE
+        assert time.monotonic() - t_start < 0.5 + self.raft.max_timeout + 0.1
+
     @pytest.mark.asyncio
     async def test_valid_heartbeat_sets_got_heartbeat(self, unused_tcp_port):
         self.communicator = HTTPCommunicator('a', unused_tcp_port)
@@ -168,29 +179,55 @@ class TestConsensus:
         assert self.raft_f.got_heartbeat.is_set() is False
         await self.raft_l.process_state()
         assert self.raft_f.got_heartbeat.is_set()
-        await self.raft_f.process_state()
-        assert self.raft_f.got_heartbeat.is_set() is False
+        assert self.raft_f.election_timer.deadline > asyncio.get_running_loop().time()
+        self.raft_l.step_down()
 
     @pytest.mark.asyncio
-    async def test_leader_gives_up_on_followers_long_heartbeat(self, unused_tcp_port_factory):
+    async def test_leader_sets_followers_heartbeat_flag_over_tcp(self, unused_tcp_port_factory):
         port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
-        self.communicator_l = HTTPCommunicator('leader', port_l)
-        self.communicator_f = HTTPCommunicator('follower', port_f)
+        self.communicator_l = TCPCommunicator('leader', port_l)
+        self.communicator_f = TCPCommunicator('follower', port_f)
         await self.communicator_f.start()
         self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
         self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]))
+
         self.raft_l.state = PeerState.LEADER
 
-        async def long_call(data):
-            await asyncio.sleep(0.5)
+        await self.raft_l.process_state()
+        assert self.raft_f.got_heartbeat.is_set()
+        assert self.raft_f.known_leader == 'leader'
+        await self.communicator_l.close()
+        await self.communicator_f.close()
+
+    @pytest.mark.asyncio
+    async def test_leader_sets_followers_heartbeat_flag_over_udp(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_l = HTTPCommunicator('leader', port_l, udp_heartbeats=True)
+        self.communicator_f = HTTPCommunicator('follower', port_f, udp_heartbeats=True)
+        await self.communicator_l.start()
+        await self.communicator_f.start()
+        self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]))
 
-        self.communicator_f.set_on_heartbeat(long_call)
+        self.raft_l.state = PeerState.LEADER
 
-        t_start = time.time()
         await self.raft_l.process_state()
-        duration = time.time() - t_start - 0.050
+        assert self.raft_f.got_heartbeat.is_set()
+        assert self.raft_f.known_leader == 'leader'
+        await self.communicator_l.close()
+        await self.communicator_f.close()
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_ack_with_newer_term_demotes_leader(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([{'host': 'localhost', 'port': 7001, 'identifier': 'b'}]))
+        self.raft.state = PeerState.LEADER
+        self.raft.term = 3
 
-        assert duration <= 0.15
+        self.raft.on_heartbeat_ack('localhost', 7001, {'term': 5, 'success': False})
+
+        assert self.raft.state == PeerState.FOLLOWER
+        assert self.raft.term == 5
 
     @pytest.mark.asyncio
     async def test_candidate_sends_votes(self, unused_tcp_port_factory):
@@ -210,7 +247,7 @@ class TestConsensus:
 
         await self.raft_c.process_state()
 
-        on_rv.assert_called_with({'identifier': 'candidate', 'term': 4})
+        on_rv.assert_called_with({'identifier': 'candidate', 'term': 4, 'last_log_index': 0, 'last_log_term': 0})
 
     @pytest.mark.asyncio
     async def test_valid_heartbeat_cancels_election(self, unused_tcp_port_factory):
@@ -239,7 +276,7 @@ class TestConsensus:
         self.communicator_c = HTTPCommunicator('candidate', port_c)
         self.communicator_l = HTTPCommunicator('leader', port_l)
         await self.communicator_l.start()
-        self.raft_c = RaftConsensus(self.communicator_c, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]))
+        self.raft_c = RaftConsensus(self.communicator_c, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]), pre_vote=False)
         self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_c, 'identifier': 'candidate'}]))
 
         self.raft_c.state = PeerState.CANDIDATE
@@ -310,7 +347,7 @@ class TestConsensus:
             {'host': 'localhost', 'port': port_b, 'identifier': 'b'},
             {'host': 'localhost', 'port': port_c, 'identifier': 'c'},
             {'host': 'localhost', 'port': port_d, 'identifier': 'd'},
-        ]))
+        ]), pre_vote=False)
         self.raft_b = RaftConsensus(self.communicator_b, Registry([
             {'host': 'localhost', 'port': port_a, 'identifier': 'a'},
             {'host': 'localhost', 'port': port_c, 'identifier': 'c'},
@@ -346,6 +383,40 @@ class TestConsensus:
         await self.raft_a.process_state()
         assert self.raft_a.state == PeerState.CANDIDATE
 
+    @pytest.mark.asyncio
+    async def test_election_is_decided_without_waiting_for_slow_peers(self, unused_tcp_port_factory):
+        ports = [unused_tcp_port_factory() for _ in range(4)]
+        communicators = [HTTPCommunicator(name, port) for name, port in zip('abcd', ports)]
+        for communicator in communicators[1:]:
+            await communicator.start()
+        self.raft = RaftConsensus(communicators[0], Registry([
+            {'host': 'localhost', 'port': port, 'identifier': name} for name, port in zip('bcd', ports[1:])
+        ]))
+
+        async def slow(data):
+            await asyncio.sleep(5)
+
+        def on_rv_true(data):
+            return True, {"vote_granted": True}
+
+        def on_rv_false(data):
+            return True, {"vote_granted": False}
+
+        communicators[1].set_on_request_vote(on_rv_true)
+        communicators[2].set_on_request_vote(on_rv_true)
+        communicators[3].set_on_request_vote(slow)
+        t_start = time.monotonic()
+        assert await self.raft.request_votes(1, timeout=2) is True
+        assert time.monotonic() - t_start < 1
+
+        communicators[1].set_on_request_vote(on_rv_false)
+        communicators[2].set_on_request_vote(on_rv_false)
+        t_start = time.monotonic()
+        assert await self.raft.request_votes(2, timeout=2) is False
+        assert time.monotonic() - t_start < 1
+        for communicator in communicators:
+            await communicator.close()
+
     @pytest.mark.asyncio
     async def test_old_candidate_rejected_by_newer_term(self, unused_tcp_port_factory):
         port_c, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
@@ -370,8 +441,8 @@ class TestConsensus:
         self.communicator_2 = HTTPCommunicator('candidate_2', port_2)
         await self.communicator_1.start()
         await self.communicator_2.start()
-        self.raft_1 = RaftConsensus(self.communicator_1, Registry([{'host': 'localhost', 'port': port_1, 'identifier': 'candidate_1'}]))
-        self.raft_2 = RaftConsensus(self.communicator_2, Registry([{'host': 'localhost', 'port': port_2, 'identifier': 'candidate_2'}]))
+        self.raft_1 = RaftConsensus(self.communicator_1, Registry([{'host': 'localhost', 'port': port_1, 'identifier': 'candidate_1'}]), pre_vote=False)
+        self.raft_2 = RaftConsensus(self.communicator_2, Registry([{'host': 'localhost', 'port': port_2, 'identifier': 'candidate_2'}]), pre_vote=False)
 
         self.raft_1.state = PeerState.CANDIDATE
         self.raft_2.state = PeerState.CANDIDATE
@@ -386,6 +457,71 @@ class TestConsensus:
         assert self.raft_1.state == PeerState.CANDIDATE
         assert self.raft_2.state == PeerState.CANDIDATE
 
+    @pytest.mark.asyncio
+    async def test_pre_vote_starts_election_without_changing_voters(self, unused_tcp_port_factory):
+        port_c, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_c = HTTPCommunicator('candidate', port_c)
+        self.communicator_f = HTTPCommunicator('follower', port_f)
+        await self.communicator_f.start()
+        self.raft_c = RaftConsensus(self.communicator_c, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_c, 'identifier': 'candidate'}]))
+        self.raft_c.term = 3
+        self.raft_f.term = 3
+
+        await self.raft_c.process_state()
+
+        assert self.raft_c.state == PeerState.CANDIDATE
+        assert self.raft_c.term == 4
+        assert self.raft_f.term == 3
+        assert self.raft_f.has_voted_in_term is False
+
+    @pytest.mark.asyncio
+    async def test_refused_pre_vote_keeps_term(self, unused_tcp_port_factory):
+        port_c, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_c = HTTPCommunicator('candidate', port_c)
+        self.communicator_f = HTTPCommunicator('follower', port_f)
+        await self.communicator_f.start()
+        self.raft_c = RaftConsensus(self.communicator_c, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_c, 'identifier': 'candidate'}]), min_timeout=5, max_timeout=6)
+        self.raft_c.term = 50
+        # The follower still hears from its leader
+        self.raft_f.on_heartbeat({'identifier': 'leader', 'term': 3})
+
+        await self.raft_c.process_state()
+
+        assert self.raft_c.state == PeerState.FOLLOWER
+        assert self.raft_c.term == 50
+        assert self.raft_f.term == 3
+        assert self.raft_f.known_leader == 'leader'
+
+    @pytest.mark.asyncio
+    async def test_candidate_losing_pre_vote_becomes_follower(self, unused_tcp_port_factory):
+        port_c, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_c = HTTPCommunicator('candidate', port_c)
+        self.communicator_f = HTTPCommunicator('follower', port_f)
+        await self.communicator_f.start()
+        self.raft_c = RaftConsensus(self.communicator_c, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_c, 'identifier': 'candidate'}]))
+        self.raft_c.state = PeerState.CANDIDATE
+        self.raft_c.term = 4
+        self.raft_f.term = 4
+        self.raft_f.log.append(4, 'newer')
+
+        await self.raft_c.process_state()
+
+        assert self.raft_c.state == PeerState.FOLLOWER
+        assert self.raft_c.term == 4
+
+    @pytest.mark.asyncio
+    async def test_leader_refuses_pre_vote(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        data = {'identifier': 'b', 'term': 1, 'pre_vote': True}
+        assert self.raft.on_request_vote(data) == (True, {'vote_granted': True})
+        assert self.raft.term == 0
+        self.raft.state = PeerState.LEADER
+        assert self.raft.on_request_vote(data) == (True, {'vote_granted': False})
+
     @pytest.mark.asyncio
     async def test_follower_will_vote_for_newer_term(self, unused_tcp_port_factory):
         port_1, port_2, port_3 = unused_tcp_port_factory(), unused_tcp_port_factory(), unused_tcp_port_factory()
@@ -521,3 +657,656 @@ class TestConsensus:
         assert self.raft.is_candidate() is False
         self.raft.state = PeerState.LEADER
         assert self.raft.is_candidate() is False
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_appends_entries_and_commits(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        applied = []
+        self.raft.on_apply = applied.append
+
+        data = {
+            'identifier': 'leader',
+            'term': 1,
+            'prev_index': 0,
+            'prev_term': 0,
+            'entries': [{'term': 1, 'data': 'x'}, {'term': 1, 'data': 'y'}],
+            'leader_commit': 1
+        }
+
+        assert self.raft.on_heartbeat(data) == (True, {'term': 1, 'success': True, 'match_index': 2})
+        assert self.raft.log.last_index() == 2
+        assert self.raft.commit_index == 1
+        await asyncio.sleep(0)
+        assert [entry.data for entry in applied] == ['x']
+
+    @pytest.mark.asyncio
+    async def test_resent_batch_does_not_lower_commit_index(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        entries = [{'term': 1, 'data': 'x'}, {'term': 1, 'data': 'y'}]
+        data = {'identifier': 'leader', 'term': 1, 'prev_index': 0, 'prev_term': 0,
+                'entries': entries, 'leader_commit': 2}
+        self.raft.on_heartbeat(data)
+        assert self.raft.commit_index == 2
+
+        # The leader resends a batch, capped below what we already committed
+        data = dict(data, entries=entries[:1], leader_commit=3)
+        assert self.raft.on_heartbeat(data) == (True, {'term': 1, 'success': True, 'match_index': 1})
+
+        assert self.raft.commit_index == 2
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_with_unknown_previous_entry_fails(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+
+        data = {'identifier': 'leader', 'term': 1, 'prev_index': 4, 'prev_term': 1, 'entries': []}
+
+        assert self.raft.on_heartbeat(data) == (True, {'term': 1, 'success': False, 'match_index': 0})
+        assert self.raft.got_heartbeat.is_set()
+
+    @pytest.mark.asyncio
+    async def test_stale_heartbeat_is_rejected_with_term(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        self.raft.term = 5
+
+        status, data = self.raft.on_heartbeat({'identifier': 'leader', 'term': 4})
+
+        assert status is False
+        assert data['term'] == 5
+        assert self.raft.got_heartbeat.is_set() is False
+
+    @pytest.mark.asyncio
+    async def test_leader_replicates_and_commits_entries(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_l = HTTPCommunicator('leader', port_l)
+        self.communicator_f = HTTPCommunicator('follower', port_f)
+        await self.communicator_f.start()
+        self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]))
+        # The follower holds a stale entry from an old term that must be replaced
+        self.raft_f.log.append(0, 'stale')
+
+        self.raft_l.term = 1
+        self.raft_l.become_leader()
+        self.raft_l.log.append(1, {'key': 'value'})
+
+        await self.raft_l.process_state()
+        assert self.raft_l.commit_index == 2
+        assert self.raft_l.match_index['follower'] == 2
+        assert [(e.term, e.data) for e in self.raft_f.log.entries] == [(1, None), (1, {'key': 'value'})]
+
+        await self.raft_l.process_state()
+        assert self.raft_f.commit_index == 2
+
+    @pytest.mark.asyncio
+    async def test_leader_backs_up_next_index_on_mismatch(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([{'host': 'localhost', 'port': 7001, 'identifier': 'b'}]))
+        for _ in range(10):
+            self.raft.log.append(0, 'x')
+        self.raft.become_leader()
+        assert self.raft.next_index['b'] == 11
+
+        self.raft.handle_append_response(self.raft.registry.peers[0], {'term': 0, 'success': False, 'match_index': 3})
+
+        assert self.raft.next_index['b'] == 4
+
+    @pytest.mark.asyncio
+    async def test_follower_refuses_vote_for_outdated_log(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        self.raft.term = 2
+        self.raft.log.append(2, 'x')
+
+        data = {'identifier': 'b', 'term': 3, 'last_log_index': 5, 'last_log_term': 1}
+
+        assert self.raft.on_request_vote(data) == (True, {'vote_granted': False})
+        assert self.raft.term == 3
+        assert self.raft.has_voted_in_term is False
+
+    @pytest.mark.asyncio
+    async def test_propose_on_follower_raises(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+
+        with pytest.raises(NotLeaderError):
+            await self.raft.propose({'op': 'noop'})
+
+    @pytest.mark.asyncio
+    async def test_proposal_cannot_change_membership(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        self.raft.term = 1
+        self.raft.become_leader()
+        members = [{'host': 'localhost', 'port': 7002, 'identifier': 'b', 'metadata': {}}]
+
+        with pytest.raises(ValueError):
+            await self.raft.propose({'membership': members})
+
+        assert self.raft.log.last_index() == 1
+        assert self.raft.membership_of({'op': 'put', 'membership': members}) is None
+        assert self.raft.membership_of({'membership': members}) == members
+
+    @pytest.mark.asyncio
+    async def test_proposals_in_window_are_batched(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]), batch_window=0.05)
+        self.raft.on_apply = lambda entry: entry.data * 10
+        self.raft.become_leader()
+
+        results = await asyncio.gather(*[self.raft.propose(i) for i in range(1, 4)])
+
+        assert results == [10, 20, 30]
+        assert [e.data for e in self.raft.log.entries] == [None, 1, 2, 3]
+        assert self.raft.commit_index == 4
+
+    @pytest.mark.asyncio
+    async def test_full_batch_is_flushed_early(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]), batch_window=10, max_batch_entries=2)
+        self.raft.become_leader()
+
+        results = await asyncio.wait_for(asyncio.gather(self.raft.propose('a'), self.raft.propose('b')), 1)
+
+        assert results == [None, None]
+        assert self.raft.log.last_index() == 3
+
+    @pytest.mark.asyncio
+    async def test_proposal_commits_on_majority(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_l = HTTPCommunicator('leader', port_l)
+        self.communicator_f = HTTPCommunicator('follower', port_f)
+        await self.communicator_f.start()
+        self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]))
+        self.raft_l.term = 1
+        self.raft_l.become_leader()
+
+        index = asyncio.ensure_future(self.raft_l.propose({'key': 'value'}))
+        while not self.raft_l._in_flight.get('follower'):
+            await asyncio.sleep(0.001)
+        # The batch is in flight and the next one would start after it
+        assert self.raft_l.next_index['follower'] == 3
+        await asyncio.wait_for(index, 1)
+
+        assert self.raft_l.commit_index == 2
+        assert self.raft_f.log.get(2).data == {'key': 'value'}
+
+    @pytest.mark.asyncio
+    async def test_lost_leadership_fails_pending_proposals(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([{'host': 'localhost', 'port': 7001, 'identifier': 'b'}]))
+        self.raft.become_leader()
+
+        proposal = asyncio.ensure_future(self.raft.propose('x'))
+        await asyncio.sleep(0.01)
+        self.raft.on_heartbeat({'identifier': 'b', 'term': 1})
+
+        with pytest.raises(NotLeaderError):
+            await proposal
+
+    def _leader_and_follower(self, port_l, port_f, **kwargs):
+        self.communicator_l = HTTPCommunicator('leader', port_l)
+        self.communicator_f = HTTPCommunicator('follower', port_f)
+        self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'follower'}]), **kwargs)
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]), **kwargs)
+        self.raft_l.term = 1
+        self.raft_l.become_leader()
+
+    @pytest.mark.asyncio
+    async def test_transfer_leadership_to_follower(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        await self.communicator_l.start()
+        await self.communicator_f.start()
+        self.raft_l.log.append(1, 'x')
+        # The follower still hears from the leader, which must not stop it
+        self.raft_f.on_heartbeat({'identifier': 'leader', 'term': 1})
+
+        assert await self.raft_l.transfer_leadership() is True
+
+        assert self.raft_f.log.last_index() == 2
+        assert self.raft_f.state == PeerState.CANDIDATE
+        assert self.raft_f.term == 2
+        self.raft_f.got_heartbeat.clear()
+        await self.raft_f.process_state()
+        assert self.raft_f.state == PeerState.LEADER
+        assert self.raft_l.state == PeerState.FOLLOWER
+        assert self.raft_l.term == 2
+
+    @pytest.mark.asyncio
+    async def test_transfer_leadership_refuses_proposals(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        self.raft_l.max_timeout = 0.05
+
+        transfer = asyncio.ensure_future(self.raft_l.transfer_leadership('follower'))
+        await asyncio.sleep(0)
+        with pytest.raises(NotLeaderError):
+            await self.raft_l.propose('x')
+        # The follower is down, so it never catches up
+        assert await transfer is False
+        assert self.raft_l.transfer_target is None
+        with pytest.raises(ValueError):
+            await self.raft_l.transfer_leadership('unknown')
+        with pytest.raises(NotLeaderError):
+            await self.raft_f.transfer_leadership()
+
+    @pytest.mark.asyncio
+    async def test_election_timeout_follows_round_trip_time(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]), min_timeout=0.1, max_timeout=0.2, max_election_timeout=2)
+        assert self.raft.heartbeat_interval == pytest.approx(0.1 / 3)
+
+        self.raft.record_rtt('b', 0.002)
+        assert self.raft.min_timeout == 0.1
+        for _ in range(20):
+            self.raft.record_rtt('c', 0.050)
+        assert 0.5 < self.raft.min_timeout < 1
+        assert self.raft.max_timeout == pytest.approx(self.raft.min_timeout * 2)
+        assert self.raft.heartbeat_interval == pytest.approx(self.raft.min_timeout / 3)
+        self.raft.record_rtt('d', 1)
+        assert self.raft.min_timeout == 2
+
+    @pytest.mark.asyncio
+    async def test_follower_adopts_leader_election_timeout(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        await self.communicator_f.start()
+        self.raft_l.set_election_timeout(0.6)
+
+        assert await self.raft_l.replicate_to(self.raft_l.registry.peers[0]) is True
+
+        assert self.raft_f.min_timeout == 0.6
+        assert self.raft_f.heartbeat_interval == pytest.approx(0.2)
+        assert 'follower' in self.raft_l._srtt
+
+    @pytest.mark.asyncio
+    async def test_heartbeats_feed_failure_detectors(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        await self.communicator_f.start()
+
+        for _ in range(3):
+            assert await self.raft_l.replicate_to(self.raft_l.registry.peers[0]) is True
+
+        assert self.raft_l.registry._detectors['follower'].count == 2
+        assert self.raft_f.registry._detectors['leader'].count == 2
+        assert self.raft_l.registry.is_available('follower')
+
+    @pytest.mark.asyncio
+    async def test_slow_follower_does_not_delay_heartbeats_to_others(self, unused_tcp_port_factory):
+        ports = [unused_tcp_port_factory() for _ in range(3)]
+        communicators = [HTTPCommunicator(name, port) for name, port in zip(['leader', 'slow', 'fast'], ports)]
+        for communicator in communicators[1:]:
+            await communicator.start()
+        self.raft_l = RaftConsensus(communicators[0], Registry([
+            {'host': 'localhost', 'port': ports[1], 'identifier': 'slow'},
+            {'host': 'localhost', 'port': ports[2], 'identifier': 'fast'}
+        ]), check_quorum=False)
+        self.raft_l.state = PeerState.LEADER
+        heartbeats = []
+
+        async def long_call(data):
+            await asyncio.sleep(0.5)
+
+        def on_heartbeat(data):
+            heartbeats.append(time.monotonic())
+            return True, {'term': data['term'], 'success': True, 'match_index': 0}
+
+        communicators[1].set_on_heartbeat(long_call)
+        communicators[2].set_on_heartbeat(on_heartbeat)
+
+        t_start = time.monotonic()
+        while time.monotonic() - t_start < 0.5:
+            await self.raft_l.process_state()
+
+        assert len(heartbeats) >= 8
+        assert max(b - a for a, b in zip(heartbeats, heartbeats[1:])) < 0.1
+        self.raft_l.step_down()
+        for communicator in communicators:
+            await communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_unreachable_follower_is_probed_less_often(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f, check_quorum=False, max_probe_interval=0.2)
+        attempts = []
+        real_replicate_to = self.raft_l.replicate_to
+
+        async def replicate_to(peer, reliable=False):
+            attempts.append(time.monotonic())
+            return await real_replicate_to(peer, reliable)
+
+        self.raft_l.replicate_to = replicate_to
+
+        # The follower is down, so it never responds
+        t_start = time.monotonic()
+        while time.monotonic() - t_start < 1:
+            await self.raft_l.process_state()
+
+        intervals = [b - a for a, b in zip(attempts, attempts[1:])]
+        assert len(attempts) < 1 / self.raft_l.heartbeat_interval / 2
+        assert intervals[-1] == pytest.approx(0.2, abs=0.05)
+        self.raft_l.step_down()
+
+    @pytest.mark.asyncio
+    async def test_membership_entries_take_effect_when_appended(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([{'host': 'localhost', 'port': 7001, 'identifier': 'b'}]))
+        members = self.raft.membership() + [{'host': 'localhost', 'port': 7002, 'identifier': 'c', 'metadata': {}}]
+
+        self.raft.on_heartbeat({'identifier': 'b', 'term': 1, 'prev_index': 0, 'prev_term': 0,
+                                'entries': [{'term': 1, 'data': None}, {'term': 1, 'data': {'membership': members}}]})
+        assert self.raft.registry.get_peer_by_identifier('c').port == 7002
+        assert self.raft.membership_at(1) != members
+
+        # A new leader replaces the entry before it is committed
+        self.raft.on_heartbeat({'identifier': 'b', 'term': 2, 'prev_index': 1, 'prev_term': 1,
+                                'entries': [{'term': 2, 'data': None}]})
+        assert self.raft.registry.get_peer_by_identifier('c') is None
+        assert [peer.identifier for peer in self.raft.registry.peers] == ['b']
+
+    @pytest.mark.asyncio
+    async def test_leader_removing_itself_steps_down(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        await self.communicator_f.start()
+
+        await self.raft_l.remove_peer('leader')
+
+        assert self.raft_l.state == PeerState.FOLLOWER
+        assert self.raft_l.is_member is False
+        assert [member['identifier'] for member in self.raft_f.membership()] == ['follower']
+        assert self.raft_f.registry.get_peer_count() == 0
+        with pytest.raises(NotLeaderError):
+            await self.raft_l.add_peer('localhost', port_l, 'leader')
+        await self.communicator_f.close()
+
+    @pytest.mark.asyncio
+    async def test_learner_follows_without_voting(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self.communicator_l = HTTPCommunicator('leader', port_l)
+        self.communicator_f = HTTPCommunicator('learner', port_f)
+        await self.communicator_f.start()
+        self.raft_l = RaftConsensus(self.communicator_l, Registry([{'host': 'localhost', 'port': port_f, 'identifier': 'learner', 'learner': True}]))
+        self.raft_f = RaftConsensus(self.communicator_f, Registry([{'host': 'localhost', 'port': port_l, 'identifier': 'leader'}]),
+                                    min_timeout=0.05, max_timeout=0.1, learner=True)
+
+        # A learner never starts an election
+        await self.raft_f.process_state()
+        assert self.raft_f.state == PeerState.LEARNER
+        assert self.raft_f.term == 0
+
+        # The learner does not count towards the majority
+        self.raft_l.term = 1
+        self.raft_l.become_leader()
+        assert self.raft_l.commit_index == 1
+        assert await self.raft_l.replicate_to(self.raft_l.registry.peers[0]) is True
+        assert self.raft_f.state == PeerState.LEARNER
+        assert self.raft_f.known_leader == 'leader'
+        assert self.raft_f.commit_index == 1
+        assert self.raft_f.on_request_vote({'identifier': 'leader', 'term': 5}) == (True, {'vote_granted': False})
+
+        # Adding it again as a voter promotes it
+        await self.raft_l.add_peer('localhost', port_f, 'learner')
+        assert self.raft_l.registry.get_voter_count() == 1
+        assert self.raft_f.state == PeerState.FOLLOWER
+        assert self.raft_f.is_voter
+        self.raft_l.step_down()
+        await self.communicator_f.close()
+
+    @pytest.mark.asyncio
+    async def test_isolated_leader_steps_down(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f, min_timeout=0.05, max_timeout=0.1)
+        proposal = asyncio.ensure_future(self.raft_l.propose('x'))
+
+        # The follower is down, so it never responds
+        while self.raft_l.is_leader():
+            await self.raft_l.process_state()
+
+        assert self.raft_l.state == PeerState.FOLLOWER
+        assert self.raft_l.known_leader is None
+        assert self.raft_l.term == 1
+        with pytest.raises(NotLeaderError):
+            await proposal
+
+    @pytest.mark.asyncio
+    async def test_leader_with_quorum_stays_leader(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f, min_timeout=0.05, max_timeout=0.1)
+        await self.communicator_f.start()
+
+        t_start = time.monotonic()
+        while time.monotonic() - t_start < 0.3:
+            await self.raft_l.process_state()
+
+        assert self.raft_l.is_leader()
+        assert self.raft_l.has_quorum()
+
+    @pytest.mark.asyncio
+    async def test_read_index_on_follower_raises(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+
+        with pytest.raises(NotLeaderError):
+            await self.raft.read_index()
+
+    @pytest.mark.asyncio
+    async def test_read_index_confirms_leadership(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        await self.communicator_f.start()
+
+        read_index = await self.raft_l.read_index()
+
+        assert read_index == 1
+        assert self.raft_l.last_applied >= read_index
+
+    @pytest.mark.asyncio
+    async def test_read_index_without_majority_raises(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+
+        with pytest.raises(NotLeaderError):
+            await self.raft_l.read_index()
+
+    @pytest.mark.asyncio
+    async def test_lease_expires_after_election_timeout(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f, min_timeout=0.1, max_timeout=0.2)
+        await self.communicator_f.start()
+        assert self.raft_l.has_lease() is False
+
+        assert await self.raft_l.confirm_leadership()
+        assert self.raft_l.has_lease()
+        assert await self.raft_l.lease_read() == self.raft_l.commit_index
+
+        await asyncio.sleep(0.1)
+        assert self.raft_l.has_lease() is False
+
+    @pytest.mark.asyncio
+    async def test_transfer_leadership_revokes_the_lease(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f)
+        await self.communicator_l.start()
+        await self.communicator_f.start()
+        # The follower answers TimeoutNow without winning, so we stay leader
+        self.raft_f.on_timeout_now = Mock(return_value=(True, {'success': True}))
+        self.communicator_f.set_on_timeout_now(self.raft_f.on_timeout_now)
+        assert await self.raft_l.confirm_leadership()
+        assert self.raft_l.has_lease()
+
+        assert await self.raft_l.transfer_leadership('follower') is True
+
+        assert self.raft_l.is_leader()
+        assert await self.raft_l.confirm_leadership()
+        assert self.raft_l.has_lease() is False
+        with patch.object(self.raft_l, 'read_index', wraps=self.raft_l.read_index) as read_index:
+            assert await self.raft_l.lease_read() == self.raft_l.commit_index
+        read_index.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_follower_with_recent_leader_declines_votes(self, unused_tcp_port):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        self.raft = RaftConsensus(self.communicator, Registry([]))
+        self.raft.on_heartbeat({'identifier': 'leader', 'term': 2})
+
+        result = self.raft.on_request_vote({'identifier': 'b', 'term': 3})
+
+        assert result == (True, {'vote_granted': False})
+        assert self.raft.term == 2
+        assert self.raft.known_leader == 'leader'
+
+    @pytest.mark.asyncio
+    async def test_vote_is_recovered_from_storage(self, unused_tcp_port, tmp_path):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        wal = WriteAheadLog(str(tmp_path))
+        self.raft = RaftConsensus(self.communicator, Registry([]), storage=wal)
+        self.raft.recover()
+        self.raft.log.append(1, 'x')
+
+        result = await self.raft.handle_request_vote({'identifier': 'b', 'term': 4, 'last_log_index': 1, 'last_log_term': 1})
+        assert result == (True, {'vote_granted': True})
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path))
+        self.raft = RaftConsensus(self.communicator, Registry([]), storage=wal)
+        self.raft.recover()
+        assert self.raft.term == 4
+        assert self.raft.voted_for == 'b'
+        assert self.raft.log.last_index() == 1
+        result = self.raft.on_request_vote({'identifier': 'c', 'term': 4, 'last_log_index': 1, 'last_log_term': 1})
+        assert result == (True, {'vote_granted': False})
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_leader_commits_once_durable(self, unused_tcp_port, tmp_path):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        wal = WriteAheadLog(str(tmp_path))
+        self.raft = RaftConsensus(self.communicator, Registry([]), storage=wal)
+        self.raft.recover()
+        self.raft.term = 1
+        self.raft.become_leader()
+        assert self.raft.commit_index == 0
+
+        result = await self.raft.propose({'op': 'put'})
+
+        assert result is None
+        assert self.raft.commit_index == 2
+        assert wal.durable_index == 2
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_lazy_recovery_answers_votes_before_restoring(self, unused_tcp_port, tmp_path):
+        wal = WriteAheadLog(str(tmp_path / 'wal'))
+        wal.open()
+        wal.save_state(2, None)
+        for index in range(1, 5):
+            wal.append(index, 2, index)
+        await wal.sync()
+        wal.close()
+        store = SnapshotStore(str(tmp_path / 'snapshots'))
+        store.save(Snapshot(3, 2, b'state'))
+
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        wal = WriteAheadLog(str(tmp_path / 'wal'))
+        self.raft = RaftConsensus(self.communicator, Registry([]), storage=wal,
+                                  snapshot_store=store, lazy_recovery=True)
+        restored = []
+        self.raft.set_on_restore(restored.append)
+        self.raft.recover()
+        assert not self.raft.state_restored.is_set()
+        assert self.raft.log.last_index() == 4
+        result = self.raft.on_request_vote({'identifier': 'b', 'term': 3, 'last_log_index': 4, 'last_log_term': 2})
+        assert result == (True, {'vote_granted': True})
+        assert restored == []
+
+        await self.raft._restore_task
+        assert restored == [b'state']
+        assert self.raft.state_restored.is_set()
+        assert self.raft.last_applied == 3
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_lagging_follower_receives_snapshot(self, unused_tcp_port_factory):
+        port_l, port_f = unused_tcp_port_factory(), unused_tcp_port_factory()
+        self._leader_and_follower(port_l, port_f, snapshot_threshold=3, snapshot_chunk_size=4)
+        await self.communicator_f.start()
+        applied = []
+        self.raft_l.set_on_apply(lambda entry: applied.append(entry.data))
+        self.raft_l.set_on_snapshot(lambda: repr(applied).encode())
+        restored = []
+        self.raft_f.set_on_restore(restored.append)
+        # The follower misses every entry until the leader compacted them
+        self.raft_l.next_index['follower'] = 1
+        self.raft_l.match_index['follower'] = 0
+        for i in range(3):
+            self.raft_l.log.append(1, i)
+        self.raft_l.commit_index = self.raft_l.log.last_index()
+        self.raft_l.apply_committed()
+        await self.raft_l._snapshot_task
+        assert self.raft_l.log.snapshot_index == 4
+
+        assert await self.raft_l.replicate_to(self.raft_l.registry.peers[0]) is False
+        await self.raft_l._snapshot_senders['follower']
+
+        assert restored == [b'[0, 1, 2]']
+        assert self.raft_f.last_applied == 4
+        assert self.raft_f.log.last_index() == 4
+        assert self.raft_l.match_index['follower'] == 4
+        assert self.raft_l.next_index['follower'] == 5
+
+
+    @pytest.mark.asyncio
+    async def test_conflicting_snapshot_replaces_the_log_after_restart(self, unused_tcp_port, tmp_path):
+        self.communicator = HTTPCommunicator('a', unused_tcp_port)
+        wal = WriteAheadLog(str(tmp_path / 'wal'))
+        store = SnapshotStore(str(tmp_path / 'snapshots'))
+        self.raft = RaftConsensus(self.communicator, Registry([]), storage=wal, snapshot_store=store)
+        self.raft.recover()
+        self.raft.term = 2
+        for i in range(5):
+            self.raft.log.append(2, i)
+
+        data = {'identifier': 'leader', 'term': 3, 'last_index': 3, 'last_term': 3,
+                'offset': 0, 'done': True}
+        assert await self.raft.on_install_snapshot(data, b'state') == \
+            (True, {'term': 3, 'success': True, 'match_index': 3})
+        assert self.raft.log.last_index() == 3
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path / 'wal'))
+        self.raft = RaftConsensus(self.communicator, Registry([]), storage=wal, snapshot_store=store)
+        self.raft.recover()
+        assert (self.raft.log.snapshot_index, self.raft.log.snapshot_term) == (3, 3)
+        assert self.raft.log.last_index() == 3
+        assert self.raft.log.entries == []
+        wal.close()
+
+
+class TestElectionTimer:
+
+    @pytest.mark.asyncio
+    async def test_reset_pushes_the_deadline_back(self):
+        timer = ElectionTimer(lambda: 0.1)
+        loop = asyncio.get_running_loop()
+        t_start = loop.time()
+        waiter = asyncio.ensure_future(timer.wait())
+        await asyncio.sleep(0.05)
+        timer.reset()
+        await waiter
+        assert loop.time() - t_start >= 0.15
+        assert timer.deadline is None
+
+    @pytest.mark.asyncio
+    async def test_expire_wakes_the_waiter(self):
+        timer = ElectionTimer(lambda: 10)
+        waiter = asyncio.ensure_future(timer.wait())
+        await asyncio.sleep(0)
+        timer.expire()
+        await asyncio.wait_for(waiter, 1)
@@ -0,0 +1,141 @@
+import pytest
+import asyncio
+from unittest.mock import Mock
+
+from qcluster.communication import HTTPCommunicator
+from qcluster.gossip import Gossip, MemberStatus
+from qcluster.registry import Registry
+
+
+def update(identifier, status, incarnation, port=7002):
+    return {'identifier': identifier, 'host': 'localhost', 'port': port,
+            'status': status.value, 'incarnation': incarnation}
+
+
+def mock_communicator(identifier='a'):
+    communicator = Mock()
+    communicator.identifier = identifier
+    communicator.listen_host = 'localhost'
+    communicator.listen_port = 7001
+    return communicator
+
+
+class TestGossip:
+
+    @pytest.mark.asyncio
+    async def test_merge_rules(self):
+        gossip = Gossip(mock_communicator(), Registry([]))
+
+        gossip.merge(update('b', MemberStatus.ALIVE, 1))
+        assert gossip.status('b') == MemberStatus.ALIVE
+        # An alive member is suspected at the same incarnation
+        gossip.merge(update('b', MemberStatus.SUSPECT, 1))
+        assert gossip.status('b') == MemberStatus.SUSPECT
+        # Only a newer incarnation refutes the suspicion
+        gossip.merge(update('b', MemberStatus.ALIVE, 1))
+        assert gossip.status('b') == MemberStatus.SUSPECT
+        gossip.merge(update('b', MemberStatus.ALIVE, 2))
+        assert gossip.status('b') == MemberStatus.ALIVE
+        # Older news is ignored
+        gossip.merge(update('b', MemberStatus.SUSPECT, 1))
+        gossip.merge(update('b', MemberStatus.DEAD, 1))
+        assert gossip.status('b') == MemberStatus.ALIVE
+        gossip.merge(update('b', MemberStatus.DEAD, 2))
+        assert gossip.status('b') == MemberStatus.DEAD
+        gossip.merge(update('b', MemberStatus.SUSPECT, 3))
+        assert gossip.status('b') == MemberStatus.DEAD
+        # A restarted member comes back with a newer incarnation
+        gossip.merge(update('b', MemberStatus.ALIVE, 3))
+        assert gossip.status('b') == MemberStatus.ALIVE
+        assert gossip.status('c') is None
+
+    @pytest.mark.asyncio
+    async def test_suspicion_of_self_is_refuted(self):
+        gossip = Gossip(mock_communicator(), Registry([]))
+
+        gossip.merge(update('a', MemberStatus.SUSPECT, 0, port=7001))
+
+        assert gossip.incarnation == 1
+        assert gossip.status('a') == MemberStatus.ALIVE
+        assert gossip.piggyback() == [update('a', MemberStatus.ALIVE, 1, port=7001)]
+
+    @pytest.mark.asyncio
+    async def test_updates_are_piggybacked_a_bounded_number_of_times(self):
+        gossip = Gossip(mock_communicator(), Registry([]), max_piggyback=2)
+        for identifier in 'bcd':
+            gossip.merge(update(identifier, MemberStatus.ALIVE, 0))
+
+        sent = [gossip.piggyback() for _ in range(10)]
+
+        assert all(len(updates) <= 2 for updates in sent)
+        counts = {identifier: sum(u['identifier'] == identifier for updates in sent for u in updates)
+                  for identifier in 'bcd'}
+        assert counts == {identifier: gossip.retransmit_limit() for identifier in 'bcd'}
+        assert gossip.piggyback() == []
+
+    @pytest.mark.asyncio
+    async def test_unreachable_member_is_suspected_then_dead(self):
+        communicator = mock_communicator()
+
+        async def gossip_message(host, port, data, timeout=1):
+            if port == 7002:
+                return False, None
+            return True, {'type': 'ack', 'identifier': 'c', 'host': host,
+                          'port': port, 'incarnation': 0, 'ack': False}
+        communicator.gossip = Mock(side_effect=gossip_message)
+        registry = Registry([{'host': 'localhost', 'port': 7002, 'identifier': 'b'},
+                             {'host': 'localhost', 'port': 7003, 'identifier': 'c'}])
+        gossip = Gossip(communicator, registry, protocol_period=0.01, suspicion_multiplier=2)
+        gossip.sync_registry()
+
+        assert await gossip.probe(gossip.members['b']) is False
+        assert gossip.status('b') == MemberStatus.SUSPECT
+        # The other member was asked to probe it
+        assert communicator.gossip.call_args[0][1] == 7003
+        assert communicator.gossip.call_args[0][2]['type'] == 'ping_req'
+
+        await asyncio.sleep(gossip.suspicion_timeout())
+        gossip.expire_suspects()
+        assert gossip.status('b') == MemberStatus.DEAD
+        assert gossip.status('c') == MemberStatus.ALIVE
+        assert [member.identifier for member in gossip.alive_members()] == ['c']
+
+    @pytest.mark.asyncio
+    async def test_views_converge(self, unused_tcp_port_factory):
+        ports = [unused_tcp_port_factory() for _ in range(4)]
+        seed = [{'host': 'localhost', 'port': ports[0], 'identifier': 'n0'}]
+        communicators, nodes = [], []
+        for i, port in enumerate(ports):
+            communicator = HTTPCommunicator('n{}'.format(i), port)
+            await communicator.start()
+            gossip = Gossip(communicator, Registry(seed if i else []),
+                            protocol_period=0.05, suspicion_multiplier=2)
+            communicator.set_on_gossip(gossip.on_gossip)
+            asyncio.get_event_loop().create_task(gossip.start())
+            communicators.append(communicator)
+            nodes.append(gossip)
+
+        identifiers = {'n{}'.format(i) for i in range(4)}
+
+        def converged():
+            return all({member.identifier for member in node.alive_members()} == identifiers - {node.identifier}
+                       for node in nodes)
+        for _ in range(100):
+            if converged():
+                break
+            await asyncio.sleep(0.05)
+        assert converged()
+
+        # A failed member is declared dead by everyone
+        nodes[3].stop()
+        await communicators[3].close()
+        for _ in range(100):
+            if all(node.status('n3') == MemberStatus.DEAD for node in nodes[:3]):
+                break
+            await asyncio.sleep(0.05)
+        assert all(node.status('n3') == MemberStatus.DEAD for node in nodes[:3])
+        assert all(node.status('n0') == MemberStatus.ALIVE for node in nodes[1:3])
+
+        for node, communicator in zip(nodes[:3], communicators[:3]):
+            node.stop()
+            await communicator.close()
@@ -0,0 +1,92 @@
+from qcluster.log import RaftLog, LogEntry
+
+
+class TestRaftLog:
+
+    def test_log_starts_empty(self):
+        log = RaftLog()
+        assert log.last_index() == 0
+        assert log.last_term() == 0
+        assert log.term_at(0) == 0
+        assert log.term_at(1) is None
+
+    def test_append_assigns_indexes(self):
+        log = RaftLog()
+        assert log.append(1, 'a') == 1
+        assert log.append(2, 'b') == 2
+        assert log.last_index() == 2
+        assert log.last_term() == 2
+        assert log.get(1) == LogEntry(1, 1, 'a')
+
+    def test_entries_from(self):
+        log = RaftLog()
+        for i in range(5):
+            log.append(1, i)
+        assert [e.data for e in log.entries_from(3)] == [2, 3, 4]
+        assert [e.data for e in log.entries_from(2, max_entries=2)] == [1, 2]
+        assert log.entries_from(6) == []
+
+    def test_append_entries_rejects_missing_previous_entry(self):
+        log = RaftLog()
+        assert log.append_entries(1, 1, [{'term': 1, 'data': 'a'}]) is False
+        assert log.last_index() == 0
+
+    def test_append_entries_rejects_previous_term_mismatch(self):
+        log = RaftLog()
+        log.append(1, 'a')
+        assert log.append_entries(1, 2, [{'term': 2, 'data': 'b'}]) is False
+        assert log.last_index() == 1
+
+    def test_append_entries_removes_conflicts(self):
+        log = RaftLog()
+        log.append(1, 'a')
+        log.append(1, 'b')
+        log.append(1, 'c')
+        assert log.append_entries(1, 1, [{'term': 2, 'data': 'x'}]) is True
+        assert [(e.term, e.data) for e in log.entries] == [(1, 'a'), (2, 'x')]
+
+    def test_append_entries_is_idempotent(self):
+        log = RaftLog()
+        entries = [{'term': 1, 'data': 'a'}, {'term': 1, 'data': 'b'}]
+        assert log.append_entries(0, 0, entries)
+        assert log.append_entries(0, 0, entries[:1])
+        assert log.last_index() == 2
+
+    def test_is_up_to_date(self):
+        log = RaftLog()
+        log.append(1, 'a')
+        log.append(2, 'b')
+        assert log.is_up_to_date(2, 2)
+        assert log.is_up_to_date(1, 3)
+        assert log.is_up_to_date(5, 1) is False
+        assert log.is_up_to_date(1, 2) is False
+
+    def test_compact_keeps_following_entries(self):
+        log = RaftLog()
+        for term in (1, 1, 2, 2):
+            log.append(term, term)
+        log.compact(2, 1)
+        assert log.last_index() == 4
+        assert log.term_at(2) == 1
+        assert log.term_at(1) is None
+        assert log.get(3) == LogEntry(3, 2, 2)
+        assert [e.index for e in log.entries_from(1)] == [3, 4]
+        assert log.append(3, 'x') == 5
+
+    def test_compact_replaces_a_conflicting_log(self):
+        log = RaftLog()
+        log.append(1, 'a')
+        log.compact(5, 3)
+        assert log.last_index() == 5
+        assert log.last_term() == 3
+        assert log.entries == []
+
+    def test_append_entries_across_the_snapshot(self):
+        log = RaftLog()
+        for i in range(3):
+            log.append(1, i)
+        log.compact(3, 1)
+        entries = [{'term': 1, 'data': i} for i in range(2, 5)]
+        assert log.append_entries(1, 1, entries)
+        assert [e.data for e in log.entries] == [4]
+        assert log.last_index() == 4
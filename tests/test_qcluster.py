@@ -1,6 +1,9 @@
+import asyncio
 import pytest
 
-from qcluster import QCluster
+from qcluster import QCluster, NotLeaderError, MemberStatus
+from qcluster.communication import TCPCommunicator
+from qcluster.consensus import PeerState
 
 
 class TestQCluster:
@@ -9,3 +12,145 @@ class TestQCluster:
     async def test_qcluster(self, unused_tcp_port):
         cluster = QCluster('test_identifier', unused_tcp_port)
         assert cluster.is_leader() is False
+
+    @pytest.mark.asyncio
+    async def test_qcluster_tcp_transport(self, unused_tcp_port):
+        cluster = QCluster('test_identifier', listen_port=unused_tcp_port, transport='tcp')
+        assert isinstance(cluster.communicator, TCPCommunicator)
+        assert cluster.is_leader() is False
+
+    @pytest.mark.asyncio
+    async def test_key_value_store_on_single_peer(self, unused_tcp_port):
+        cluster = QCluster('a', listen_port=unused_tcp_port)
+        while not cluster.is_leader():
+            await asyncio.sleep(0.05)
+
+        await cluster.put('color', 'blue')
+        assert await cluster.get('color') == 'blue'
+        assert await cluster.compare_and_set('color', 'red', 'green') is False
+        assert await cluster.compare_and_set('color', 'blue', 'green') is True
+        assert await cluster.get('color') == 'green'
+        assert await cluster.delete('color') is True
+        assert await cluster.get('color') is None
+        await cluster.put('size', 3)
+        assert await cluster.get('size', consistency='read_index') == 3
+        assert await cluster.get('size', consistency='lease') == 3
+        with pytest.raises(ValueError):
+            await cluster.get('size', consistency='eventual')
+        cluster.raft.state = PeerState.TERMINATING
+
+    @pytest.mark.asyncio
+    async def test_writes_on_follower_raise(self, unused_tcp_port):
+        cluster = QCluster('a', listen_port=unused_tcp_port, peers=[{'host': 'localhost', 'port': 1, 'identifier': 'b'}])
+        with pytest.raises(NotLeaderError):
+            await cluster.put('color', 'blue')
+        with pytest.raises(ValueError):
+            await cluster.put(5, 'blue')
+        with pytest.raises(NotLeaderError):
+            await cluster.get('color', consistency='read_index')
+
+    @pytest.mark.asyncio
+    async def test_restart_from_state_dir(self, unused_tcp_port_factory, tmp_path):
+        cluster = QCluster('a', listen_port=unused_tcp_port_factory(), state_dir=str(tmp_path), snapshot_threshold=3)
+        cluster.set_on_snapshot(lambda: 'application state')
+        while not cluster.is_leader():
+            await asyncio.sleep(0.05)
+        for i in range(3):
+            await cluster.put(str(i), i)
+        await cluster.raft._snapshot_task
+        await cluster.put('after', True)
+        cluster.raft.state = PeerState.TERMINATING
+        await cluster.communicator.close()
+        cluster.wal.close()
+
+        restored = []
+        cluster = QCluster('a', listen_port=unused_tcp_port_factory(), state_dir=str(tmp_path))
+        cluster.set_on_restore(restored.append)
+        await asyncio.sleep(0)
+        assert restored == ['application state']
+        assert await cluster.get('1') == 1
+        assert await cluster.get('2') is None
+        assert cluster.raft.log.snapshot_index == 3
+        while not cluster.is_leader():
+            await asyncio.sleep(0.05)
+        await cluster.put('again', True)
+        assert await cluster.get('2') == 2
+        assert await cluster.get('after') is True
+        cluster.raft.state = PeerState.TERMINATING
+        await cluster.communicator.close()
+        cluster.wal.close()
+
+    @pytest.mark.asyncio
+    async def test_transfer_leadership_on_follower_raises(self, unused_tcp_port):
+        cluster = QCluster('a', listen_port=unused_tcp_port)
+        with pytest.raises(NotLeaderError):
+            await cluster.transfer_leadership('b')
+
+    @pytest.mark.asyncio
+    async def test_join_running_cluster(self, unused_tcp_port_factory):
+        port_a, port_b = unused_tcp_port_factory(), unused_tcp_port_factory()
+        cluster_a = QCluster('a', listen_port=port_a)
+        while not cluster_a.is_leader():
+            await asyncio.sleep(0.05)
+        await cluster_a.put('color', 'blue')
+
+        cluster_b = QCluster('b', listen_port=port_b, peers=[{'host': 'localhost', 'port': port_a, 'identifier': 'a'}])
+        await asyncio.sleep(0)
+        assert await cluster_b.join() is True
+        assert cluster_a.registry.get_peer_by_identifier('b') is not None
+        assert cluster_b.get_leader_info().identifier == 'a'
+        assert await cluster_b.get('color') == 'blue'
+
+        await cluster_a.remove_peer('b')
+        assert cluster_a.registry.get_peer_count() == 0
+        with pytest.raises(NotLeaderError):
+            await cluster_b.remove_peer('a')
+        for cluster in (cluster_a, cluster_b):
+            cluster.raft.state = PeerState.TERMINATING
+            await cluster.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_join_as_learner(self, unused_tcp_port_factory):
+        port_a, port_b = unused_tcp_port_factory(), unused_tcp_port_factory()
+        cluster_a = QCluster('a', listen_port=port_a)
+        while not cluster_a.is_leader():
+            await asyncio.sleep(0.05)
+
+        cluster_b = QCluster('b', listen_port=port_b, learner=True,
+                             peers=[{'host': 'localhost', 'port': port_a, 'identifier': 'a'}])
+        await asyncio.sleep(0)
+        assert await cluster_b.join() is True
+        assert cluster_a.registry.get_voter_count() == 0
+        await cluster_a.put('color', 'blue')
+        for _ in range(20):
+            if await cluster_b.get('color') == 'blue':
+                break
+            await asyncio.sleep(0.05)
+        assert await cluster_b.get('color') == 'blue'
+        assert cluster_b.is_learner()
+        assert cluster_b.get_leader_info().identifier == 'a'
+        for cluster in (cluster_a, cluster_b):
+            cluster.raft.state = PeerState.TERMINATING
+            await cluster.communicator.close()
+
+    @pytest.mark.asyncio
+    async def test_member_status_through_gossip(self, unused_tcp_port_factory):
+        port_a, port_b = unused_tcp_port_factory(), unused_tcp_port_factory()
+        cluster_a = QCluster('a', listen_port=port_a, gossip=True, gossip_period=0.02,
+                             peers=[{'host': 'localhost', 'port': port_b, 'identifier': 'b'}])
+        await asyncio.sleep(0.1)
+        assert cluster_a.get_member_status('b') in (MemberStatus.SUSPECT, MemberStatus.DEAD)
+
+        cluster_b = QCluster('b', listen_port=port_b, gossip=True, gossip_period=0.02,
+                             peers=[{'host': 'localhost', 'port': port_a, 'identifier': 'a'}])
+        for _ in range(50):
+            if cluster_a.get_member_status('b') == MemberStatus.ALIVE:
+                break
+            await asyncio.sleep(0.02)
+        assert cluster_a.get_member_status('b') == MemberStatus.ALIVE
+        assert cluster_b.get_member_status('a') == MemberStatus.ALIVE
+        assert cluster_b.get_member_status('c') is None
+        for cluster in (cluster_a, cluster_b):
+            cluster.gossip.stop()
+            cluster.raft.state = PeerState.TERMINATING
+            await cluster.communicator.close()
@@ -0,0 +1,113 @@
+import pytest
+
+from qcluster.registry import Peer, PhiAccrualDetector, Registry
+
+
+class TestRegistry:
+
+    def test_lookups(self):
+        registry = Registry([
+            {'host': 'localhost', 'port': 7001, 'identifier': 'a'},
+            {'host': 'localhost', 'port': '7002', 'identifier': 'b', 'metadata': {'zone': 1}}
+        ])
+
+        assert registry.get_peer_count() == 2
+        assert [peer.identifier for peer in registry.peers] == ['a', 'b']
+        assert registry.get_peer_by_identifier('b').metadata == {'zone': 1}
+        assert registry.get_peer_by_identifier('c') is None
+        assert registry.get_peer_by_address('localhost', 7002).identifier == 'b'
+        assert registry.get_peer_by_address('localhost', 7003) is None
+
+    def test_invalid_and_duplicate_peers_are_skipped(self):
+        registry = Registry([
+            {'host': 'localhost', 'port': 7001, 'identifier': 'a'},
+            {'host': 'localhost', 'port': 7002, 'identifier': 'a'},
+            {'host': 'localhost', 'identifier': 'b'},
+            {'host': 'localhost', 'port': 7003, 'identifier': 'c', 'metadata': []}
+        ])
+
+        assert [peer.identifier for peer in registry.peers] == ['a']
+        assert registry.get_peer_by_address('localhost', 7002) is None
+
+    def test_peer_has_no_instance_dictionary(self):
+        peer = Peer('localhost', 7001, 'a', {})
+
+        with pytest.raises(AttributeError):
+            peer.extra = True
+
+    def test_add_and_remove_peers(self):
+        registry = Registry([{'host': 'localhost', 'port': 7001, 'identifier': 'a'}])
+
+        peer = registry.add_peer({'host': 'localhost', 'port': 7002, 'identifier': 'b'})
+        assert registry.get_peer_by_address('localhost', 7002) is peer
+        assert registry.add_peer({'host': 'localhost', 'port': 7003, 'identifier': 'b'}) is None
+        assert registry.remove_peer('a').identifier == 'a'
+        assert registry.remove_peer('a') is None
+        assert [peer.identifier for peer in registry.peers] == ['b']
+        assert registry.get_peer_by_identifier('a') is None
+        assert registry.get_peer_by_address('localhost', 7001) is None
+        assert peer.to_dict() == {'host': 'localhost', 'port': 7002, 'identifier': 'b', 'metadata': {}}
+
+    def test_learners_are_not_voters(self):
+        registry = Registry([
+            {'host': 'localhost', 'port': 7001, 'identifier': 'a'},
+            {'host': 'localhost', 'port': 7002, 'identifier': 'b', 'learner': True}
+        ])
+
+        assert registry.get_peer_count() == 2
+        assert [peer.identifier for peer in registry.voters] == ['a']
+        assert registry.get_peer_by_identifier('b').to_dict()['learner'] is True
+        registry.set_learner('b', False)
+        assert registry.get_voter_count() == 2
+        registry.remove_peer('a')
+        assert [peer.identifier for peer in registry.voters] == ['b']
+
+
+class TestPhiAccrualDetector:
+
+    def test_phi_grows_with_silence(self):
+        detector = PhiAccrualDetector()
+        assert detector.phi(now=0) == 0.0
+        for beat in range(10):
+            detector.heartbeat(now=beat * 0.05)
+        last = 9 * 0.05
+
+        assert detector.phi(now=last) < 0.5
+        assert detector.phi(now=last + 0.3) < detector.phi(now=last + 0.6) < detector.phi(now=last + 1)
+        assert detector.phi(now=last + 1) > 8
+        assert detector.phi(now=last + 1000) > 8
+
+    def test_jittery_link_is_suspected_later(self):
+        steady = PhiAccrualDetector(min_std_deviation=0.01)
+        jittery = PhiAccrualDetector(min_std_deviation=0.01)
+        for beat in range(20):
+            steady.heartbeat(now=beat * 0.5)
+            jittery.heartbeat(now=beat * 0.5 + (0.3 if beat % 2 else -0.3))
+
+        assert steady.phi(now=steady.last_arrival + 1) > jittery.phi(now=jittery.last_arrival + 1)
+
+    def test_window_has_fixed_size(self):
+        detector = PhiAccrualDetector(window_size=4)
+        for beat in range(100):
+            detector.heartbeat(now=beat * 10.0)
+        for beat in range(4):
+            detector.heartbeat(now=990 + beat + 1)
+
+        assert len(detector.intervals) == 4
+        assert detector.count == 4
+        assert detector.total == pytest.approx(4)
+        # Only the last intervals count, so a second of silence is unusual
+        assert detector.phi(now=detector.last_arrival + 3) > 8
+
+    def test_registry_tracks_known_peers(self):
+        registry = Registry([{'host': 'localhost', 'port': 7001, 'identifier': 'a'}])
+        for beat in range(5):
+            registry.record_heartbeat('a', now=beat)
+            registry.record_heartbeat('b', now=beat)
+
+        assert registry.get_phi('b', now=10) == 0.0
+        assert registry.is_available('a', now=4.5)
+        assert not registry.is_available('a', now=10)
+        assert not registry.is_available('a', threshold=1, now=5.2)
+        registry.remove_peer('a')
+        assert registry.get_phi('a', now=10) == 0.0
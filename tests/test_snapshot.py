@@ -0,0 +1,32 @@
+from qcluster.snapshot import Snapshot, SnapshotStore
+
+
+class TestSnapshot:
+
+    def test_chunks(self):
+        snapshot = Snapshot(3, 1, b'abcdefg')
+        chunks = [(offset, bytes(chunk), done)
+                  for offset, chunk, done in snapshot.chunks(3)]
+        assert chunks == [(0, b'abc', False), (3, b'def', False),
+                          (6, b'g', True)]
+
+    def test_empty_snapshot_is_one_chunk(self):
+        snapshot = Snapshot(3, 1, b'')
+        assert [(offset, bytes(chunk), done) for offset, chunk, done
+                in snapshot.chunks(3)] == [(0, b'', True)]
+
+
+class TestSnapshotStore:
+
+    def test_latest_of_empty_store(self, tmp_path):
+        store = SnapshotStore(str(tmp_path / 'snapshots'))
+        assert store.latest() is None
+
+    def test_save_and_retain(self, tmp_path):
+        store = SnapshotStore(str(tmp_path), retain=2)
+        for index in (10, 20, 30):
+            store.save(Snapshot(index, 2, str(index).encode()))
+
+        assert [index for index, _, _ in store.list()] == [20, 30]
+        latest = store.latest()
+        assert (latest.index, latest.term, latest.data) == (30, 2, b'30')
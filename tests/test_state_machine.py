@@ -0,0 +1,44 @@
+import pytest
+
+from qcluster.log import LogEntry
+from qcluster.state_machine import KeyValueStateMachine
+
+
+class TestKeyValueStateMachine:
+
+    def test_put_and_get(self):
+        sm = KeyValueStateMachine()
+        assert sm.apply(LogEntry(1, 1, {'op': 'put', 'key': 'a', 'value': 5})) is True
+        assert sm.get('a') == 5
+        assert sm.get('b', 'missing') == 'missing'
+
+    def test_delete(self):
+        sm = KeyValueStateMachine()
+        sm.apply(LogEntry(1, 1, {'op': 'put', 'key': 'a', 'value': None}))
+        assert sm.apply(LogEntry(2, 1, {'op': 'delete', 'key': 'a'})) is True
+        assert sm.apply(LogEntry(3, 1, {'op': 'delete', 'key': 'a'})) is False
+        assert sm.get('a', 'gone') == 'gone'
+
+    def test_compare_and_set(self):
+        sm = KeyValueStateMachine()
+        assert sm.apply(LogEntry(1, 1, {'op': 'cas', 'key': 'a', 'expected': None, 'value': 1})) is True
+        assert sm.apply(LogEntry(2, 1, {'op': 'cas', 'key': 'a', 'expected': 2, 'value': 3})) is False
+        assert sm.apply(LogEntry(3, 1, {'op': 'cas', 'key': 'a', 'expected': 1, 'value': 3})) is True
+        assert sm.get('a') == 3
+
+    def test_unknown_operation_raises(self):
+        sm = KeyValueStateMachine()
+        with pytest.raises(ValueError):
+            sm.apply(LogEntry(1, 1, {'op': 'increment', 'key': 'a'}))
+        with pytest.raises(ValueError):
+            sm.apply(LogEntry(1, 1, 'put a 5'))
+
+    def test_snapshot_and_restore(self):
+        sm = KeyValueStateMachine()
+        sm.apply(LogEntry(1, 1, {'op': 'put', 'key': 'a', 'value': 1}))
+        snapshot = sm.snapshot()
+        sm.apply(LogEntry(2, 1, {'op': 'put', 'key': 'b', 'value': 2}))
+
+        restored = KeyValueStateMachine()
+        restored.restore(snapshot)
+        assert restored.data == {'a': 1}
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import pytest
+import threading
+
+from qcluster.log import RaftLog
+from qcluster.wal import (WriteAheadLog, encode_record, decode_records,
+                          RECORD_ENTRY)
+
+
+def reopen(directory, **kwargs):
+    wal = WriteAheadLog(directory, **kwargs)
+    wal.open()
+    return wal
+
+
+class TestWriteAheadLog:
+
+    @pytest.mark.asyncio
+    async def test_recovers_state_and_entries(self, tmp_path):
+        wal = reopen(str(tmp_path))
+        wal.save_state(3, 'server_b')
+        wal.append(1, 1, None)
+        wal.append(2, 3, {'op': 'put', 'key': 'a', 'value': 1})
+        await wal.sync()
+        assert wal.durable_index == 2
+        wal.close()
+
+        wal = reopen(str(tmp_path))
+        assert wal.term == 3
+        assert wal.voted_for == 'server_b'
+        assert wal.entries == [(1, 1, None),
+                               (2, 3, {'op': 'put', 'key': 'a', 'value': 1})]
+        assert wal.durable_index == 2
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_truncate_and_overwrite(self, tmp_path):
+        wal = reopen(str(tmp_path))
+        for index in range(1, 6):
+            wal.append(index, 1, index)
+        wal.truncate(4)
+        wal.append(3, 2, 'c')
+        await wal.sync()
+        wal.close()
+
+        wal = reopen(str(tmp_path))
+        assert wal.entries == [(1, 1, 1), (2, 1, 2), (3, 2, 'c')]
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_group_commit_shares_one_fsync(self, tmp_path, monkeypatch):
+        wal = reopen(str(tmp_path), flush_window=0.01)
+        fsyncs = []
+        real_fsync = os.fsync
+        monkeypatch.setattr(os, 'fsync',
+                            lambda fd: fsyncs.append(fd) or real_fsync(fd))
+        futures = [wal.append(index, 1, index) for index in range(1, 51)]
+        await asyncio.gather(*futures)
+        assert len(fsyncs) == 1
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_sync_waits_for_the_write_in_progress(self, tmp_path):
+        wal = reopen(str(tmp_path), flush_window=0)
+        written = threading.Event()
+        real_write = wal._write
+        wal._write = lambda records: written.wait(5) and real_write(records)
+        wal.append(1, 1, 'x')
+        # The flusher takes the buffered record and starts writing it
+        await asyncio.sleep(0.01)
+        sync = asyncio.ensure_future(wal.sync())
+        await asyncio.sleep(0.01)
+        assert not sync.done()
+        written.set()
+        await sync
+        assert wal.durable_index == 1
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_failed_write_fails_the_log(self, tmp_path):
+        wal = reopen(str(tmp_path), flush_window=0)
+        await wal.append(1, 1, 'a')
+        real_write = wal._write
+
+        def failing_write(records):
+            raise OSError("disk on fire")
+        wal._write = failing_write
+        failed = wal.append(2, 1, 'b')
+        with pytest.raises(OSError):
+            await failed
+        wal._write = real_write
+
+        with pytest.raises(OSError):
+            await wal.append(3, 1, 'c')
+        with pytest.raises(OSError):
+            await wal.save_state(2, None)
+        with pytest.raises(OSError):
+            await wal.sync()
+        assert wal.durable_index == 1
+        wal.close()
+
+        wal = reopen(str(tmp_path))
+        assert wal.entries == [(1, 1, 'a')]
+        assert wal.error is None
+        wal.append(2, 1, 'b')
+        await wal.sync()
+        assert wal.durable_index == 2
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_segments_roll_and_are_preallocated(self, tmp_path):
+        wal = reopen(str(tmp_path), segment_size=256)
+        for index in range(1, 41):
+            wal.append(index, 1, 'x' * 10)
+        await wal.sync()
+        wal.close()
+
+        assert len(wal.segments) > 1
+        for name in wal.segments:
+            assert os.path.getsize(wal.segment_path(name)) == 256
+        wal = reopen(str(tmp_path), segment_size=256)
+        assert [entry[0] for entry in wal.entries] == list(range(1, 41))
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_torn_write_is_discarded(self, tmp_path):
+        wal = reopen(str(tmp_path))
+        wal.append(1, 1, 'a')
+        wal.append(2, 1, 'b')
+        await wal.sync()
+        wal.close()
+
+        # Corrupt the last record, as a crash in the middle of a write would
+        path = wal.segment_path(wal.segments[-1])
+        with open(path, 'r+b') as f:
+            data = f.read()
+            end = data.index(b'"b"')
+            f.seek(end)
+            f.write(b'"z"')
+
+        wal = reopen(str(tmp_path))
+        assert wal.entries == [(1, 1, 'a')]
+        wal.append(2, 2, 'c')
+        await wal.sync()
+        wal.close()
+        wal = reopen(str(tmp_path))
+        assert wal.entries == [(1, 1, 'a'), (2, 2, 'c')]
+        wal.close()
+
+    def test_record_checksum_covers_type(self):
+        record = bytearray(encode_record(RECORD_ENTRY, b'payload'))
+        assert len(list(decode_records(bytes(record)))) == 1
+        record[8] = RECORD_ENTRY + 1
+        assert list(decode_records(bytes(record))) == []
+
+    @pytest.mark.asyncio
+    async def test_raft_log_writes_through(self, tmp_path):
+        wal = reopen(str(tmp_path))
+        log = RaftLog(wal)
+        log.append(1, 'a')
+        log.append(1, 'b')
+        log.append_entries(1, 1, [{'term': 2, 'data': 'c'}])
+        await wal.sync()
+        wal.close()
+
+        wal = reopen(str(tmp_path))
+        log = RaftLog(wal)
+        log.load(wal.entries)
+        assert [(e.index, e.term, e.data) for e in log.entries] == \
+            [(1, 1, 'a'), (2, 2, 'c')]
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_compaction_removes_old_segments(self, tmp_path):
+        wal = reopen(str(tmp_path), segment_size=256)
+        wal.save_state(2, 'a')
+        for index in range(1, 31):
+            wal.append(index, 2, index)
+        await wal.sync()
+        segments = list(wal.segments)
+
+        await wal.compact(25, 2)
+        await wal.sync()
+        assert wal.segments[0] != segments[0]
+        assert len(wal.segments) < len(segments)
+        wal.close()
+
+        wal = reopen(str(tmp_path), segment_size=256)
+        assert (wal.term, wal.voted_for) == (2, 'a')
+        assert (wal.snapshot_index, wal.snapshot_term) == (25, 2)
+        assert [entry[0] for entry in wal.entries] == [26, 27, 28, 29, 30]
+        assert wal.last_index == 30
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_open_skips_entries_covered_by_a_snapshot(self, tmp_path):
+        wal = reopen(str(tmp_path))
+        for index in range(1, 6):
+            wal.append(index, 1, {'n': index})
+        await wal.sync()
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path))
+        wal.open(skip_through=3)
+        assert wal.entries == [(4, 1, {'n': 4}), (5, 1, {'n': 5})]
+        assert wal.last_index == 5
+        wal.close()
+
+    @pytest.mark.asyncio
+    async def test_compaction_keeps_the_membership(self, tmp_path):
+        members = [{'host': 'localhost', 'port': 7001, 'identifier': 'a', 'metadata': {}}]
+        wal = reopen(str(tmp_path), segment_size=256)
+        for index in range(1, 31):
+            wal.append(index, 1, index)
+        await wal.compact(25, 1, members)
+        wal.save_state(2, None)
+        await wal.sync()
+        wal.close()
+
+        wal = reopen(str(tmp_path), segment_size=256)
+        assert wal.membership == members
+        assert wal.term == 2
+        wal.close()